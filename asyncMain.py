@@ -0,0 +1,471 @@
+import telebot
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware
+import asyncio
+
+import customTypes as types
+import constants
+import library
+import botSetup
+import voting
+import commands
+import metrics
+from searchResults import SearchSession
+from rateLimit import RateLimited
+
+
+# Asyncio version of the bot (main.py), run with: python asyncMain.py
+# Handlers never block the event loop: Google Books and Telegram are awaited, SQLite calls run on the database executor
+# and reports are rendered in a separate process, so one slow command does not hold up the others
+
+# The bot is created on import so that the module can be re-imported by the report rendering processes
+# Its token is only set once the secrets are loaded by the entry point, importing the module needs no secrets
+bot = AsyncTeleBot('', parse_mode="Markdown", validate_token = False)
+
+# References to running background tasks, so that they are not garbage collected before they finish
+backgroundTasks: set[asyncio.Task] = set()
+
+# Load the secrets, then create the database and the state shared by the handlers, as main.setup() does
+def setup():
+    global bookClubDB, asyncDB, clubs, userProfiles, userSearchResults, chapterExecutor
+    bookClubDB, asyncDB, clubs, userProfiles, userSearchResults, chapterExecutor = botSetup.setup(bot, useAsync = True)
+
+
+# Get dictionary of user mentions based on user IDs
+async def getUserMentions(chatId, userIds: list[int]):
+    return { userId: commands.userMention(userId, firstName) for userId, firstName in (await getUserNames(chatId, userIds)).items() }
+
+# Get dictionary of user names based on user IDs, asking Telegram only about users missing from the profile cache
+async def getUserNames(chatId, userIds: list[int]):
+    async def fetchUser(userId: int) -> telebot.types.User:
+        return (await bot.get_chat_member(chatId, userId)).user
+    return await userProfiles.getFirstNamesAsync(list(userIds), fetchUser)
+
+# Get the user IDs of a group's admins
+async def getChatAdmins(chatId) -> list[int]:
+    return [member.user.id for member in await bot.get_chat_administrators(chatId)]
+
+# Send a table as one or more text messages, or as images if it is too wide to read as text
+async def sendTable(chatId: int, table: types.Table, fileName: str):
+    if voting.isWideTable(table):
+        # Drawing large images takes a while, keep it off the event loop
+        images = await asyncio.get_running_loop().run_in_executor(None, voting.drawTableImages, table)
+        for imageIdx, image in enumerate(images):
+            suffix = f'-{imageIdx + 1}' if len(images) > 1 else ''
+            await bot.send_document(chatId, image, visible_file_name = f'{fileName}{suffix}.png')
+    else:
+        for tableMessage in voting.drawTable(table):
+            await bot.send_message(chatId, tableMessage, parse_mode = 'html')
+
+# Helper function for gating access to commands of the club with the given chat ID, same rules as in main.py
+async def commandAllowed(message: telebot.types.Message, chatId: int, requirements: types.CommandRequirements):
+    # Load the club's meeting state off the event loop, the rules below only read it from memory
+    await asyncDB.getMeetingState(chatId)
+    isAdmin = bool(requirements.get('onlyAdmin') and message.from_user and await clubs.isAdminAsync(chatId, message.from_user.id, getChatAdmins))
+    rejection = commands.commandRejection(bookClubDB, message, requirements, chatId, isAdmin)
+    if rejection:
+        await bot.reply_to(message, rejection)
+        return False
+    return True
+
+# Run a coroutine as a background task, printing any exception it raises as nothing awaits its result
+def runInBackground(coroutine):
+    task = asyncio.create_task(coroutine)
+    backgroundTasks.add(task)
+    task.add_done_callback(backgroundTasks.discard)
+    task.add_done_callback(reportBackgroundFailure)
+
+def reportBackgroundFailure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task {task.get_coro().__qualname__} failed: {task.exception()}")
+
+
+# Record the profile of every user sending a message, keeping the user profile cache warm, and the club they are in
+class ObserveUserMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message']
+
+    async def pre_process(self, message: telebot.types.Message, data: dict):
+        if message.from_user:
+            await userProfiles.observeAsync(message.from_user)
+            await clubs.observeAsync(message)
+
+    async def post_process(self, message: telebot.types.Message, data: dict, exception: Exception | None):
+        pass
+
+bot.setup_middleware(ObserveUserMiddleware())
+
+
+# Print message with instructions on how the bot operates
+@bot.message_handler(commands=['instructions'])
+@metrics.timeHandler
+async def printInstructions(message: telebot.types.Message):
+    await bot.reply_to(message, commands.instructionsMessage())
+
+
+# Print message with possible commands
+@bot.message_handler(commands=['commands'])
+@metrics.timeHandler
+async def printCommands(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    await bot.reply_to(message, commands.commandsMessage())
+
+
+# List the clubs of the user, or switch to a different one
+@bot.message_handler(commands=['club'])
+@metrics.timeHandler
+async def club(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    userClubs = await clubs.getClubsAsync(message.from_user.id)
+    if not message.text.strip().removeprefix('/club').strip():
+        await bot.reply_to(message, commands.clubsReply(userClubs, chatId))
+        return
+    chosenChatId, error = commands.parseClubChoice(message.text, userClubs)
+    if error:
+        await bot.reply_to(message, error)
+        return
+
+    await clubs.selectClubAsync(message.from_user.id, chosenChatId)
+    await bot.reply_to(message, commands.clubsReply(await clubs.getClubsAsync(message.from_user.id), chosenChatId))
+
+
+# Check the current status of the meeting
+@bot.message_handler(commands=['checkStatus'])
+@metrics.timeHandler
+async def checkStatus(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private', 'group', 'supergroup'],
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    # Check for active meeting
+    try:
+        activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
+    except:
+        await bot.reply_to(message, f'There is no active meeting. An admin needs to initiate a new meeting to begin the process.')
+        return
+
+    # Check the stage of the meeting
+    [stage, volumeId] = await asyncDB.getMeeting(chatId, activeMeetingId)
+    match stage:
+        case 'submit':
+            usersWhoSubmitted = await asyncDB.getSubmitters(chatId)
+            userMentions = ', '.join((await getUserMentions(chatId, usersWhoSubmitted)).values())
+            await bot.reply_to(message, f'I am currently collecting submissions for meeting {activeMeetingId}\nThe following users have submitted books: {userMentions}')
+            return
+        case 'vote':
+            usersWhoVoted = await asyncDB.getVoters(chatId)
+            userMentions = ', '.join((await getUserMentions(chatId, usersWhoVoted)).values())
+            reply = f'I am currently collecting votes for meeting {activeMeetingId}.\nThe following users have voted ({len(usersWhoVoted)} so far): {userMentions}'
+            # The projected winner is only revealed to admins, in private
+            if message.chat.type == 'private' and usersWhoVoted and await clubs.isAdminAsync(chatId, message.from_user.id, getChatAdmins):
+                _, voteResult = await asyncDB.getTally(chatId)
+                leaderVolume = await library.getBookVolumeAsync(await asyncDB.getSubmissionVolumeId(chatId, voteResult['winner']))
+                reply += '\n\n' + commands.projectionReply(voteResult, await asyncDB.getFirstPreferences(chatId), leaderVolume)
+            await bot.reply_to(message, reply)
+            return
+        case 'report':
+            await bot.reply_to(message, f'I am rendering the submission report for meeting {activeMeetingId}, the vote stage begins once it has been sent.')
+            return
+        case 'organized':
+            bookVolume = await library.getBookVolumeAsync(volumeId)
+            await bot.reply_to(message, f'Meeting {activeMeetingId} has been organized.\n{library.formatBookVolume(bookVolume)} was chosen.')
+            return
+        case _:
+            raise Exception(f'Invalid stage: {stage}')
+
+
+# Initiate a new meeting
+@bot.message_handler(commands=['newMeeting'])
+@metrics.timeHandler
+async def newMeeting(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['group', 'supergroup'],
+        'onlyAdmin': True,
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    await asyncDB.newMeeting(chatId)
+    activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
+
+    await bot.reply_to(message, f'I have initiated meeting number {activeMeetingId} for the book club.')
+
+# Begin the process of submitting a book
+@bot.message_handler(commands=['search'])
+@metrics.timeHandler
+async def search(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+        'activeMeeting': True,
+        'stage': 'submit',
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    try:
+        numFound, searchResults, nextIndex = await library.findBookVolumesAsync(message.text, message.from_user.id)
+    except RateLimited as e:
+        await bot.reply_to(message, commands.slowDownReply(e))
+        return
+    if not searchResults:
+        await bot.reply_to(message, "No results found, please try again.")
+        return
+
+    session = commands.addSearchPage(SearchSession.new(message.text, numFound, searchResults, nextIndex))
+    await userSearchResults.saveAsync(message.from_user.id, session)
+    replyString, keyboard = commands.searchPageReply(session, 0)
+
+    await bot.reply_to(message, replyString, reply_markup = keyboard)
+
+
+# List the next page of a search, first fetching more results from Google Books if there are not enough left for a full page
+# The page is not added if there are no results left to list (e.g. Google Books could not be reached), raises RateLimited
+async def listNextSearchPage(session: SearchSession, userId: int) -> SearchSession:
+    for _ in range(constants.SEARCH_PAGE_MAX_FETCHES):
+        if not session.needsResults(constants.MAX_SEARCH_RESULTS):
+            break
+        moreResults = await library.findMoreBookVolumesAsync(session.input, session.nextIndex, userId)
+        if moreResults is None:
+            break
+        session = session.withResults(*moreResults)
+    return commands.addSearchPage(session) or session
+
+# Show another page of search results in place of the current one, when the user presses one of its buttons
+# Pages are listed (and their results fetched) the first time they are shown, afterwards they are shown as they were
+@bot.callback_query_handler(func = lambda call: commands.parseSearchPage(call.data) is not None)
+@metrics.timeHandler
+async def searchPage(call: telebot.types.CallbackQuery):
+    searchId, pageIdx = commands.parseSearchPage(call.data)
+    userId = call.from_user.id
+    session = await userSearchResults.getAsync(userId)
+    if session and session.searchId == searchId and pageIdx == len(session.pageEnds):
+        try:
+            session = await listNextSearchPage(session, userId)
+        except RateLimited as e:
+            await bot.answer_callback_query(call.id, commands.slowDownReply(e), show_alert = True)
+            return
+        await userSearchResults.saveAsync(userId, session)
+
+    shownPageIdx, alert = commands.searchPageToShow(session, searchId, pageIdx)
+    if shownPageIdx is not None:
+        replyString, keyboard = commands.searchPageReply(session, shownPageIdx)
+        try:
+            await bot.edit_message_text(replyString, call.message.chat.id, call.message.message_id, reply_markup = keyboard)
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            # Pressing a button twice asks for the page which is already shown
+            if 'message is not modified' not in e.description:
+                raise
+    await bot.answer_callback_query(call.id, alert, show_alert = alert is not None)
+
+
+# Submit a book from the user's previous search result
+@bot.message_handler(commands=['choose'])
+@metrics.timeHandler
+async def chooseSubmission(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+        'activeMeeting': True,
+        'stage': 'submit',
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+    userId = message.from_user.id
+
+    session = await userSearchResults.getAsync(userId)
+    searchResults = session.listed() if session else None
+    choiceIdx, error = commands.parseChoice(message.text, searchResults)
+    if error:
+        await bot.reply_to(message, error)
+        return
+
+    volumeId = searchResults[choiceIdx]['id']
+    if not await asyncDB.submitBook(chatId, userId, volumeId):
+        await bot.reply_to(message, 'Submissions for the active meeting have just been closed, so I could not save your choice.')
+        return
+    chapterExecutor.submit(commands.prepareSubmissionChapter, bookClubDB, chatId, bookClubDB.getActiveMeetingId(chatId), userId, volumeId)
+    replyString = f"I saved your choice of {library.formatBookVolume(searchResults[choiceIdx])}."
+
+    await bot.reply_to(message, replyString)
+
+
+# Finalize the submit stage, generate a submission report and begin the vote stage
+@bot.message_handler(commands=['finishSubmissions'])
+@metrics.timeHandler
+async def finishSubmissions(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['group', 'supergroup'],
+        'activeMeeting': True,
+        'onlyAdmin': True,
+        'stage': 'submit',
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    # Generate report
+    activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
+    if bookClubDB.getSubmissionCount(chatId) == 0:
+        await bot.reply_to(message, f'No submissions found, please submit some books for the active meeting.')
+        return
+    # Close the submissions first, so that the report and the ballot of the vote stage list the same books
+    if not await asyncDB.closeSubmissions(chatId):
+        await bot.reply_to(message, f'I am already rendering the submission report for meeting {activeMeetingId}, please be patient.')
+        return
+    try:
+        submissionsData = await asyncDB.getSubmissions(chatId, activeMeetingId)
+        # Use the chapters prepared when books were submitted, only fetching the volumes of those which are missing
+        chapters = await asyncDB.getSubmissionAssets(chatId, activeMeetingId)
+        bookVolumes, errors = await library.getBookVolumesAsync([volumeId for (_, submissionId, volumeId) in submissionsData if submissionId not in chapters])
+        if errors:
+            await asyncDB.reopenSubmissions(chatId)
+            await bot.reply_to(message, commands.fetchErrorReply(errors))
+            return
+        chapters = commands.reportChapters(submissionsData, chapters, bookVolumes)
+
+        # Render the report in a separate process, the vote stage begins once it has been sent
+        await bot.reply_to(message, f'Rendering the submission report for meeting {activeMeetingId}\u2026')
+        # The report module (fpdf, fontTools, Pillow) is only imported by the first report, not when the bot starts
+        import submissionReport
+        future = asyncio.wrap_future(submissionReport.generateInBackground(activeMeetingId, chapters, commands.clubName(message.chat)))
+    except Exception:
+        await asyncDB.reopenSubmissions(chatId)
+        raise
+    runInBackground(sendSubmissionReport(message, chatId, activeMeetingId, future))
+    chapterExecutor.submit(voting.preloadTally)
+
+# Send the rendered submission report and begin the vote stage
+async def sendSubmissionReport(message: telebot.types.Message, chatId: int, meetingId: int, future: asyncio.Future):
+    try:
+        report = await future
+        await bot.send_document(message.chat.id, report, caption = f"Meeting {meetingId} of {commands.clubName(message.chat)}: Submission Overview", visible_file_name = f"bookClubSubmissions-meeting{meetingId}.pdf")
+        # Begin vote stage
+        await asyncDB.startVoting(chatId)
+    except Exception as e:
+        print(f"Failed to deliver the submission report for meeting {meetingId}: {e}")
+        await asyncDB.reopenSubmissions(chatId)
+        await bot.reply_to(message, f'Something went wrong while preparing the submission report, please try again.')
+        return
+
+    await bot.reply_to(message, f'The voting stage has begun. Please have a look at the submission overview I generated and vote based on their IDs.')
+
+
+# Vote on three books (descending order of priority) from the submissions in the active meeting
+@bot.message_handler(commands=['vote'])
+@metrics.timeHandler
+async def vote(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+        'activeMeeting': True,
+        'stage': 'vote',
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+    userId = message.from_user.id
+
+    choices, error = commands.parseVotes(message.text, bookClubDB.getSubmissionCount(chatId))
+    if error:
+        await bot.reply_to(message, error)
+        return
+
+    await asyncDB.vote(chatId, userId, choices[0], choices[1], choices[2])
+    chosenVolumeIds = [bookClubDB.getSubmissionVolumeId(chatId, choice) for choice in choices]
+    bookVolumes, _ = await library.getBookVolumesAsync(chosenVolumeIds)
+    chosenBooks = [bookVolumes[volumeId] for volumeId in chosenVolumeIds if volumeId in bookVolumes]
+
+    await bot.reply_to(message, f'Successfully saved your votes:\n{library.formatBookVolumeList(chosenBooks)}')
+
+
+# Finalize the vote stage and choose the winning submission
+@bot.message_handler(commands=['finishVoting'])
+@metrics.timeHandler
+async def finishVoting(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['group', 'supergroup'],
+        'activeMeeting': True,
+        'onlyAdmin': True,
+        'stage': 'vote',
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    # Gather data from BookClubDB
+    activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
+    # Votes, tallied as they came in
+    userVotes, voteResult = await asyncDB.getTally(chatId)
+    if len(userVotes.keys()) == 0:
+        await bot.reply_to(message, f'No votes found, cannot perform voting process.')
+        return
+    # Submissions
+    submissionsData = await asyncDB.getSubmissions(chatId, activeMeetingId)
+    bookVolumes, errors = await library.getBookVolumesAsync([volumeId for (_, _, volumeId) in submissionsData])
+    if errors:
+        await bot.reply_to(message, commands.fetchErrorReply(errors))
+        return
+    submissions = { int(submissionId): bookVolumes[volumeId] for (_, submissionId, volumeId) in submissionsData }
+    # Vote tables
+    userNames = await getUserNames(chatId, userVotes.keys())
+    winner = voteResult['winner']
+    voteTable = voting.voteTable(userVotes, list(submissions.keys()), userNames)
+    roundTable = voting.roundTable(voteResult)
+    # End vote stage
+    await asyncDB.endVoting(chatId, submissions[winner].get('id'))
+
+    # Drawing a wide table as images takes a while, the results are sent in the background
+    runInBackground(sendVoteResults(message, activeMeetingId, voteTable, roundTable, submissions[winner]))
+
+# Send the vote and round tables of a meeting, then announce its winner
+async def sendVoteResults(message: telebot.types.Message, meetingId: int, voteTable: types.Table, roundTable: types.Table, winner: types.BookVolume):
+    await sendTable(message.chat.id, voteTable, f'votes-meeting{meetingId}')
+    await sendTable(message.chat.id, roundTable, f'rounds-meeting{meetingId}')
+    await bot.reply_to(message, f'The voting stage has concluded! The winner is {library.formatBookVolume(winner)}. See the tables above to see how users voted and how many votes each book had in every round (- being ballots with no books left).')
+
+
+# Print how long commands and the work behind them take, and how often the caches are hit
+@bot.message_handler(commands=['stats'])
+@metrics.timeHandler
+async def stats(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+        'onlyMasterUser': True,
+    }
+    chatId = await clubs.getClubIdAsync(message)
+    if not await commandAllowed(message, chatId, commandRequirements):
+        return
+
+    await bot.reply_to(message, commands.statsReply(metrics.registry, library.client.quota.usage()))
+
+
+async def run():
+    try:
+        await bot.infinity_polling()
+    finally:
+        await library.asyncClient.close()
+        await bot.close_session()
+
+
+# Initialize infinity polling to enable the bot
+if __name__ == '__main__':
+    setup()
+    metrics.startExporters()
+    asyncio.run(run())
@@ -0,0 +1,73 @@
+# Stand-in for the Telegram Bot API used by the benchmarks, so that the bot's real handlers can run without network access
+# Install it with telebot.apihelper.CUSTOM_REQUEST_SENDER = FakeTelegram(), every API call is then answered in-process
+# with a plausible result and counted per method
+import json
+import time
+import threading
+from collections import Counter
+
+import telebot
+
+
+class FakeResponse:
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, result):
+        self.text = json.dumps({ 'ok': True, 'result': result })
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def user(userId: int) -> dict:
+    return { 'id': userId, 'is_bot': False, 'first_name': f'Reader {userId}' }
+
+
+class FakeTelegram:
+    def __init__(self, adminIds: list[int] = [1]):
+        self.adminIds = adminIds
+        self.lock = threading.Lock()
+        # method -> number of calls
+        self.calls = Counter()
+        # (method, perf_counter) of every message or document sent
+        self.sent: list[tuple[str, float]] = []
+
+    def __call__(self, method, url, **kwargs):
+        params = kwargs.get('params') or {}
+        apiMethod = url.rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[apiMethod] += 1
+            if apiMethod.startswith('send'):
+                self.sent.append((apiMethod, time.perf_counter()))
+        match apiMethod:
+            case 'getChatMember':
+                return FakeResponse({ 'status': 'member', 'user': user(int(params['user_id'])) })
+            case 'getChatAdministrators':
+                return FakeResponse([{ 'status': 'creator', 'user': user(adminId) } for adminId in self.adminIds])
+            case _:
+                return FakeResponse({ 'message_id': 1, 'date': 0, 'chat': { 'id': int(params.get('chat_id', 0)), 'type': 'private' } })
+
+    # Wait until a method was called after the given time, returning the time of that call or None on timeout
+    def waitFor(self, apiMethod: str, after: float, timeout: float) -> float | None:
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            with self.lock:
+                for sentMethod, sentAt in self.sent:
+                    if sentMethod == apiMethod and sentAt > after:
+                        return sentAt
+            time.sleep(0.01)
+        return None
+
+    def install(self):
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = self
+
+
+# Update carrying a command sent by a user, in a group chat if chatId is given, otherwise in a private chat
+def update(text: str, userId: int, chatId: int | None = None) -> telebot.types.Update:
+    chat = { 'id': chatId, 'type': 'supergroup', 'title': f'Club {chatId}' } if chatId else { 'id': userId, 'type': 'private' }
+    command = text.split()[0]
+    return telebot.types.Update.de_json({ 'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': text, 'from': user(userId), 'chat': chat,
+        'entities': [{ 'type': 'bot_command', 'offset': 0, 'length': len(command) }],
+    } })
@@ -0,0 +1,166 @@
+# Local stand-in for the Google Books API used by the benchmarks, replaying recorded responses with a configurable latency
+# Searches which were not recorded are answered with a deterministic selection of the recorded volumes, and cover images
+# are generated and served by the stub itself, so nothing leaves the machine
+# Point the bot at it with library.client.baseUrl = stub.baseUrl
+# Run from the repository root:
+#   python bench/googleBooksStub.py [--latency 0.1] [--port 8766]   serve the recordings until interrupted
+#   python bench/googleBooksStub.py --record <query> [<query> ...]  record real responses (needs GOOGLE_BOOKS_API_KEY)
+import os
+import sys
+import io
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image, ImageDraw
+
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(__file__), 'googleBooksRecordings.json')
+
+class GoogleBooksStub:
+    def __init__(self, recordingsPath: str = RECORDINGS_PATH, latency: float = 0.0, jitter: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        with open(recordingsPath, encoding = 'utf-8') as recordingsFile:
+            recordings = json.load(recordingsFile)
+        # q -> { totalItems, ids }
+        self.searches: dict[str, dict] = recordings['searches']
+        # volumeId -> volume resource
+        self.volumes: dict[str, dict] = recordings['volumes']
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        # 'search' | 'volume' | 'cover' | 'notFound' -> number of requests
+        self.calls = Counter()
+        self.covers: dict[str, bytes] = {}
+        self.httpServer = ThreadingHTTPServer((host, port), self.requestHandler())
+        self.httpServer.daemon_threads = True
+        host, port = self.httpServer.server_address[:2]
+        self.url = f'http://{host}:{port}'
+        self.baseUrl = f'{self.url}/books/v1'
+
+    def start(self) -> 'GoogleBooksStub':
+        threading.Thread(target = self.httpServer.serve_forever, name = 'google-books-stub', daemon = True).start()
+        return self
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    def count(self, kind: str):
+        with self.lock:
+            self.calls[kind] += 1
+
+    # A recorded volume, with its cover links pointing at the stub
+    def volume(self, volumeId: str) -> dict:
+        volume = json.loads(json.dumps(self.volumes[volumeId]))
+        if 'imageLinks' in volume['volumeInfo']:
+            volume['volumeInfo']['imageLinks'] = { size: f'{self.url}/covers/{volumeId}.jpg' for size in volume['volumeInfo']['imageLinks'] }
+        return volume
+
+    # The page of a search starting at startIndex, later pages going on with the recorded volumes which were not on the
+    # first one (in an order depending on the query) until they run out
+    def search(self, query: str, startIndex: int = 0, maxResults: int = 10) -> dict:
+        volumeIds = sorted(self.volumes.keys())
+        random.Random(hashlib.sha256(query.encode()).digest()).shuffle(volumeIds)
+        recorded = self.searches.get(query)
+        if recorded is None:
+            recorded = { 'totalItems': 10 + len(query) * 7, 'ids': volumeIds[:10] }
+        if startIndex == 0:
+            pageIds = recorded['ids']
+        else:
+            pageIds = (recorded['ids'] + [volumeId for volumeId in volumeIds if volumeId not in recorded['ids']])[startIndex:startIndex + maxResults]
+        result = { 'kind': 'books#volumes', 'totalItems': recorded['totalItems'] }
+        if pageIds:
+            result['items'] = [self.volume(volumeId) for volumeId in pageIds]
+        return result
+
+    # A cover image in the colors of the volume, generated once per volume
+    def cover(self, volumeId: str) -> bytes:
+        with self.lock:
+            if volumeId not in self.covers:
+                color = tuple(hashlib.sha256(volumeId.encode()).digest()[:3])
+                image = Image.new('RGB', (128, 196), color)
+                ImageDraw.Draw(image).rectangle((12, 40, 116, 80), fill = (255, 255, 255))
+                output = io.BytesIO()
+                image.save(output, 'JPEG', quality = 90)
+                self.covers[volumeId] = output.getvalue()
+            return self.covers[volumeId]
+
+    def requestHandler(self):
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if stub.latency or stub.jitter:
+                    time.sleep(stub.latency + random.uniform(0, stub.jitter))
+                url = urlsplit(self.path)
+                parts = url.path.strip('/').split('/')
+                if parts[:3] == ['books', 'v1', 'volumes'] and len(parts) == 3:
+                    stub.count('search')
+                    query = parse_qs(url.query)
+                    result = stub.search(query.get('q', [''])[0], int(query.get('startIndex', ['0'])[0]), int(query.get('maxResults', ['10'])[0]))
+                    return self.respond(200, json.dumps(result).encode(), 'application/json')
+                if parts[:3] == ['books', 'v1', 'volumes'] and len(parts) == 4 and parts[3] in stub.volumes:
+                    stub.count('volume')
+                    return self.respond(200, json.dumps(stub.volume(parts[3])).encode(), 'application/json')
+                if parts[0] == 'covers' and len(parts) == 2 and parts[1].removesuffix('.jpg') in stub.volumes:
+                    stub.count('cover')
+                    return self.respond(200, stub.cover(parts[1].removesuffix('.jpg')), 'image/jpeg')
+                stub.count('notFound')
+                self.respond(404, json.dumps({ 'error': { 'code': 404, 'message': 'The volume ID could not be found.' } }).encode(), 'application/json')
+
+            def respond(self, status: int, body: bytes, contentType: str):
+                self.send_response(status)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+
+# Record the responses of the real Google Books API to the given searches, along with every volume they returned
+def record(queries: list[str], recordingsPath: str = RECORDINGS_PATH):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    import library
+
+    searches = {}
+    volumes = {}
+    for query in queries:
+        searchString = library.normalizeSearchString(library.parseSearchTerms(query))
+        result = library.client.get('volumes', library.searchParams(searchString))
+        if result is None:
+            raise Exception(f'Failed to record the search for {query}')
+        items = result.get('items') or []
+        searches[searchString] = { 'totalItems': result['totalItems'], 'ids': [item['id'] for item in items] }
+        for item in items:
+            volumes[item['id']] = library.client.get(f"volumes/{item['id']}") or item
+    with open(recordingsPath, 'w', encoding = 'utf-8') as recordingsFile:
+        json.dump({ 'searches': searches, 'volumes': volumes }, recordingsFile, indent = 1, ensure_ascii = False)
+    print(f"Recorded {len(searches)} searches and {len(volumes)} volumes to {recordingsPath}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds added to every response')
+    parser.add_argument('--jitter', type = float, default = 0.0, help = 'up to this many more seconds added at random')
+    parser.add_argument('--port', type = int, default = 8766)
+    parser.add_argument('--record', nargs = '+', metavar = 'QUERY', help = 'record the real responses to these searches instead of serving')
+    args = parser.parse_args()
+    if args.record:
+        record(args.record)
+    else:
+        stub = GoogleBooksStub(latency = args.latency, jitter = args.jitter, port = args.port)
+        print(f"Serving recorded Google Books responses on {stub.baseUrl}")
+        try:
+            stub.httpServer.serve_forever()
+        except KeyboardInterrupt:
+            pass
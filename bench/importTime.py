@@ -0,0 +1,120 @@
+# Cold start of the bots: time taken by importing main.py and asyncMain.py in a fresh interpreter, as measured by
+# python -X importtime, compared with a saved baseline. Restarts and short-lived webhook workers pay this on every start.
+# Also checks that the modules only needed by the submission report and the vote stage (loaded on first use) and the
+# .env loader (run by setup) are not imported at all, and lists what the import time is spent on.
+# The baseline is the bot before the lazy imports, whose constants module needs the secrets, so record it with a .env in place
+# Run from the repository root: python bench/importTime.py [--save-baseline]
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+ENTRY_MODULES = ['main', 'asyncMain']
+REPEATS = 15
+# Modules which must not be imported on startup
+LAZY_MODULES = ['submissionReport', 'fpdf', 'fontTools', 'numpy', 'PIL', 'prettytable', 'pyrankvote', 'dotenv']
+# The bot library each entry module is built on. telebot imports PIL itself (to send images), so a lazy module it imports is
+# only reported rather than counted, the check being meaningful for the repository's own imports alone
+ENTRY_LIBRARIES = { 'main': 'telebot', 'asyncMain': 'telebot.async_telebot' }
+# Slowest direct imports of the entry module to show
+SHOWN_IMPORTS = 10
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'importBaseline.json')
+# A module is flagged when it takes this much longer than in the baseline (fraction and milliseconds)
+REGRESSION_TOLERANCE = 0.25
+REGRESSION_MIN_DIFFERENCE = 10.0
+
+repositoryRoot = os.path.join(os.path.dirname(__file__), '..')
+
+# Import a module in a new interpreter, returning its -X importtime lines as (self us, cumulative us, depth, name) and the
+# modules imported once it is done
+def importOnce(module: str) -> tuple[list[tuple[int, int, int, str]], set[str]]:
+    code = f'import sys, json, {module}; print(json.dumps(sorted(sys.modules)))'
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd = repositoryRoot, capture_output = True, text = True, check = True)
+    lines = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        lines.append((int(selfTime), int(cumulative), (len(name) - len(name.lstrip()) - 1) // 2, name.strip()))
+    return lines, set(json.loads(process.stdout))
+
+# The modules imported directly by the entry module (the last one imported at the top level), with their cumulative times
+def directImports(lines: list[tuple[int, int, int, str]], module: str) -> dict[str, int]:
+    entryIdx = max(idx for idx, line in enumerate(lines) if line[3] == module and line[2] == 0)
+    imports = {}
+    for _, cumulative, depth, name in reversed(lines[:entryIdx]):
+        if depth == 0:
+            break
+        if depth == 1:
+            imports[name] = cumulative
+    return imports
+
+# Median import time of the entry module and of each of its direct imports (ms), the lazy modules which were imported by the
+# repository's own modules and those which its bot library imports
+def measure(module: str) -> tuple[float, dict[str, float], list[str], list[str]]:
+    # The first run compiles any stale bytecode, which is not what a restart pays
+    importOnce(module)
+    totals, imports = [], {}
+    for _ in range(REPEATS):
+        lines, loadedModules = importOnce(module)
+        totals.append(next(cumulative for _, cumulative, depth, name in reversed(lines) if name == module and depth == 0) / 1000)
+        for name, cumulative in directImports(lines, module).items():
+            imports.setdefault(name, []).append(cumulative / 1000)
+    _, libraryModules = importOnce(ENTRY_LIBRARIES[module])
+    eagerModules = [name for name in LAZY_MODULES if name in loadedModules and name not in libraryModules]
+    libraryLazyModules = [name for name in LAZY_MODULES if name in libraryModules]
+    return statistics.median(totals), { name: statistics.median(times) for name, times in imports.items() }, eagerModules, libraryLazyModules
+
+def isRegression(baseline: float, current: float) -> bool:
+    return current > baseline * (1 + REGRESSION_TOLERANCE) and current - baseline > REGRESSION_MIN_DIFFERENCE
+
+# Print an entry module's import times next to its baseline, returning the number of problems
+def report(module: str, total: float, imports: dict[str, float], eagerModules: list[str], libraryLazyModules: list[str], baseline: dict | None) -> int:
+    problems = 0
+    print(f"\nimport {module}")
+    print(f"  {'module':<28} {'baseline':>10} {'current':>10}")
+    rows = [(f'{module} (total)', total, baseline['total'] if baseline else None)]
+    slowest = sorted(imports.items(), key = lambda item: item[1], reverse = True)[:SHOWN_IMPORTS]
+    rows += [(name, time, (baseline or {}).get('imports', {}).get(name)) for name, time in slowest]
+    for name, current, previous in rows:
+        flag = ''
+        if previous is not None and isRegression(previous, current):
+            problems += 1
+            flag = '  <- regression'
+        print(f"  {name:<28} {'-' if previous is None else f'{previous:.1f}':>10} {current:>10.1f}{flag}")
+    if eagerModules:
+        problems += len(eagerModules)
+        print(f"  Imported on startup, expected to be loaded on first use: {', '.join(eagerModules)}")
+    if libraryLazyModules:
+        print(f"  Imported by {ENTRY_LIBRARIES[module]} itself, not checked: {', '.join(libraryLazyModules)}")
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', default = BASELINE_PATH)
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'save the results as the new baseline')
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baselineFile:
+            baselines = json.load(baselineFile)
+
+    allResults = {}
+    problems = 0
+    for module in ENTRY_MODULES:
+        total, imports, eagerModules, libraryLazyModules = measure(module)
+        allResults[module] = { 'total': total, 'imports': imports }
+        problems += report(module, total, imports, eagerModules, libraryLazyModules, baselines.get(module))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baselineFile:
+            json.dump(allResults, baselineFile, indent = 1)
+        print(f"\nSaved the results as the baseline in {args.baseline}")
+    elif problems:
+        print(f"\n{problems} regressions compared to the baseline")
+        sys.exit(1)
@@ -0,0 +1,105 @@
+# Differential check of voting.tallyVotes against pyrankvote's instant_runoff_voting, then a timing comparison of both
+# Random profiles in which a tie had to be broken are skipped by the check, as the two break ties differently
+# (pyrankvote falls back to random choices, tallyVotes is deterministic), those are checked by hand-built tie profiles instead
+# Run from the repository root: python bench/irvTally.py
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyrankvote import Candidate, Ballot, instant_runoff_voting
+
+import voting
+
+
+PROFILES = 1000
+BALLOT_COUNTS = [100, 1000, 10000, 50000]
+CANDIDATE_COUNT = 12
+BALLOT_LENGTH = 5
+REPEATS = 5
+
+# Ballots drawn with a popularity skew, so that runoffs take a few rounds and are not decided by ties
+def randomBallots(ballotCount: int, candidateCount: int, ballotLength: int) -> list[list[int]]:
+    candidates = list(range(1, candidateCount + 1))
+    weights = [random.random() ** 2 for _ in candidates]
+    ballots = []
+    for _ in range(ballotCount):
+        length = random.randint(1, min(ballotLength, candidateCount))
+        ballot = []
+        while len(ballot) < length:
+            choice = random.choices(candidates, weights)[0]
+            if choice not in ballot:
+                ballot.append(choice)
+        ballots.append(ballot)
+    return ballots
+
+def pyrankvoteWinner(ballots: list[list[int]], candidateIds: list[int]) -> int:
+    candidates = { candidateId: Candidate(candidateId) for candidateId in candidateIds }
+    result = instant_runoff_voting(list(candidates.values()), [Ballot([candidates[vote] for vote in ballot]) for ballot in ballots])
+    return result.get_winners()[0].name
+
+def differentialCheck():
+    compared = 0
+    skipped = 0
+    for _ in range(PROFILES):
+        candidateIds = list(range(1, random.randint(2, 8) + 1))
+        ballots = randomBallots(random.randint(1, 60), len(candidateIds), random.randint(1, 6))
+        result = voting.tallyVotes(ballots, candidateIds)
+        if any(voteRound['tieBreak'] for voteRound in result['rounds']):
+            skipped += 1
+            continue
+        expected = pyrankvoteWinner(ballots, candidateIds)
+        if result['winner'] != expected:
+            raise Exception(f"Winner {result['winner']} instead of {expected} for ballots {ballots}")
+        compared += 1
+    print(f"Same winner as pyrankvote in {compared} random profiles ({skipped} profiles with ties skipped)")
+
+# Hand-built profiles needing a tie-break, with the rounds' eliminations expected of tallyVotes
+# Each is (ballots as (count, ballot) pairs, candidates, tieBreakOrder, expected winner, eliminated candidates of each round)
+TIE_PROFILES = [
+    # First round tie, the candidate with the highest ID goes first
+    ([(3, [1]), (2, [2, 1]), (2, [3, 2])], [1, 2, 3], None, 2, [[3], []]),
+    # Same tie, the tie-break order deciding the other way
+    ([(3, [1]), (2, [2, 1]), (2, [3, 2])], [1, 2, 3], [3, 2, 1], 1, [[2], []]),
+    # Tie broken by the earlier round in which the tied candidates' votes differed, overriding the ID order
+    ([(5, [1]), (2, [2, 1]), (3, [3, 2]), (1, [4, 2, 1])], [1, 2, 3, 4], None, 1, [[4], [2], []]),
+    # Candidates without votes leave together without a tie-break, the following tie is equal in every round
+    ([(2, [1]), (2, [2, 1])], [1, 2, 3, 4], None, 1, [[3, 4], [2], []]),
+]
+
+def tieBreakCheck():
+    for ballotCounts, candidateIds, tieBreakOrder, expectedWinner, expectedEliminated in TIE_PROFILES:
+        ballots = [ballot for count, ballot in ballotCounts for _ in range(count)]
+        result = voting.tallyVotes(ballots, candidateIds, tieBreakOrder)
+        eliminated = [voteRound['eliminated'] for voteRound in result['rounds']]
+        if result['winner'] != expectedWinner or eliminated != expectedEliminated:
+            raise Exception(f"Winner {result['winner']} after eliminating {eliminated} instead of {expectedWinner} after {expectedEliminated} for ballots {ballotCounts}")
+        if not any(voteRound['tieBreak'] for voteRound in result['rounds']):
+            raise Exception(f"No tie was broken for ballots {ballotCounts}")
+    print(f"Expected tie-breaks in {len(TIE_PROFILES)} hand-built profiles")
+
+def timeIt(function, *args) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    differentialCheck()
+    tieBreakCheck()
+
+    candidateIds = list(range(1, CANDIDATE_COUNT + 1))
+    print(f"{CANDIDATE_COUNT} candidates, ballots ranking up to {BALLOT_LENGTH} of them")
+    print(f"{'ballots':>8} {'pyrankvote (ms)':>16} {'tallyVotes (ms)':>16} {'speedup':>8}")
+    for ballotCount in BALLOT_COUNTS:
+        ballots = randomBallots(ballotCount, CANDIDATE_COUNT, BALLOT_LENGTH)
+        before = timeIt(pyrankvoteWinner, ballots, candidateIds)
+        after = timeIt(voting.tallyVotes, ballots, candidateIds)
+        print(f"{ballotCount:>8} {before * 1000:>16.2f} {after * 1000:>16.2f} {before / after:>7.1f}x")
@@ -0,0 +1,212 @@
+# End-to-end benchmark of a book club meeting, run offline against the real handlers of main.py
+# Google Books is replaced by the local stub of bench/googleBooksStub.py (recorded responses, configurable latency) and
+# Telegram by the fake transport of bench/fakeTelegram.py. Each scenario has N users in one club, M of them submitting a book
+# and K of them voting, and runs in a fresh process with its own database, so that caches and peak memory are not shared.
+# Reports handler latency (p50/p99 per command), submission report and vote results delivery time, the time
+# voting.performVote takes on the final ballots, upstream calls and peak memory, and compares them with a saved baseline.
+# Requires the fonts and images configured in constants.py, run from the repository root:
+#   python bench/meetingBenchmark.py [--scenario USERS SUBMISSIONS VOTERS ...] [--latency SECONDS] [--save-baseline]
+import os
+import sys
+import io
+import json
+import time
+import random
+import resource
+import tempfile
+import argparse
+import contextlib
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+for envVar in ['TELEGRAM_TOKEN', 'GOOGLE_BOOKS_API_KEY']:
+    os.environ.setdefault(envVar, '1:benchmark')
+os.environ['MASTER_USER_ID'] = '1'
+os.environ['MASTER_CHAT_ID'] = '-1'
+
+import main
+import library
+import voting
+import submissionReport
+from rateLimit import TokenBucket, DailyQuota
+from fakeTelegram import FakeTelegram, update
+from googleBooksStub import GoogleBooksStub
+
+
+SCENARIOS = [(10, 5, 10), (50, 20, 50), (200, 50, 200)]
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'meetingBaseline.json')
+ADMIN_ID = 1
+CLUB_ID = -1
+SEARCHES = ['austen', 'dickens', 'tolstoy', 'classic novel', 'horror', 'victorian', 'adventure sea', 'dostoyevsky', 'title:"pride" author:"austen"']
+# A change is only flagged as a regression if it is both relatively and absolutely large enough to not be noise
+REGRESSION_TOLERANCE = 0.25
+REGRESSION_MIN_DIFFERENCE = { 'ms': 5.0, 'MB': 5.0, 'calls': 0 }
+PERFORM_VOTE_REPEATS = 5
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def userId(userIdx: int) -> int:
+    return 1000 + userIdx
+
+def searchFor(userIdx: int) -> str:
+    return SEARCHES[userIdx] if userIdx < len(SEARCHES) else f'novel {userIdx}'
+
+# Run one meeting from start to finish, meant to run in a process of its own
+def runScenario(users: int, submissions: int, voters: int, latency: float) -> dict:
+    workDir = tempfile.mkdtemp(prefix = 'meetingBenchmark')
+    os.chdir(workDir)
+    stub = GoogleBooksStub(latency = latency).start()
+    telegram = FakeTelegram(adminIds = [ADMIN_ID])
+    telegram.install()
+    library.client.baseUrl = stub.baseUrl
+    # A meeting's days of traffic are squeezed into seconds here, the Google Books rate limits are meant for the real thing
+    library.client.rateLimiter = TokenBucket(1e6, 1e6)
+    library.client.quota = DailyQuota(10 ** 9, 0, 0)
+    submissionReport.coverCacheDir = os.path.join(workDir, 'covers')
+    random.seed(0)
+    timings: dict[str, list[float]] = {}
+
+    def handle(text: str, fromUserId: int, chatId: int | None = None) -> float:
+        start = time.perf_counter()
+        main.bot.process_new_updates([update(text, fromUserId, chatId)])
+        elapsed = time.perf_counter() - start
+        timings.setdefault(text.split()[0].lstrip('/'), []).append(elapsed)
+        return start
+
+    # The bot's own messages for every update would drown out the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.setup()
+        main.bot.threaded = False
+
+        handle('/newMeeting', ADMIN_ID, CLUB_ID)
+        meetingId = main.bookClubDB.getActiveMeetingId(CLUB_ID)
+        for userIdx in range(users):
+            handle('/checkStatus', userId(userIdx), CLUB_ID)
+        for userIdx in range(submissions):
+            handle(f'/search {searchFor(userIdx)}', userId(userIdx))
+            session = main.userSearchResults.get(userId(userIdx))
+            results = session.listed() if session else ()
+            handle(f'/choose {userIdx % max(len(results), 1) + 1}', userId(userIdx))
+        # Members submit over days, so their report chapters are prepared by the time submissions close
+        deadline = time.perf_counter() + 60
+        while len(main.bookClubDB.getSubmissionAssets(CLUB_ID, meetingId)) < main.bookClubDB.getSubmissionCount(CLUB_ID) and time.perf_counter() < deadline:
+            time.sleep(0.05)
+
+        finishedAt = handle('/finishSubmissions', ADMIN_ID, CLUB_ID)
+        deliveredAt = telegram.waitFor('sendDocument', finishedAt, timeout = 300)
+        submissionCount = main.bookClubDB.getSubmissionCount(CLUB_ID)
+        for userIdx in range(voters):
+            choices = random.sample(range(1, submissionCount + 1), 3)
+            handle(f'/vote {choices[0]} {choices[1]} {choices[2]}', userId(userIdx))
+            if userIdx % 10 == 0:
+                handle('/checkStatus', ADMIN_ID)
+        ballots, _ = main.bookClubDB.getTally(CLUB_ID)
+        votingFinishedAt = handle('/finishVoting', ADMIN_ID, CLUB_ID)
+        # The vote tables and the winner are sent in the background, which is done once the executor has run everything
+        main.chapterExecutor.shutdown(wait = True)
+        resultsDeliveredAt = time.perf_counter()
+
+        performVoteTimings = []
+        submissionIds = { submissionId: None for submissionId in range(1, submissionCount + 1) }
+        for _ in range(PERFORM_VOTE_REPEATS):
+            start = time.perf_counter()
+            voting.performVote(ballots, submissionIds)
+            performVoteTimings.append(time.perf_counter() - start)
+
+        if submissionReport.renderExecutor:
+            submissionReport.renderExecutor.shutdown(wait = True)
+    stub.stop()
+
+    return {
+        'handlers': { command: { 'count': len(values), 'p50': percentile(values, 0.5) * 1000, 'p99': percentile(values, 0.99) * 1000 } for command, values in timings.items() },
+        'reportDeliveryMs': (deliveredAt - finishedAt) * 1000 if deliveredAt else None,
+        'resultsDeliveryMs': (resultsDeliveredAt - votingFinishedAt) * 1000,
+        'performVoteMs': statistics.median(performVoteTimings) * 1000,
+        'googleBooksCalls': dict(stub.calls),
+        'telegramCalls': dict(telegram.calls),
+        # ru_maxrss is in kilobytes on Linux, the renderer being the largest child process
+        'peakMemoryMB': {
+            'bot': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'reportRenderer': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        },
+    }
+
+# Flatten a scenario's results into (metric, unit) -> value
+def metrics(results: dict) -> dict[tuple[str, str], float]:
+    flat = {}
+    for command, stats in results['handlers'].items():
+        flat[(f'{command} p50', 'ms')] = stats['p50']
+        flat[(f'{command} p99', 'ms')] = stats['p99']
+    if results['reportDeliveryMs'] is not None:
+        flat[('report delivery', 'ms')] = results['reportDeliveryMs']
+    if results.get('resultsDeliveryMs') is not None:
+        flat[('results delivery', 'ms')] = results['resultsDeliveryMs']
+    flat[('performVote', 'ms')] = results['performVoteMs']
+    for kind, count in results['googleBooksCalls'].items():
+        flat[(f'Google Books {kind}', 'calls')] = count
+    for method, count in results['telegramCalls'].items():
+        flat[(f'Telegram {method}', 'calls')] = count
+    for process, megabytes in results['peakMemoryMB'].items():
+        flat[(f'peak memory {process}', 'MB')] = megabytes
+    return flat
+
+def isRegression(unit: str, baseline: float, current: float) -> bool:
+    return current > baseline * (1 + REGRESSION_TOLERANCE) and current - baseline > REGRESSION_MIN_DIFFERENCE[unit]
+
+# Print a scenario's results next to its baseline, returning the number of regressions
+def report(name: str, results: dict, baseline: dict | None) -> int:
+    current = metrics(results)
+    previous = metrics(baseline) if baseline else {}
+    regressions = 0
+    print(f"\n{name}")
+    print(f"  {'metric':<34} {'baseline':>10} {'current':>10} {'change':>8}")
+    for (metric, unit), value in current.items():
+        baselineValue = previous.get((metric, unit))
+        if baselineValue is None:
+            print(f"  {metric + ' (' + unit + ')':<34} {'-':>10} {value:>10.1f}")
+            continue
+        change = f'{(value - baselineValue) / baselineValue * 100:+.0f}%' if baselineValue else ''
+        flag = ''
+        if isRegression(unit, baselineValue, value):
+            regressions += 1
+            flag = '  <- regression'
+        print(f"  {metric + ' (' + unit + ')':<34} {baselineValue:>10.1f} {value:>10.1f} {change:>8}{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', nargs = 3, type = int, action = 'append', metavar = ('USERS', 'SUBMISSIONS', 'VOTERS'))
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'seconds the Google Books stub takes to answer')
+    parser.add_argument('--baseline', default = BASELINE_PATH)
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'save the results as the new baseline')
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baselineFile:
+            baselines = json.load(baselineFile)
+        if baselines.get('latency') != args.latency:
+            print(f"The baseline was measured with a latency of {baselines.get('latency')}s, not {args.latency}s")
+
+    allResults = { 'latency': args.latency, 'scenarios': {} }
+    regressions = 0
+    for users, submissions, voters in args.scenario or SCENARIOS:
+        name = f'{users} users, {submissions} submissions, {voters} voters'
+        with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as executor:
+            results = executor.submit(runScenario, users, submissions, voters, args.latency).result()
+        allResults['scenarios'][name] = results
+        regressions += report(name, results, baselines.get('scenarios', {}).get(name))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baselineFile:
+            json.dump(allResults, baselineFile, indent = 1)
+        print(f"\nSaved the results as the baseline in {args.baseline}")
+    elif regressions:
+        print(f"\n{regressions} regressions compared to the baseline")
+        sys.exit(1)
@@ -0,0 +1,102 @@
+# Load test of the bot's handlers as the number of book clubs grows, showing that handler latency stays flat
+# Runs the real handlers of main.py against a fresh database in a temporary directory, with Telegram replaced by a fake
+# transport (nothing leaves the process) and Google Books by canned responses
+# Run from the repository root: python bench/multiClubLoad.py
+import os
+import sys
+import time
+import random
+import tempfile
+import contextlib
+import io
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+for envVar in ['TELEGRAM_TOKEN', 'GOOGLE_BOOKS_API_KEY']:
+    os.environ.setdefault(envVar, '1:benchmark')
+os.environ['MASTER_USER_ID'] = '1'
+os.environ['MASTER_CHAT_ID'] = '-1'
+
+import telebot
+import main
+import library
+from fakeTelegram import FakeTelegram, update
+
+
+CLUB_COUNTS = [10, 100, 1000, 5000]
+MEMBERS_PER_CLUB = 3
+SAMPLES = 300
+
+def volume(volumeId: str) -> dict:
+    return { 'id': volumeId, 'volumeInfo': { 'title': f'Book {volumeId}', 'authors': ['Author'], 'infoLink': f'https://books.google.pl/books?id={volumeId}' } }
+
+# Google Books stand-in
+def fakeGoogleBooks(resource: str, params: dict | None = None) -> dict:
+    if resource.startswith('volumes/'):
+        return volume(resource.split('/', 1)[1])
+    return { 'totalItems': 5, 'items': [volume(f'v{i}') for i in range(5)] }
+
+def clubChatId(clubIdx: int) -> int:
+    return -1000 - clubIdx
+
+def memberId(clubIdx: int, memberIdx: int) -> int:
+    return 1000 + clubIdx * 10 + memberIdx
+
+# Clubs are added straight through the database, only the measured commands go through the handlers
+# Even clubs are collecting submissions, odd clubs are collecting votes
+def addClubs(start: int, end: int):
+    db = main.bookClubDB
+    for clubIdx in range(start, end):
+        chatId = clubChatId(clubIdx)
+        db.saveClub(chatId, f'Club {chatId}')
+        db.newMeeting(chatId)
+        for memberIdx in range(MEMBERS_PER_CLUB):
+            db.saveMember(chatId, memberId(clubIdx, memberIdx))
+            db.submitBook(chatId, memberId(clubIdx, memberIdx), f'v{memberIdx}')
+        if clubIdx % 2:
+            db.startVoting(chatId)
+
+def handle(botUpdate: telebot.types.Update) -> float:
+    start = time.perf_counter()
+    main.bot.process_new_updates([botUpdate])
+    return time.perf_counter() - start
+
+# Latency of each command for members of randomly picked clubs
+def measure(clubCount: int) -> dict[str, list[float]]:
+    timings = { 'checkStatus': [], 'search': [], 'choose': [], 'vote': [] }
+    for _ in range(SAMPLES):
+        clubIdx = random.randrange(clubCount)
+        userId = memberId(clubIdx, random.randrange(MEMBERS_PER_CLUB))
+        timings['checkStatus'].append(handle(update('/checkStatus', userId, clubChatId(clubIdx))))
+        if clubIdx % 2 == 0:
+            timings['search'].append(handle(update('/search book', userId)))
+            timings['choose'].append(handle(update(f'/choose {random.randint(1, 5)}', userId)))
+        else:
+            timings['vote'].append(handle(update('/vote 1 2 3', userId)))
+    return timings
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+if __name__ == '__main__':
+    FakeTelegram().install()
+    library.client.get = fakeGoogleBooks
+    os.chdir(tempfile.mkdtemp(prefix = 'multiClubLoad'))
+    random.seed(0)
+
+    clubCount = 0
+    print(f"{'clubs':>6} {'command':>12} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for targetCount in CLUB_COUNTS:
+        # The bot's own messages for every update would drown out the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            if clubCount == 0:
+                main.setup()
+                main.bot.threaded = False
+            addClubs(clubCount, targetCount)
+            clubCount = targetCount
+            timings = measure(clubCount)
+        for command, values in timings.items():
+            print(f"{clubCount:>6} {command:>12} {statistics.median(values) * 1000:>9.2f} {percentile(values, 0.99) * 1000:>9.2f}")
@@ -0,0 +1,71 @@
+# Benchmark of submission report rendering time for 5, 20 and 50 submissions, and of the share of it spent loading the fonts
+# (the add_font calls made by every report). Loading is timed inside submissionReport.generate itself, so this measures the
+# code path the bot runs
+# Requires the fonts and images configured in constants.py, run from the repository root: python bench/reportRendering.py
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import submissionReport
+
+
+SUBMISSION_COUNTS = [5, 20, 50]
+REPEATS = 5
+
+description = "<p>" + " ".join(["A story of <b>books</b>, <i>friends</i> and the occasional heated vote."] * 12) + "</p>"
+
+def buildChapters(count: int):
+    return {
+        submissionId: {
+            'volume': {
+                'id': f'volume{submissionId}',
+                'title': f'Benchmark Book {submissionId}',
+                'subtitle': 'A Subtitle' if submissionId % 2 else None,
+                'authors': ['First Author', 'Second Author'],
+                'categories': ['Fiction', 'Benchmarks'],
+                'description': description,
+                'pageCount': 300 + submissionId,
+                'googleBooksLink': f'https://books.google.pl/books?id=volume{submissionId}',
+                'imageLink': None,
+            },
+            'coverPath': None,
+            'descriptionHtml': description,
+        } for submissionId in range(1, count + 1)
+    }
+
+# Time spent in add_font by the report being rendered
+fontLoadingTime = 0.0
+addFont = submissionReport.SubmissionReport.add_font
+def timedAddFont(self, *args, **kwargs):
+    global fontLoadingTime
+    start = time.perf_counter()
+    try:
+        return addFont(self, *args, **kwargs)
+    finally:
+        fontLoadingTime += time.perf_counter() - start
+submissionReport.SubmissionReport.add_font = timedAddFont
+
+# Median render time and median time spent loading fonts, in seconds
+def measure(count: int) -> tuple[float, float]:
+    global fontLoadingTime
+    chapters = buildChapters(count)
+    renderTimes, fontTimes = [], []
+    for _ in range(REPEATS):
+        fontLoadingTime = 0.0
+        start = time.perf_counter()
+        submissionReport.generate(1, chapters)
+        renderTimes.append(time.perf_counter() - start)
+        fontTimes.append(fontLoadingTime)
+    return statistics.median(renderTimes), statistics.median(fontTimes)
+
+
+if __name__ == '__main__':
+    # Warm up imports so that the first measurement is not skewed
+    submissionReport.generate(1, buildChapters(1))
+    print(f"{'submissions':>12} {'render (ms)':>12} {'fonts (ms)':>12} {'share':>8}")
+    for count in SUBMISSION_COUNTS:
+        render, fonts = measure(count)
+        print(f"{count:>12} {render * 1000:>12.1f} {fonts * 1000:>12.1f} {fonts / render:>8.1%}")
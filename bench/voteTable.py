@@ -0,0 +1,60 @@
+# Benchmark of vote table rendering: a single PrettyTable looking up each row's user with list(userVotes.keys())[uIdx] (before)
+# versus the linear renderer splitting text tables into messages, or drawing images for wide tables (after)
+# Run from the repository root: python bench/voteTable.py
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import prettytable as pt
+
+import voting
+from constants import MAX_MESSAGE_LENGTH
+
+
+VOTER_COUNTS = [10, 100, 500]
+SUBMISSION_COUNTS = [10, 50]
+REPEATS = 3
+
+# The vote table as it was drawn before, a single message
+def drawVoteTableBefore(userVotes: dict[int, list[int]], submissionIds: list[int], userNames: dict[int, str]) -> str:
+    table: list[list[str]] = []
+    for uIdx, votes in enumerate(userVotes.values()):
+        table.append([])
+        for submissionId in submissionIds:
+            table[uIdx].append(str(votes.index(submissionId) + 1) if submissionId in votes else '')
+    voteTable = pt.PrettyTable([''] + [str(submissionId) for submissionId in submissionIds])
+    for uIdx, userSubmissionVotes in enumerate(table):
+        userId = list(userVotes.keys())[uIdx]
+        voteTable.add_row([userNames[userId]] + userSubmissionVotes)
+    return f'<pre>{voteTable}</pre>'
+
+def drawVoteTableAfter(userVotes: dict[int, list[int]], submissionIds: list[int], userNames: dict[int, str]) -> list[str] | list[bytes]:
+    table = voting.voteTable(userVotes, submissionIds, userNames)
+    return voting.drawTableImages(table) if voting.isWideTable(table) else voting.drawTable(table)
+
+def timeIt(function, *args) -> tuple[float, object]:
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    print(f"{'voters':>6} {'books':>5} {'before (ms)':>12} {'fits':>5} {'after (ms)':>11} {'sent as':>16}")
+    for voterCount in VOTER_COUNTS:
+        for submissionCount in SUBMISSION_COUNTS:
+            submissionIds = list(range(1, submissionCount + 1))
+            userVotes = { 1000 + userIdx: random.sample(submissionIds, 3) for userIdx in range(voterCount) }
+            userNames = { userId: f'Reader {userId}' for userId in userVotes.keys() }
+            before, message = timeIt(drawVoteTableBefore, userVotes, submissionIds, userNames)
+            after, parts = timeIt(drawVoteTableAfter, userVotes, submissionIds, userNames)
+            sentAs = f"{len(parts)} {'images' if isinstance(parts[0], bytes) else 'messages'}"
+            fits = 'yes' if len(message) <= MAX_MESSAGE_LENGTH else 'no'
+            print(f"{voterCount:>6} {submissionCount:>5} {before * 1000:>12.1f} {fits:>5} {after * 1000:>11.1f} {sentAs:>16}")
@@ -0,0 +1,45 @@
+# POST recorded Telegram updates to a bot running in webhook mode (python main.py --webhook) and report how fast they are accepted
+# Usage: python bench/webhookReplay.py [updates.json] [repeats], with WEBHOOK_SECRET_TOKEN (and WEBHOOK_HOST/WEBHOOK_PORT) set
+# as for the bot. The file holds a single update or a list of them, bench/webhookUpdates.json is used by default.
+import os
+import sys
+import json
+import time
+import statistics
+import urllib.request
+import urllib.error
+
+
+def post(url: str, secretToken: str, update: dict) -> int:
+    request = urllib.request.Request(url, data = json.dumps(update).encode(), method = 'POST', headers = {
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secretToken,
+    })
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+if __name__ == '__main__':
+    updatesPath = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'webhookUpdates.json')
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    url = f"http://{os.getenv('WEBHOOK_HOST', '127.0.0.1')}:{os.getenv('WEBHOOK_PORT', '8080')}/"
+    secretToken = os.environ['WEBHOOK_SECRET_TOKEN']
+    with open(updatesPath) as updatesFile:
+        updates = json.load(updatesFile)
+    if isinstance(updates, dict):
+        updates = [updates]
+
+    statuses: dict[int, int] = {}
+    timings = []
+    for _ in range(repeats):
+        for update in updates:
+            start = time.perf_counter()
+            status = post(url, secretToken, update)
+            timings.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    print(f"POSTed {len(timings)} updates to {url}, responses: {statuses}")
+    print(f"latency p50 {statistics.median(timings) * 1000:.2f} ms, max {max(timings) * 1000:.2f} ms")
@@ -0,0 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import constants
+import library
+import db
+from userProfiles import UserProfiles
+from searchResults import SearchResultStore
+from clubs import Clubs
+
+
+# Load the secrets, then create the database and the state shared by the handlers, for both bots (main.py and asyncMain.py)
+# Returns (bookClubDB, asyncDB, clubs, userProfiles, userSearchResults, chapterExecutor), asyncDB being None unless useAsync
+# is set, in which case the stores' async methods reach the database on its executor
+def setup(bot, useAsync: bool = False):
+    constants.loadSecrets()
+    bot.token = constants.secrets['TELEGRAM_TOKEN']
+    library.client.quota.limit = constants.GOOGLE_BOOKS_DAILY_QUOTA
+    bookClubDB = db.BookClubDB()
+    asyncDB = db.AsyncBookClubDB(bookClubDB) if useAsync else None
+    storeExecutor = asyncDB.executor if asyncDB else None
+    library.volumeCache.attachStore(bookClubDB, storeExecutor)
+    library.client.quota.attachStore(bookClubDB)
+    library.client.quota.savePeriodically(constants.GOOGLE_BOOKS_QUOTA_SAVE_INTERVAL)
+    library.catalog.attachStore(bookClubDB, storeExecutor)
+    clubs = Clubs(bookClubDB, storeExecutor = storeExecutor)
+    userProfiles = UserProfiles(bookClubDB, storeExecutor = storeExecutor)
+    userSearchResults = SearchResultStore(bookClubDB, storeExecutor = storeExecutor)
+    # Prepares the report chapters of new submissions in the background, and delivers rendered submission reports
+    chapterExecutor = ThreadPoolExecutor(max_workers = constants.CHAPTER_PREPARATION_WORKERS, thread_name_prefix = 'chapter-prep')
+    return bookClubDB, asyncDB, clubs, userProfiles, userSearchResults, chapterExecutor
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+# Thread-safe LRU cache with a bounded size and an optional time-to-live (in seconds) for its entries
+class LRUCache:
+    def __init__(self, maxSize: int, ttl: float | None = None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def isFresh(self, storedAt: float) -> bool:
+        return self.ttl is None or (time.time() - storedAt) < self.ttl
+
+    # Return the cached value (or default if it is missing or expired), marking it as recently used
+    # Expired values are still returned if allowStale is set, e.g. as a fallback when a refresh fails
+    def get(self, key, default = None, allowStale: bool = False):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not (allowStale or self.isFresh(entry[1])):
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Store a value, evicting the least recently used entries if the cache is full
+    # storedAt can be provided for values which were already cached elsewhere (e.g. in the database)
+    def set(self, key, value, storedAt: float | None = None):
+        with self.lock:
+            self.entries[key] = (value, storedAt if storedAt is not None else time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last = False)
+
+    def pop(self, key, default = None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[0] if entry else default
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Coalesces concurrent calls for the same key, so that only the first caller does the work and the others share its result
+class InFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[object, Future] = {}
+
+    def do(self, key, function):
+        with self.lock:
+            future = self.calls.get(key)
+            isLeader = future is None
+            if isLeader:
+                future = self.calls[key] = Future()
+        if not isLeader:
+            return future.result()
+
+        try:
+            result = function()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+# Asyncio counterpart of InFlight, for coroutines running on the same event loop
+class AsyncInFlight:
+    def __init__(self):
+        self.calls: dict[object, asyncio.Future] = {}
+
+    async def do(self, key, function):
+        future = self.calls.get(key)
+        if future is not None:
+            # Shielded so that a cancelled follower does not cancel the leader's call
+            return await asyncio.shield(future)
+
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Followers re-raise the exception, but it should not be reported as never retrieved if there were none
+            future.exception()
+            raise
+        finally:
+            del self.calls[key]
@@ -0,0 +1,117 @@
+import asyncio
+from typing import Callable, Awaitable
+
+import telebot
+
+import constants
+import metrics
+from cache import LRUCache
+from constants import CLUB_MEMBER_CACHE_SIZE, CLUB_ADMIN_CACHE_SIZE, CLUB_ADMIN_TTL
+
+
+# Book clubs served by the bot, one per group chat
+# Commands sent in a group apply to that group's club. Commands sent in a private chat apply to the user's current club,
+# which is the group they were last seen in (or picked with /club), falling back to the master chat for users never seen in a group
+# Club admins are the group's Telegram administrators (and the master user, in every club)
+# The store is expected to provide getCurrentClub(userId), getClubs(userId), saveClub(chatId, title) and saveMember(chatId, userId)
+# The async methods reach the store on storeExecutor (None means the event loop's default executor)
+class Clubs:
+    def __init__(self, store, storeExecutor = None):
+        self.store = store
+        self.storeExecutor = storeExecutor
+        # userId -> chatId of their current club
+        self.currentClubs = LRUCache(CLUB_MEMBER_CACHE_SIZE)
+        # chatId -> title, for the clubs whose title is known to be saved
+        self.titles = LRUCache(CLUB_MEMBER_CACHE_SIZE)
+        # chatId -> frozenset of admin user IDs
+        self.admins = LRUCache(CLUB_ADMIN_CACHE_SIZE, CLUB_ADMIN_TTL)
+        metrics.registry.registerCache('currentClubs', self.currentClubs)
+        metrics.registry.registerCache('clubTitles', self.titles)
+        metrics.registry.registerCache('clubAdmins', self.admins)
+
+    # Whether observe() would have anything to save for this message
+    def needsSaving(self, message: telebot.types.Message) -> bool:
+        if message.chat.type not in ['group', 'supergroup'] or not message.from_user:
+            return False
+        return self.titles.get(message.chat.id) != message.chat.title or self.currentClubs.get(message.from_user.id) != message.chat.id
+
+    # Record the club of a group message and make it the sender's current club, only writing to the database on changes
+    def observe(self, message: telebot.types.Message):
+        if not self.needsSaving(message):
+            return
+        chatId = message.chat.id
+        if self.titles.get(chatId) != message.chat.title:
+            self.store.saveClub(chatId, message.chat.title)
+            self.titles.set(chatId, message.chat.title)
+        if self.currentClubs.get(message.from_user.id) != chatId:
+            self.store.saveMember(chatId, message.from_user.id)
+            self.currentClubs.set(message.from_user.id, chatId)
+
+    # Get the chat ID of the club a message applies to
+    def getClubId(self, message: telebot.types.Message) -> int:
+        if message.chat.type != 'private':
+            return message.chat.id
+        userId = message.from_user.id
+        chatId = self.currentClubs.get(userId)
+        if chatId is None:
+            chatId = self.store.getCurrentClub(userId)
+            if chatId is None:
+                chatId = int(constants.secrets['MASTER_CHAT_ID'])
+            self.currentClubs.set(userId, chatId)
+        return chatId
+
+    # List the (chatId, title) of the clubs a user was seen in
+    def getClubs(self, userId: int) -> list[tuple[int, str | None]]:
+        return self.store.getClubs(userId)
+
+    # Make one of the clubs the user was seen in their current club
+    def selectClub(self, userId: int, chatId: int):
+        self.store.saveMember(chatId, userId)
+        self.currentClubs.set(userId, chatId)
+
+    # Whether the user is an admin of the club, fetching the club's admins with fetchAdmins(chatId) once in a while
+    # The last known admins are used if fetching them fails
+    def isAdmin(self, chatId: int, userId: int, fetchAdmins: Callable[[int], list[int]]) -> bool:
+        if userId == int(constants.secrets['MASTER_USER_ID']):
+            return True
+        admins = self.admins.get(chatId)
+        if admins is None:
+            try:
+                admins = frozenset(fetchAdmins(chatId))
+                self.admins.set(chatId, admins)
+            except Exception as e:
+                print(f"Failed to fetch the admins of chat {chatId}: {e}")
+                admins = self.admins.get(chatId, frozenset(), allowStale = True)
+        return userId in admins
+
+    # Asyncio counterparts of the methods above
+    async def observeAsync(self, message: telebot.types.Message):
+        if self.needsSaving(message):
+            await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.observe, message)
+
+    async def getClubIdAsync(self, message: telebot.types.Message) -> int:
+        if message.chat.type != 'private':
+            return message.chat.id
+        chatId = self.currentClubs.get(message.from_user.id)
+        if chatId is not None:
+            return chatId
+        return await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.getClubId, message)
+
+    async def getClubsAsync(self, userId: int) -> list[tuple[int, str | None]]:
+        return await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.getClubs, userId)
+
+    async def selectClubAsync(self, userId: int, chatId: int):
+        await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.selectClub, userId, chatId)
+
+    async def isAdminAsync(self, chatId: int, userId: int, fetchAdmins: Callable[[int], Awaitable[list[int]]]) -> bool:
+        if userId == int(constants.secrets['MASTER_USER_ID']):
+            return True
+        admins = self.admins.get(chatId)
+        if admins is None:
+            try:
+                admins = frozenset(await fetchAdmins(chatId))
+                self.admins.set(chatId, admins)
+            except Exception as e:
+                print(f"Failed to fetch the admins of chat {chatId}: {e}")
+                admins = self.admins.get(chatId, frozenset(), allowStale = True)
+        return userId in admins
@@ -0,0 +1,301 @@
+import telebot
+import re
+import time
+
+import customTypes as types
+import constants
+import library
+import metrics
+from searchResults import SearchResult, SearchSession
+from rateLimit import RateLimited
+
+
+# Command logic shared by the synchronous bot (main.py) and the asyncio bot (asyncMain.py)
+# Everything here is free of Telegram API calls, so both bots keep the same gating rules and replies
+
+
+# Helper function for gating access to commands, returns the reason for rejecting the message or None if it is allowed
+# chatId is the club the message applies to and isAdmin whether the sender is one of its admins (only needed for onlyAdmin commands)
+# Only the in-memory meeting state of BookClubDB is consulted, so this never waits on the database once the club is loaded
+def commandRejection(bookClubDB, message: telebot.types.Message, requirements: types.CommandRequirements, chatId: int, isAdmin: bool = False) -> str | None:
+    user = message.from_user
+    if not user:
+        return "You are not a real user. Go away."
+    if requirements.get('chatTypes') and (not message.chat.type in requirements.get('chatTypes')):
+        return f"This command is only allowed for messages in one of these contexts: [{requirements.get('chatTypes')}]"
+    if requirements.get('activeMeeting'):
+        try:
+            bookClubDB.getActiveMeetingId(chatId)
+        except:
+            return f'There is no active meeting. An admin needs to initiate a new meeting to begin the process.'
+    if requirements.get('onlyAdmin') and not isAdmin:
+        return f'Only an admin can tell me to do that ( ͡° ͜ʖ ͡°)'
+    if requirements.get('onlyMasterUser') and user.id != int(constants.secrets['MASTER_USER_ID']):
+        return f'Only the master user can tell me to do that ( ͡° ͜ʖ ͡°)'
+    if requirements.get('stage'):
+        activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
+        (stage, _) = bookClubDB.getMeeting(chatId, activeMeetingId)
+        if stage != requirements.get('stage'):
+            return f"This command requires the active stage to be {requirements.get('stage')}, but it is currently {stage}."
+    return None
+
+
+# Get telegram formatted user mention
+def userMention(userId: int, firstName: str):
+    return f"[{firstName}](tg://user?id={str(userId)})"
+
+
+# Name of the club of a group chat, as used in submission reports
+def clubName(chat: telebot.types.Chat) -> str:
+    return chat.title or constants.DEFAULT_CLUB_NAME
+
+
+# Message with instructions on how the bot operates
+def instructionsMessage() -> str:
+    instructionsMsg = "I am the *Book Club Bot* developed by *stygio* ([see here for more info](https://github.com/stygio/book-club-bot)).\n\n"
+
+    instructionsMsg += "Every group chat I am in runs its own book club. Once an admin of the group creates a new meeting, there are two stages: submitting books and voting on books.\n\n"
+
+    instructionsMsg += "During the *submit* stage, users submit 1 book for the active meeting.\n"
+    instructionsMsg += "Find your book using the `/search <search query>` command. Once it appears in the results, choose it using the `/choose <number>` command.\n"
+    instructionsMsg += "You can repeat this process and choose a different book if this phase is still ongoing.\n"
+    instructionsMsg += "At the end of this phase, a submission report will be generated in PDF format with an overview of the submitted books. No more books can be chosen while it is being generated.\n\n"
+
+    instructionsMsg += "During the *vote* stage, users vote on 3 books submitted for the active meeting in order of preferrence.\n"
+    instructionsMsg += "Vote on books in order of preferrence using the `/vote <number> <number> <number>` command.\n"
+    instructionsMsg += "A winner is chosen using [Ranked-choice voting](https://ballotpedia.org/Ranked-choice_voting).\n"
+    instructionsMsg += "You can repeat this process and change your vote if this phase is still ongoing.\n"
+    instructionsMsg += "At the end of this phase, tables of the votes and of every runoff round will be generated and a winner will be chosen for the active meeting.\n\n"
+
+    instructionsMsg += "Commands sent to me in a private chat apply to the club of the group where you last used a command. If you are in several clubs, use `/club` to switch between them.\n\n"
+
+    instructionsMsg += "The admins have some additional commands available to them. For a full list of commands with explanations, type `/commands` in a private chat with me."
+
+    return instructionsMsg
+
+
+# Message with possible commands
+def commandsMessage() -> str:
+    commandsMsg = "Here is a list of valid commands and their requirements.\n\n"
+    commandsMsg += "Most commands have a list of tags (a: group admin only, u: master user only, m: active meeting required, p: private chat, g: group chat, s: submissions stage, v: voting stage)\n\n"
+    commandsMsg += "*instructions*: Prints a message with an overview of how I operate.\n\n"
+    commandsMsg += "*commands* (p): Prints this message with possible commands.\n\n"
+    commandsMsg += "*club* (p): Lists the book clubs you are in. Commands in this chat apply to your current club, choose a different one using its number in the list. Example:\n`/club 2`\n\n"
+    commandsMsg += "*checkStatus*: Prints the current status of the meeting. During the vote stage, admins asking in a private chat are also told which book would win if voting ended now.\n\n"
+    commandsMsg += "*newMeeting* (a/g): Initiates a new meeting.\n\n"
+    commandsMsg += f"*search* (m/p/s): Search the Google Books collection for a book. I will return up to 10 results. If you don't find your book, please try again with a different query (after a few searches in a row, you get another one every {constants.USER_SEARCH_INTERVAL} seconds). You can enter search terms directly or use the (title, author, isbn) tags to be more specific. Examples:\n`/search tolkien lord rings`\n`/search title:\"city of thieves\" author:\"david benioff\"`\n`/search isbn:9788373899292`\n\n"
+    commandsMsg += "*choose* (m/p/s): Choose one of the options I returned based on your search using its number in the list of results. Example:\n`/choose 4`\n\n"
+    commandsMsg += "*finishSubmissions* (a/m/g/s): Complete the submit stage and begin the vote stage.\n\n"
+    commandsMsg += "*vote* (m/p/v): Vote on 3 books in order of preferrence based on their numbers in the submission report. Example:\n`/vote 5 10 2`\n\n"
+    commandsMsg += "*finishVoting* (a/m/g/v): Complete the vote stage.\n\n"
+    commandsMsg += "*stats* (u/p): Prints how long commands, Google Books requests, database calls and report rendering take, and how often the caches are hit."
+
+    return commandsMsg
+
+
+# First line of a page of search results, which tells which results are listed if there is more than one page
+def searchPageHeader(numFound: int, start: int, end: int, paged: bool) -> str:
+    if not paged:
+        return f'I found {numFound} results for your search:\n'
+    return f'I found {numFound} results for your search, these are {start + 1} - {end}:\n'
+
+# Results are numbered across pages, so that /choose works with any of the results listed so far
+def searchResultLine(number: int, result: SearchResult) -> str:
+    return f'{number}. {library.formatBookVolume(result)}'
+
+
+# List the next page of a search: as many of the results after those listed so far as fit in a message, up to MAX_SEARCH_RESULTS
+# Each line is measured once as it is added, the header being measured for a full page (its longest). Returns None if
+# there are no results left to list
+def addSearchPage(session: SearchSession) -> SearchSession | None:
+    start = session.listedCount()
+    if start >= len(session.results):
+        return None
+    length = len(searchPageHeader(session.numFound, start, start + constants.MAX_SEARCH_RESULTS, True))
+    end = start
+    for result in session.results[start:start + constants.MAX_SEARCH_RESULTS]:
+        length += len(searchResultLine(end + 1, result)) + 1
+        # A page lists at least one result, however long
+        if length > constants.MAX_MESSAGE_LENGTH and end > start:
+            break
+        end += 1
+    return session.withPage(end)
+
+
+# Reply listing a listed page of a search, with buttons to the previous and next pages (None if there is only one page)
+def searchPageReply(session: SearchSession, pageIdx: int) -> tuple[str, telebot.types.InlineKeyboardMarkup | None]:
+    start, end = session.pageBounds(pageIdx)
+    buttons = []
+    if pageIdx > 0:
+        buttons.append(telebot.types.InlineKeyboardButton('\u2039 Previous', callback_data = f'search:{session.searchId}:{pageIdx - 1}'))
+    if session.hasMore(pageIdx):
+        buttons.append(telebot.types.InlineKeyboardButton('Next \u203a', callback_data = f'search:{session.searchId}:{pageIdx + 1}'))
+    replyString = searchPageHeader(session.numFound, start, end, bool(buttons))
+    replyString += '\n'.join([searchResultLine(number, result) for number, result in enumerate(session.results[start:end], start + 1)])
+    return replyString, telebot.types.InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+# Parse the data of a search page button, returning (searchId, pageIdx) or None if it is not one
+def parseSearchPage(data: str | None) -> tuple[int, int] | None:
+    searchPageMatch = re.fullmatch(constants.regex['SEARCH_PAGE'], data or '')
+    if not searchPageMatch:
+        return None
+    return int(searchPageMatch.group(1)), int(searchPageMatch.group(2))
+
+
+# The page to show for a search page button (None to leave the message as it is) and the alert to answer it with, if any
+# The next page is only missing once listing it was attempted, when there were no results left to list: the page before it
+# is shown again, without its next button if the search has run out of results
+def searchPageToShow(session: SearchSession | None, searchId: int, pageIdx: int) -> tuple[int | None, str | None]:
+    if not session or session.searchId != searchId or pageIdx > len(session.pageEnds):
+        return None, 'These search results have expired, please search again.'
+    if pageIdx < len(session.pageEnds):
+        return pageIdx, None
+    if session.nextIndex is None:
+        return pageIdx - 1, 'There are no more results for this search.'
+    return None, 'I could not get more results from Google Books, please try again in a moment.'
+
+
+# Parse a /choose command against the user's search results, returning the index of the choice or an error reply
+def parseChoice(text: str, searchResults: tuple[SearchResult, ...] | None) -> tuple[int | None, str | None]:
+    chooseMatch = re.match(constants.regex['CHOOSE'], text)
+    if not chooseMatch:
+        return None, 'Your message does not conform to the expected format of `/choose <number>`.'
+    if not searchResults:
+        return None, 'You have no search results to choose from. Have you used the `/search <search expression>` command yet?'
+    # User input is indexed from 1, array is indexed from 0
+    choiceStr = chooseMatch.group(1)
+    choiceIdx = int(choiceStr) - 1
+    if not (choiceIdx >= 0 and choiceIdx < len(searchResults)):
+        return None, f'Your choice ({choiceStr}) is not valid, expected something in the range of 1 - {len(searchResults)}.'
+    return choiceIdx, None
+
+
+# Reply listing the clubs of a user, with a mark next to their current club
+def clubsReply(clubs: list[tuple[int, str | None]], currentChatId: int) -> str:
+    if not clubs:
+        return "I have not seen you in any book club yet. Use a command (e.g. `/checkStatus`) in your club's group chat first."
+    clubList = '\n'.join([f"{idx}. {title or chatId}{' (current)' if chatId == currentChatId else ''}" for idx, (chatId, title) in enumerate(clubs, 1)])
+    return f"These are the book clubs I have seen you in:\n{clubList}\nUse `/club <number>` to switch to a different one."
+
+
+# Parse a /club command against the user's clubs, returning the chat ID of the chosen club or an error reply
+def parseClubChoice(text: str, clubs: list[tuple[int, str | None]]) -> tuple[int | None, str | None]:
+    clubMatch = re.match(constants.regex['CLUB'], text)
+    if not clubMatch:
+        return None, 'Your message does not conform to the expected format of `/club <number>`.'
+    choice = int(clubMatch.group(1))
+    if not (choice > 0 and choice <= len(clubs)):
+        return None, f'Your choice ({choice}) is not valid, expected something in the range of 1 - {len(clubs)}.'
+    return clubs[choice - 1][0], None
+
+
+# Parse a /vote command, returning the three chosen submission IDs or an error reply
+def parseVotes(text: str, submissionCount: int) -> tuple[list[int] | None, str | None]:
+    voteMatch = re.match(constants.regex['VOTE'], text)
+    if not voteMatch:
+        return None, 'Your message does not conform to the expected format of `/vote <first choice number> <second choice number> <third choice number>`.'
+    choices = [int(choice) for choice in voteMatch.groups()]
+    for choice in choices:
+        if not (choice > 0 and choice <= submissionCount):
+            return None, f'Your choice ({choice}) is not valid, expected something in the range of 1 - {submissionCount}.'
+    if choices[0] == choices[1] or choices[1] == choices[2] or choices[0] == choices[2]:
+        return None, f'You need to choose three different books'
+    return choices, None
+
+
+# Prepare the submission report chapter of a newly submitted book, so that finishing the submit stage only assembles the report
+# Meant to run in the background, in a worker thread, which is also where the report module is first imported
+def prepareSubmissionChapter(bookClubDB, chatId: int, meetingId: int, userId: int, volumeId: str):
+    try:
+        import submissionReport
+        bookVolume = library.getBookVolume(volumeId)
+        if not bookVolume:
+            return
+        bookClubDB.saveSubmissionAssets(chatId, meetingId, userId, volumeId, submissionReport.prepareChapter(bookVolume))
+    except Exception as e:
+        print(f"Failed to prepare the report chapter of {volumeId} for user {userId}: {e}")
+
+
+# Build the chapters of the submission report from those prepared ahead of time and the volumes of the rest
+def reportChapters(submissionsData, preparedChapters: dict[int, types.ChapterAssets], bookVolumes: dict[str, types.BookVolume]) -> dict[int, types.ChapterAssets]:
+    chapters = dict(preparedChapters)
+    for (_, submissionId, volumeId) in submissionsData:
+        if submissionId not in chapters:
+            chapters[submissionId] = { 'volume': bookVolumes[volumeId], 'coverPath': None, 'descriptionHtml': None }
+    return dict(sorted(chapters.items()))
+
+
+# Projection of a vote in progress for admins: the submission winning the runoff so far and the first choices on the ballots
+def projectionReply(voteResult: types.VoteResult, firstPreferences: dict[int, int], leaderVolume: types.BookVolume | None) -> str:
+    leader = voteResult['winner']
+    leaderVotes = voteResult['rounds'][-1]['votes'][leader]
+    leaderName = f' ({library.formatBookVolume(leaderVolume)})' if leaderVolume else ''
+    reply = f'If voting ended now, submission {leader}{leaderName} would win with {leaderVotes} votes in round {len(voteResult["rounds"])} of the runoff.\n'
+    reply += 'First choices: ' + ', '.join(f'{submissionId}: {count}' for submissionId, count in sorted(firstPreferences.items())) + '\n'
+    reply += 'Only admins get to see this in a private chat, so that it does not sway anyone\'s vote.'
+    return reply
+
+
+# Reply with an overview of the bot's metrics for admins, as a monospace table
+def statsReply(registry: metrics.Metrics, quotaUsage: tuple[int, int] | None = None, slowestDbMethods: int = 8) -> str:
+    def ms(seconds: float) -> str:
+        return f'{seconds * 1000:.1f}'
+    families = { name: family.snapshot() for name, family in registry.families.items() }
+    uptime = int(time.time() - registry.startedAt)
+    lines = [f'Up for {uptime // 86400}d {uptime % 86400 // 3600}h {uptime % 3600 // 60}m', '']
+
+    handlerErrors = families['handler_errors_total']
+    lines.append(f"{'command':<22}{'calls':>7}{'p50 ms':>9}{'p99 ms':>9}{'errors':>7}")
+    for (handler,), histogram in sorted(families['handler_seconds'].items()):
+        lines.append(f"{handler:<22}{histogram.count:>7}{ms(histogram.quantile(0.5)):>9}{ms(histogram.quantile(0.99)):>9}{int(handlerErrors.get((handler,), 0)):>7}")
+
+    lines += ['', f"{'Google Books':<22}{'calls':>7}{'p50 ms':>9}{'p99 ms':>9}"]
+    for (kind,), histogram in sorted(families['google_books_request_seconds'].items()):
+        lines.append(f"{kind:<22}{histogram.count:>7}{ms(histogram.quantile(0.5)):>9}{ms(histogram.quantile(0.99)):>9}")
+    statusCounts: dict[str, int] = {}
+    for (_, status), count in families['google_books_requests_total'].items():
+        statusCounts[status] = statusCounts.get(status, 0) + int(count)
+    if statusCounts:
+        lines.append('statuses: ' + ', '.join(f'{status}: {count}' for status, count in sorted(statusCounts.items())))
+    throttled = families['google_books_throttled_total']
+    if throttled:
+        lines.append('throttled: ' + ', '.join(f'{kind} ({reason}): {int(count)}' for (kind, reason), count in sorted(throttled.items())))
+    if quotaUsage:
+        lines.append(f'daily quota: {quotaUsage[0]} of {quotaUsage[1]} requests used')
+    covers = families['cover_download_seconds'].get(())
+    if covers:
+        failedCovers = sum(int(count) for (status,), count in families['cover_downloads_total'].items() if status != '200')
+        lines.append(f'cover downloads: {covers.count} ({failedCovers} failed), p50 {ms(covers.quantile(0.5))} ms, p99 {ms(covers.quantile(0.99))} ms')
+
+    # Database methods are many and mostly fast, only those taking up the most time in total are listed
+    dbMethods = sorted(families['db_call_seconds'].items(), key = lambda item: item[1].sum, reverse = True)[:slowestDbMethods]
+    lines += ['', f"{'database':<22}{'calls':>7}{'p50 ms':>9}{'p99 ms':>9}"]
+    for (method,), histogram in dbMethods:
+        lines.append(f"{method[:22]:<22}{histogram.count:>7}{ms(histogram.quantile(0.5)):>9}{ms(histogram.quantile(0.99)):>9}")
+
+    lines += ['', f"{'cache':<22}{'lookups':>9}{'hit rate':>10}"]
+    for name, (hits, misses) in sorted(registry.cacheStats().items()):
+        hitRate = f'{hits / (hits + misses):.0%}' if hits + misses else '-'
+        lines.append(f"{name:<22}{hits + misses:>9}{hitRate:>10}")
+
+    renders = families['report_render_seconds'].get(())
+    if renders:
+        lines += ['', f'Submission reports: {renders.count} rendered, p50 {ms(renders.quantile(0.5))} ms, p99 {ms(renders.quantile(0.99))} ms']
+
+    return '```\n' + '\n'.join(lines) + '\n```'
+
+
+# Reply to a search refused by the rate limits
+def slowDownReply(rateLimited: RateLimited) -> str:
+    match rateLimited.reason:
+        case 'user':
+            return f'You are searching too quickly, please wait {max(1, round(rateLimited.retryAfter))} seconds before your next search. Repeating a recent search does not count.'
+        case 'quota':
+            return f"I have run out of Google Books searches for today, they will be available again in about {max(1, round(rateLimited.retryAfter / 3600))} hours. Books which were already submitted are not affected."
+        case _:
+            return 'I am getting too many searches at the moment, please try again in a few seconds.'
+
+
+def fetchErrorReply(errors: dict[str, str]) -> str:
+    return f'I could not fetch some of the submitted books from Google Books ({", ".join(errors.keys())}), please try again in a moment.'
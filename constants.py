@@ -1,26 +1,123 @@
-from dotenv import load_dotenv
 import os
 
 
+# The secrets are loaded by the bots' entry points (setup) rather than on import, so that importing the modules (e.g. in a
+# report rendering process) neither reads the .env file nor needs the secrets to be set
 expectedEnvVars = ['TELEGRAM_TOKEN', 'GOOGLE_BOOKS_API_KEY', 'MASTER_USER_ID', 'MASTER_CHAT_ID']
+secrets: dict[str, str] = {}
 def loadSecrets() -> dict[str, str]:
+    from dotenv import load_dotenv
     load_dotenv()
-    secrets = {}
     for envVar in expectedEnvVars:
         value = os.getenv(envVar)
         if not value:
             raise Exception(f'Missing environment variable: {envVar}')
         secrets[envVar] = value
+    # The .env file may also hold settings
+    loadSettings()
     return secrets
-secrets = loadSecrets()
 
+# Search results listed per page (and requested from Google Books at a time), Google Books pages fetched at most to list
+# one page of results (a page can repeat results listed already)
 MAX_SEARCH_RESULTS = 10
+SEARCH_PAGE_MAX_FETCHES = 2
+# Name used for clubs whose group chat has no title
+DEFAULT_CLUB_NAME = 'the Wild Frog Book Club'
+
+# Google Books API client settings ((connect, read) timeouts in seconds, retries for 429/5xx responses)
+GOOGLE_BOOKS_TIMEOUT = (3.05, 10)
+GOOGLE_BOOKS_MAX_RETRIES = 3
+# Google Books rate limit shared by all API requests (requests per second, burst), with some tokens reserved for volume fetches,
+# which the submission report and vote stage depend on. Searches are refused after waiting max wait seconds, volume fetches wait longer
+GOOGLE_BOOKS_RATE = 5
+GOOGLE_BOOKS_BURST = 20
+GOOGLE_BOOKS_RESERVED_TOKENS = 5
+GOOGLE_BOOKS_SEARCH_MAX_WAIT = 3
+GOOGLE_BOOKS_VOLUME_MAX_WAIT = 30
+# Daily quota of the API key (requests, set in the environment, hour in UTC at which it resets, which is midnight Pacific time
+# for Google, requests reserved for volume fetches)
+GOOGLE_BOOKS_QUOTA_RESET_HOUR = 8
+GOOGLE_BOOKS_QUOTA_RESERVE = 100
+# Seconds between saves of the requests counted against the daily quota, it is also saved on exit
+GOOGLE_BOOKS_QUOTA_SAVE_INTERVAL = 60
+# Searches reaching Google Books per user (burst, seconds to earn another search, users tracked), cached searches are free
+USER_SEARCH_BURST = 5
+USER_SEARCH_INTERVAL = 20
+USER_SEARCH_LIMIT_SIZE = 1024
+
+# Book volume metadata cache (size in entries, time-to-live in seconds)
+VOLUME_CACHE_SIZE = 256
+VOLUME_CACHE_TTL = 7 * 24 * 60 * 60
+# Search result cache (size in entries, time-to-live in seconds)
+SEARCH_CACHE_SIZE = 512
+SEARCH_CACHE_TTL = 24 * 60 * 60
+# Telegram user profile cache (size in entries, seconds before a profile is refreshed, parallel get_chat_member calls)
+USER_PROFILE_CACHE_SIZE = 1024
+USER_PROFILE_TTL = 24 * 60 * 60
+MAX_USER_FETCH_WORKERS = 4
+# Book clubs (users whose current club is kept in memory, clubs whose admins are kept in memory, seconds before admins are refreshed)
+CLUB_MEMBER_CACHE_SIZE = 10000
+CLUB_ADMIN_CACHE_SIZE = 1024
+CLUB_ADMIN_TTL = 10 * 60
+# Latest search results of each user (users kept in memory, seconds before the results expire)
+SEARCH_RESULTS_CACHE_SIZE = 1024
+SEARCH_RESULTS_TTL = 24 * 60 * 60
+# Submission report cover images (print resolution, seconds to wait for all covers to download)
+COVER_DPI = 150
+COVER_PREFETCH_TIMEOUT = 20
+# Number of worker processes rendering submission reports, and of threads preparing report chapters as books are submitted
+REPORT_RENDER_WORKERS = 1
+CHAPTER_PREPARATION_WORKERS = 2
+# SQLite connection settings (seconds to wait on a locked database, prepared statements cached per connection)
+DB_BUSY_TIMEOUT = 5.0
+DB_CACHED_STATEMENTS = 128
+# Threads running database calls for the asyncio bot
+DB_EXECUTOR_WORKERS = 2
+# Maximum number of parallel requests when fetching several book volumes at once
+MAX_FETCH_WORKERS = 8
+# Telegram's limit on the length of a message
+MAX_MESSAGE_LENGTH = 4096
+# Vote tables (longest user name shown, tables with more submissions or rounds are sent as images, rows and font size of the images,
+# rendered glyphs and cell texts kept for the next images)
+VOTE_TABLE_NAME_LENGTH = 16
+VOTE_TABLE_MAX_TEXT_COLUMNS = 12
+VOTE_TABLE_IMAGE_ROWS = 100
+VOTE_TABLE_IMAGE_FONT_SIZE = 20
+VOTE_TABLE_IMAGE_CACHE_SIZE = 2048
+
+# Webhook mode (python main.py --webhook): the secret token Telegram sends with every update is required, the public URL is
+# optional and only used to register the webhook with Telegram (all set in the environment)
+# Updates waiting for a worker before Telegram is asked to resend them, worker threads, largest accepted update in bytes
+WEBHOOK_QUEUE_SIZE = 256
+WEBHOOK_WORKERS = 4
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024
+
+# Metrics (latency histogram buckets in seconds, optional Prometheus text file rewritten every interval seconds, optional
+# HTTP endpoint serving /metrics, disabled unless METRICS_PORT is set, both set in the environment)
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_FILE_INTERVAL = 15
+
+# Settings read from the environment, on import and again by loadSecrets() once the .env file is loaded, so modules using
+# them read them when they are needed (constants.WEBHOOK_PORT) rather than importing their values
+def loadSettings():
+    global GOOGLE_BOOKS_DAILY_QUOTA, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN, WEBHOOK_HOST, WEBHOOK_PORT, METRICS_FILE, METRICS_HOST, METRICS_PORT
+    GOOGLE_BOOKS_DAILY_QUOTA = int(os.getenv('GOOGLE_BOOKS_DAILY_QUOTA', '1000'))
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+    WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+    METRICS_FILE = os.getenv('METRICS_FILE')
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+loadSettings()
 
 regex = {
     'SUBMIT_TITLE': r"title:\"([\w\s]+)\"",
     'SUBMIT_AUTHOR': r"author:\"([\w\s]+)\"",
     'SUBMIT_ISBN': r"isbn:([\d]+)",
     'CHOOSE': r"/choose (\d+)",
+    'SEARCH_PAGE': r"search:(\d+):(\d+)",
+    'CLUB': r"/club (\d+)",
     'VOTE': r"/vote (\d+) (\d+) (\d+)",
 }
 
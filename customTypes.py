@@ -4,6 +4,7 @@ from typing import TypedDict, Literal
 class CommandRequirements(TypedDict):
     chatTypes: list[Literal['private', 'group', 'supergroup', 'channel']] | None
     activeMeeting: bool | None
+    onlyAdmin: bool | None
     onlyMasterUser: bool | None
     stage: Literal['private', 'group', 'supergroup', 'channel'] | None
 
@@ -17,6 +18,36 @@ class BookVolume(TypedDict):
     pageCount: int | None
     googleBooksLink: str
     imageLink: str | None
+    isbns: list[str] | None
+
+# Everything needed to print a submission's chapter in the submission report
+# coverPath is a local, already downscaled image and descriptionHtml is sanitized for fpdf's write_html
+class ChapterAssets(TypedDict):
+    volume: BookVolume
+    coverPath: str | None
+    descriptionHtml: str | None
 
 BookVolumes = list[BookVolume]
-UserSearchResults = dict[int, BookVolumes]
+
+# A /search query split into its general terms and the title:, author: and isbn: tags
+class SearchQuery(TypedDict):
+    general: str
+    title: str | None
+    author: str | None
+    isbn: str | None
+
+# One round of an instant-runoff tally, votes maps the candidates still in the race to the ballots counting for them
+class VoteRound(TypedDict):
+    votes: dict[int, int]
+    exhausted: int
+    eliminated: list[int]
+    tieBreak: bool
+
+class VoteResult(TypedDict):
+    winner: int
+    rounds: list[VoteRound]
+
+# Header and rows of a table of strings, e.g. the vote table sent at the end of the vote stage
+class Table(TypedDict):
+    header: list[str]
+    rows: list[list[str]]
@@ -1,120 +1,615 @@
 import sqlite3 as sql
-from os import path
+import threading
+import json
+import time
+import re
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import customTypes as types
+import constants
+import metrics
+from voting import RunningTally
+from constants import DB_BUSY_TIMEOUT, DB_CACHED_STATEMENTS, DB_EXECUTOR_WORKERS
+
+
+# Keeps one long-lived connection per thread (WAL journal, relaxed syncing, busy timeout and a prepared statement cache)
+# Transactions are tracked per thread, so helpers called inside another method reuse the caller's connection and transaction
+class ConnectionManager:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections: list[tuple[threading.Thread, sql.Connection]] = []
+
+    def connection(self) -> sql.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Transactions are managed explicitly, so the sqlite3 module is left in autocommit mode
+            connection = sql.connect(self.filepath, timeout = DB_BUSY_TIMEOUT, isolation_level = None, check_same_thread = False, cached_statements = DB_CACHED_STATEMENTS)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+            self.local.connection = connection
+            self.local.depth = 0
+            with self.lock:
+                # Close the connections left behind by threads which have since exited
+                for thread, threadConnection in self.connections:
+                    if not thread.is_alive():
+                        threadConnection.close()
+                self.connections = [(thread, threadConnection) for thread, threadConnection in self.connections if thread.is_alive()]
+                self.connections.append((threading.current_thread(), connection))
+        return connection
+
+    # Open a transaction on this thread's connection, or join the one that is already open
+    # Write transactions take the write lock upfront, which lets SQLite wait on busy_timeout instead of failing on a lock upgrade
+    @contextmanager
+    def transaction(self, write: bool = False):
+        connection = self.connection()
+        if self.local.depth == 0:
+            connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        self.local.depth += 1
+        try:
+            yield connection
+        except BaseException:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                connection.rollback()
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            connection.commit()
+
+    def close(self):
+        with self.lock:
+            for _, connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
+# In-memory copy of the active meeting of a club (group chat), kept up to date (write-through) by BookClubDB's write methods
+# Reads which only concern the active meeting are served from here without touching the database
+# Each club has its own lock, so that a busy club never holds up the others
+class MeetingState:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.meetingId: int | None = None
+        self.stage: str | None = None
+        self.volumeId: str | None = None
+        # userId -> (submissionId, volumeId)
+        self.submissions: dict[int, tuple[int, str]] = {}
+        # Ballots of the vote stage, the voters being its users
+        self.tally = RunningTally([])
+
+
+# Schema migrations applied in order based on PRAGMA user_version, migration n brings the schema to version n
+migrations: list[list[str]] = [
+    # 1: Initial schema, the tables already exist in databases created before migrations were introduced
+    [
+        "CREATE TABLE IF NOT EXISTS meetings(meetingId INTEGER NOT NULL PRIMARY KEY, active, stage, volumeId)",
+        "CREATE TABLE IF NOT EXISTS submissions(meetingId INTEGER, userId INTEGER, submissionId INTEGER, volumeId)",
+        "CREATE TABLE IF NOT EXISTS votes(meetingId INTEGER, userId INTEGER, firstVote INTEGER, secondVote INTEGER, thirdVote INTEGER)",
+        "CREATE TABLE IF NOT EXISTS volumes(volumeId TEXT NOT NULL PRIMARY KEY, volume TEXT NOT NULL, fetchedAt REAL NOT NULL)",
+    ],
+    # 2: Keys and indexes for per-meeting lookups and upserts, keeping only the latest submission/vote of each user
+    [
+        "CREATE TABLE submissionsKeyed(meetingId INTEGER NOT NULL, userId INTEGER NOT NULL, submissionId INTEGER NOT NULL, volumeId TEXT NOT NULL, PRIMARY KEY (meetingId, userId), UNIQUE (meetingId, submissionId))",
+        "INSERT OR IGNORE INTO submissionsKeyed SELECT meetingId, userId, submissionId, volumeId FROM submissions WHERE rowid IN (SELECT MAX(rowid) FROM submissions GROUP BY meetingId, userId)",
+        "DROP TABLE submissions",
+        "ALTER TABLE submissionsKeyed RENAME TO submissions",
+        "CREATE TABLE votesKeyed(meetingId INTEGER NOT NULL, userId INTEGER NOT NULL, firstVote INTEGER NOT NULL, secondVote INTEGER NOT NULL, thirdVote INTEGER NOT NULL, PRIMARY KEY (meetingId, userId))",
+        "INSERT INTO votesKeyed SELECT meetingId, userId, firstVote, secondVote, thirdVote FROM votes WHERE rowid IN (SELECT MAX(rowid) FROM votes GROUP BY meetingId, userId)",
+        "DROP TABLE votes",
+        "ALTER TABLE votesKeyed RENAME TO votes",
+        "CREATE INDEX meetingsActive ON meetings(active) WHERE active = TRUE",
+    ],
+    # 3: Cache of Telegram user profiles
+    [
+        "CREATE TABLE users(userId INTEGER NOT NULL PRIMARY KEY, firstName TEXT NOT NULL, updatedAt REAL NOT NULL)",
+    ],
+    # 4: Report chapter assets prepared for each submission
+    [
+        "ALTER TABLE submissions ADD COLUMN assets TEXT",
+    ],
+    # 5: Latest search results of each user, so that /choose keeps working after a restart
+    [
+        "CREATE TABLE searchResults(userId INTEGER NOT NULL PRIMARY KEY, results TEXT NOT NULL, savedAt REAL NOT NULL)",
+    ],
+    # 6: Meetings, submissions and votes are kept per club (group chat), the existing ones belong to the master chat
+    # Meetings are numbered per club, at most one meeting of each club is active
+    [
+        "CREATE TABLE meetingsByChat(chatId INTEGER NOT NULL, meetingId INTEGER NOT NULL, active, stage, volumeId, PRIMARY KEY (chatId, meetingId))",
+        "INSERT INTO meetingsByChat SELECT :masterChatId, meetingId, active, stage, volumeId FROM meetings",
+        "DROP TABLE meetings",
+        "ALTER TABLE meetingsByChat RENAME TO meetings",
+        "CREATE UNIQUE INDEX meetingsActive ON meetings(chatId) WHERE active = TRUE",
+        "CREATE TABLE submissionsByChat(chatId INTEGER NOT NULL, meetingId INTEGER NOT NULL, userId INTEGER NOT NULL, submissionId INTEGER NOT NULL, volumeId TEXT NOT NULL, assets TEXT, PRIMARY KEY (chatId, meetingId, userId), UNIQUE (chatId, meetingId, submissionId))",
+        "INSERT INTO submissionsByChat SELECT :masterChatId, meetingId, userId, submissionId, volumeId, assets FROM submissions",
+        "DROP TABLE submissions",
+        "ALTER TABLE submissionsByChat RENAME TO submissions",
+        "CREATE TABLE votesByChat(chatId INTEGER NOT NULL, meetingId INTEGER NOT NULL, userId INTEGER NOT NULL, firstVote INTEGER NOT NULL, secondVote INTEGER NOT NULL, thirdVote INTEGER NOT NULL, PRIMARY KEY (chatId, meetingId, userId))",
+        "INSERT INTO votesByChat SELECT :masterChatId, meetingId, userId, firstVote, secondVote, thirdVote FROM votes",
+        "DROP TABLE votes",
+        "ALTER TABLE votesByChat RENAME TO votes",
+        # Clubs and the users seen in them, a user's current club is the one they were last seen in
+        "CREATE TABLE clubs(chatId INTEGER NOT NULL PRIMARY KEY, title TEXT)",
+        "CREATE TABLE members(chatId INTEGER NOT NULL, userId INTEGER NOT NULL, seenAt REAL NOT NULL, PRIMARY KEY (chatId, userId))",
+        "CREATE INDEX membersByUser ON members(userId, seenAt)",
+    ],
+    # 7: Google Books requests made per day, counted against the API key's daily quota
+    [
+        "CREATE TABLE quotaUsage(day TEXT NOT NULL PRIMARY KEY, requests INTEGER NOT NULL)",
+    ],
+    # 8: Catalog of every book volume seen in search results or fetched, with a full-text index kept up to date by triggers
+    # Volumes are stored without their description, which is only needed once a book is submitted
+    [
+        "CREATE TABLE catalog(catalogId INTEGER PRIMARY KEY, volumeId TEXT NOT NULL UNIQUE, title TEXT, subtitle TEXT, authors TEXT, categories TEXT, volume TEXT NOT NULL)",
+        "CREATE VIRTUAL TABLE catalogIndex USING fts5(title, subtitle, authors, categories, content = 'catalog', content_rowid = 'catalogId', tokenize = 'unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER catalogInserted AFTER INSERT ON catalog BEGIN "
+            "INSERT INTO catalogIndex(rowid, title, subtitle, authors, categories) VALUES (new.catalogId, new.title, new.subtitle, new.authors, new.categories); END",
+        "CREATE TRIGGER catalogDeleted AFTER DELETE ON catalog BEGIN "
+            "INSERT INTO catalogIndex(catalogIndex, rowid, title, subtitle, authors, categories) VALUES ('delete', old.catalogId, old.title, old.subtitle, old.authors, old.categories); END",
+        "CREATE TRIGGER catalogUpdated AFTER UPDATE ON catalog BEGIN "
+            "INSERT INTO catalogIndex(catalogIndex, rowid, title, subtitle, authors, categories) VALUES ('delete', old.catalogId, old.title, old.subtitle, old.authors, old.categories); "
+            "INSERT INTO catalogIndex(rowid, title, subtitle, authors, categories) VALUES (new.catalogId, new.title, new.subtitle, new.authors, new.categories); END",
+        "CREATE TABLE catalogIsbns(isbn TEXT NOT NULL, catalogId INTEGER NOT NULL, PRIMARY KEY (isbn, catalogId))",
+        # The volumes fetched so far are the catalog's first entries
+        "INSERT INTO catalog(volumeId, title, subtitle, authors, categories, volume) SELECT volumeId, json_extract(volume, '$.title'), json_extract(volume, '$.subtitle'), "
+            "(SELECT group_concat(value, ', ') FROM json_each(volume, '$.authors')), (SELECT group_concat(value, ', ') FROM json_each(volume, '$.categories')), "
+            "json_set(volume, '$.description', NULL) FROM volumes",
+    ],
+    # 9: Search results are saved along with the pages listed so far (a SearchSession), the lists saved before are dropped
+    [
+        "DELETE FROM searchResults",
+    ],
+]
+
+
+# Full-text query of the catalog index matching every word of a search query, None if there is nothing to match
+# Words are quoted, so that nothing the user types is taken for FTS5 syntax
+def catalogMatchExpression(query: types.SearchQuery) -> str | None:
+    def words(text: str | None) -> str:
+        return ' '.join(f'"{word}"' for word in re.findall(r"\w+", text or ''))
+    parts = []
+    if words(query['general']):
+        parts.append(f"({words(query['general'])})")
+    if words(query['title']):
+        parts.append(f"title : ({words(query['title'])})")
+    if words(query['author']):
+        parts.append(f"authors : ({words(query['author'])})")
+    return ' AND '.join(parts) or None
+
+
+# The duration of the methods running SQLite statements is recorded in the metrics, those only reading the in-memory meeting
+# state are not timed, as they are called by most handlers and would hide the database calls
+timeQuery = metrics.timeCalls(metrics.dbSeconds)
 
 
 class BookClubDB:
-    # Initiailize database connection, create tables if this is the first run
+    # Initiailize database connection, create or upgrade the tables as needed
     def __init__(self):
         self.filepath = 'bookClub.db'
-        isInitialSetup = not path.exists(self.filepath)
-        if isInitialSetup:
-            with sql.connect(self.filepath) as connection:
+        self.connections = ConnectionManager(self.filepath)
+        self.migrate()
+        self.reopenInterruptedReports()
+        # chatId -> MeetingState, loaded the first time a club is used
+        self.meetingStates: dict[int, MeetingState] = {}
+        self.meetingStatesLock = threading.Lock()
+
+    # Apply pending schema migrations, each in its own transaction so that an interrupted upgrade can be resumed
+    # Statements can refer to the master chat as :masterChatId, which is only needed to move existing meetings into the master
+    # chat's club (migration 6), so a new database can be created without it
+    @timeQuery
+    def migrate(self):
+        masterChatId = constants.secrets.get('MASTER_CHAT_ID')
+        migrationParams = { 'masterChatId': int(masterChatId) if masterChatId else None }
+        while True:
+            with self.connections.transaction(write = True) as connection:
                 cursor = connection.cursor()
-                cursor.execute("CREATE TABLE meetings(meetingId INTEGER NOT NULL PRIMARY KEY, active, stage, volumeId)")
-                cursor.execute("CREATE TABLE submissions(meetingId INTEGER, userId INTEGER, submissionId INTEGER, volumeId)")
-                cursor.execute("CREATE TABLE votes(meetingId INTEGER, userId INTEGER, firstVote INTEGER, secondVote INTEGER, thirdVote INTEGER)")
-                results = cursor.execute("SELECT name FROM sqlite_master").fetchall()
-                print(f"Created the following tables: {[result[0] for result in results]}")
+                version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(migrations):
+                    return
+                try:
+                    for statement in migrations[version]:
+                        cursor.execute(statement, migrationParams)
+                except sql.IntegrityError as e:
+                    if migrationParams['masterChatId'] is None:
+                        raise Exception(f'MASTER_CHAT_ID is needed to migrate the existing data to version {version + 1}: {e}')
+                    raise
+                cursor.execute(f"PRAGMA user_version = {version + 1}")
+                print(f"Migrated database schema to version {version + 1}")
+
+    # Submission reports being rendered when the bot stopped were never sent, their meetings go back to the submit stage
+    @timeQuery
+    def reopenInterruptedReports(self):
+        with self.connections.transaction(write = True) as connection:
+            cursor = connection.cursor()
+            cursor.execute("UPDATE meetings SET stage = ? WHERE active = TRUE AND stage = ?", ('submit', 'report'))
+
+    # Get the meeting state of a club, loading it from the database the first time the club is used
+    def getMeetingState(self, chatId: int) -> MeetingState:
+        state = self.meetingStates.get(chatId)
+        if state is None:
+            with self.meetingStatesLock:
+                state = self.meetingStates.setdefault(chatId, MeetingState())
+        if not state.loaded:
+            with state.lock:
+                if not state.loaded:
+                    self.loadMeetingState(chatId, state)
+        return state
+
+    # Populate a club's meeting state from the database
+    @timeQuery
+    def loadMeetingState(self, chatId: int, state: MeetingState):
+        with self.connections.transaction() as connection:
+            cursor = connection.cursor()
+            result = cursor.execute("SELECT meetingId, stage, volumeId FROM meetings WHERE chatId = ? AND active = TRUE", (chatId, )).fetchone()
+            (state.meetingId, state.stage, state.volumeId) = result if result else (None, None, None)
+            state.submissions = { userId: (submissionId, volumeId) for userId, submissionId, volumeId in self.getSubmissions(chatId, state.meetingId) }
+            state.tally = RunningTally(
+                [submissionId for submissionId, _ in state.submissions.values()],
+                { userId: [firstVote, secondVote, thirdVote] for userId, firstVote, secondVote, thirdVote in self.getVotes(chatId, state.meetingId) }
+            )
+            state.loaded = True
 
     # SELECT (stage, volumeId)[] FROM meetings
-    def getMeeting(self, meetingId):
-        with sql.connect(self.filepath) as connection:
+    def getMeeting(self, chatId, meetingId):
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            if meetingId == state.meetingId:
+                return (state.stage, state.volumeId)
+        with self.connections.transaction() as connection:
             cursor = connection.cursor()
-            result = cursor.execute("SELECT stage, volumeId FROM meetings WHERE meetingId = ?", (meetingId, )).fetchone()
+            result = cursor.execute("SELECT stage, volumeId FROM meetings WHERE chatId = ? AND meetingId = ?", (chatId, meetingId)).fetchone()
             return result
 
     # SELECT (userId, submissionId, volumeId)[] FROM submissions
-    def getSubmissions(self, meetingId):
-        with sql.connect(self.filepath) as connection:
+    @timeQuery
+    def getSubmissions(self, chatId, meetingId):
+        with self.connections.transaction() as connection:
             cursor = connection.cursor()
-            result = cursor.execute("SELECT userId, submissionId, volumeId FROM submissions WHERE meetingId = ?", (meetingId, )).fetchall()
+            result = cursor.execute("SELECT userId, submissionId, volumeId FROM submissions WHERE chatId = ? AND meetingId = ?", (chatId, meetingId)).fetchall()
             return result
 
     # SELECT (userId, firstVote, secondVote, thirdVote)[] FROM votes
-    def getVotes(self, meetingId):
-        with sql.connect(self.filepath) as connection:
+    @timeQuery
+    def getVotes(self, chatId, meetingId):
+        with self.connections.transaction() as connection:
             cursor = connection.cursor()
-            result = cursor.execute("SELECT userId, firstVote, secondVote, thirdVote FROM votes WHERE meetingId = ?", (meetingId, )).fetchall()
+            result = cursor.execute("SELECT userId, firstVote, secondVote, thirdVote FROM votes WHERE chatId = ? AND meetingId = ?", (chatId, meetingId)).fetchall()
             return result
 
-    # Helper function to find the currently active meeting
-    def getActiveMeetingId(self) -> int:
-        with sql.connect(self.filepath) as connection:
+    # SELECT { submissionId: assets } FROM submissions, for the submissions which have their chapter assets prepared
+    @timeQuery
+    def getSubmissionAssets(self, chatId, meetingId) -> dict[int, types.ChapterAssets]:
+        with self.connections.transaction() as connection:
+            cursor = connection.cursor()
+            results = cursor.execute("SELECT submissionId, assets FROM submissions WHERE chatId = ? AND meetingId = ? AND assets IS NOT NULL", (chatId, meetingId)).fetchall()
+            return { submissionId: json.loads(assets) for submissionId, assets in results }
+
+    # Store the prepared chapter assets of a submission, unless the user has since submitted a different book
+    @timeQuery
+    def saveSubmissionAssets(self, chatId, meetingId, userId, volumeId, assets: types.ChapterAssets):
+        with self.connections.transaction(write = True) as connection:
+            cursor = connection.cursor()
+            cursor.execute("UPDATE submissions SET assets = ? WHERE chatId = ? AND meetingId = ? AND userId = ? AND volumeId = ?", (json.dumps(assets), chatId, meetingId, userId, volumeId))
+
+    # SELECT (volume, fetchedAt) FROM volumes
+    @timeQuery
+    def getVolume(self, volumeId: str) -> tuple[types.BookVolume, float] | None:
+        with self.connections.transaction() as connection:
             cursor = connection.cursor()
-            result = cursor.execute("SELECT meetingId FROM meetings WHERE active = TRUE").fetchone()
+            result = cursor.execute("SELECT volume, fetchedAt FROM volumes WHERE volumeId = ?", (volumeId, )).fetchone()
             if not result:
-                raise Exception('No active meeting.')
-            return result[0]
-    
-    # Helper function to get the number of users that have made submissions in the currently active meeting
-    def getSubmissionCount(self) -> int:
-        with sql.connect(self.filepath) as connection:
+                return None
+            return json.loads(result[0]), result[1]
+
+    # Save a book volume to the metadata cache, replacing any previous copy
+    @timeQuery
+    def saveVolume(self, bookVolume: types.BookVolume):
+        with self.connections.transaction(write = True) as connection:
             cursor = connection.cursor()
-            activeMeetingId = self.getActiveMeetingId()
-            submissionCount = cursor.execute("SELECT COUNT(userId) FROM submissions WHERE meetingId = ?", (activeMeetingId, )).fetchone()[0]
-            return submissionCount
+            cursor.execute("INSERT OR REPLACE INTO volumes VALUES (?, ?, ?)", (bookVolume['id'], json.dumps(bookVolume), time.time()))
 
-    # Helper function to get the volumeId corresponding to a submission from the currently active meeting
-    def getSubmissionVolumeId(self, submissionId: int):
-        with sql.connect(self.filepath) as connection:
+    # Add book volumes to the catalog, updating the ones it already has
+    @timeQuery
+    def saveCatalogVolumes(self, bookVolumes: types.BookVolumes):
+        with self.connections.transaction(write = True) as connection:
+            cursor = connection.cursor()
+            for bookVolume in bookVolumes:
+                cursor.execute(
+                    "INSERT INTO catalog(volumeId, title, subtitle, authors, categories, volume) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(volumeId) DO UPDATE SET title = excluded.title, subtitle = excluded.subtitle, authors = excluded.authors, "
+                    "categories = excluded.categories, volume = excluded.volume WHERE volume IS NOT excluded.volume",
+                    (bookVolume['id'], bookVolume['title'], bookVolume['subtitle'], ', '.join(bookVolume['authors'] or []), ', '.join(bookVolume['categories'] or []),
+                     json.dumps({ **bookVolume, 'description': None }))
+                )
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO catalogIsbns SELECT ?, catalogId FROM catalog WHERE volumeId = ?",
+                    [(isbn, bookVolume['id']) for isbn in bookVolume.get('isbns') or []]
+                )
+
+    # Search the catalog, every word of the query having to match (in the title/author for those tags), best matches first
+    # Titles weigh the most in the ranking, followed by authors, subtitles and categories
+    @timeQuery
+    def searchCatalog(self, query: types.SearchQuery, limit: int) -> types.BookVolumes:
+        match = catalogMatchExpression(query)
+        if not match and not query['isbn']:
+            return []
+        conditions, params = [], []
+        if match:
+            conditions.append("catalogIndex MATCH ?")
+            params.append(match)
+        if query['isbn']:
+            conditions.append("catalog.catalogId IN (SELECT catalogId FROM catalogIsbns WHERE isbn = ?)")
+            params.append(query['isbn'])
+        if match:
+            sql = ("SELECT catalog.volume FROM catalogIndex JOIN catalog ON catalog.catalogId = catalogIndex.rowid "
+                   f"WHERE {' AND '.join(conditions)} ORDER BY bm25(catalogIndex, 10.0, 2.0, 5.0, 1.0) LIMIT ?")
+        else:
+            sql = f"SELECT catalog.volume FROM catalog WHERE {conditions[0]} LIMIT ?"
+        with self.connections.transaction() as connection:
+            cursor = connection.cursor()
+            return [json.loads(volume) for (volume, ) in cursor.execute(sql, (*params, limit))]
+
+    # SELECT (firstName, updatedAt) FROM users for each of the given users that is known
+    @timeQuery
+    def getUsers(self, userIds: list[int]) -> dict[int, tuple[str, float]]:
+        with self.connections.transaction() as connection:
+            cursor = connection.cursor()
+            placeholders = ', '.join('?' for _ in userIds)
+            results = cursor.execute(f"SELECT userId, firstName, updatedAt FROM users WHERE userId IN ({placeholders})", tuple(userIds)).fetchall()
+            return { userId: (firstName, updatedAt) for userId, firstName, updatedAt in results }
+
+    # Save a user's profile, replacing any previous copy
+    @timeQuery
+    def saveUser(self, userId: int, firstName: str):
+        with self.connections.transaction(write = True) as connection:
             cursor = connection.cursor()
-            activeMeetingId = self.getActiveMeetingId()
-            result = cursor.execute("SELECT volumeId FROM submissions WHERE meetingId = ? AND submissionId = ?", (activeMeetingId, submissionId)).fetchone()
+            cursor.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", (userId, firstName, time.time()))
+
+    # SELECT (results, savedAt) FROM searchResults, results being the row of a SearchSession
+    @timeQuery
+    def getSearchResults(self, userId: int) -> tuple[dict, float] | None:
+        with self.connections.transaction() as connection:
+            cursor = connection.cursor()
+            result = cursor.execute("SELECT results, savedAt FROM searchResults WHERE userId = ?", (userId, )).fetchone()
             if not result:
-                raise Exception(f'Missing submission {submissionId} in meeting {activeMeetingId}.')
-            return result[0]
+                return None
+            return json.loads(result[0]), result[1]
 
-    # Set all existing meetings to inactive and create a new one
-    def newMeeting(self):
-        with sql.connect(self.filepath) as connection:
+    # Save a user's latest search, replacing the previous one
+    @timeQuery
+    def saveSearchResults(self, userId: int, results: dict):
+        with self.connections.transaction(write = True) as connection:
             cursor = connection.cursor()
-            cursor.execute("UPDATE meetings SET active = FALSE")
-            meetingCount = int(cursor.execute("SELECT COUNT(meetingId) FROM meetings").fetchone()[0])
-            cursor.execute("INSERT INTO meetings(meetingId, active, stage) VALUES (?, 1, ?)", (meetingCount + 1, 'submit'))
-            connection.commit()
-            print(f"Initialized meeting {meetingCount + 1}")
-
-    # Submit a book for the currently active meeting
-    def submitBook(self, userId, volumeId):
-        with sql.connect(self.filepath) as connection:
-            cursor = connection.cursor()
-            activeMeetingId = self.getActiveMeetingId()
-            # If the user already made a submission for the currently active meeting, overwrite it
-            # Otherwise, make a new submission with the submissionId being submissionCount + 1
-            result = cursor.execute("SELECT submissionId FROM submissions WHERE meetingId = ? AND userId = ?", (activeMeetingId, userId)).fetchone()
-            if result != None:
-                cursor.execute("UPDATE submissions SET volumeId = ? WHERE meetingId = ? AND userId = ?", (volumeId, activeMeetingId, userId))
-                connection.commit()
-                print(f"User {userId} changed their submission to {volumeId} for meeting {activeMeetingId}")
-            else:
-                submissionCount = self.getSubmissionCount()
-                cursor.execute("INSERT INTO submissions VALUES (?, ?, ?, ?)", (activeMeetingId, userId, submissionCount + 1, volumeId))
-                connection.commit()
-                print(f"User {userId} submitted a book for meeting {activeMeetingId}")
-    
-    # Change meeting stage to voting
-    def startVoting(self):
-        with sql.connect(self.filepath) as connection:
+            cursor.execute("INSERT OR REPLACE INTO searchResults VALUES (?, ?, ?)", (userId, json.dumps(results), time.time()))
+
+    # Delete the search results saved before the given time
+    @timeQuery
+    def deleteSearchResults(self, olderThan: float):
+        with self.connections.transaction(write = True) as connection:
             cursor = connection.cursor()
-            activeMeetingId = self.getActiveMeetingId()
-            cursor.execute("UPDATE meetings SET stage = ? WHERE meetingId = ?", ('vote', activeMeetingId))
-            connection.commit()
-            print(f"Changed meeting stage to 'vote'")
+            cursor.execute("DELETE FROM searchResults WHERE savedAt < ?", (olderThan, ))
 
-    # Submit votes for the currently active meeting
-    def vote(self, userId, firstVote, secondVote, thirdVote):
-        with sql.connect(self.filepath) as connection:
+    # SELECT requests FROM quotaUsage, the Google Books requests made on a day (0 if there were none)
+    @timeQuery
+    def getQuotaUsage(self, day: str) -> int:
+        with self.connections.transaction() as connection:
             cursor = connection.cursor()
-            activeMeetingId = self.getActiveMeetingId()
-            cursor.execute("INSERT INTO votes VALUES (?, ?, ?, ?, ?)", (activeMeetingId, userId, firstVote, secondVote, thirdVote))
-            connection.commit()
-            print(f"User {userId} submitted their votes for meeting {activeMeetingId}.")
+            result = cursor.execute("SELECT requests FROM quotaUsage WHERE day = ?", (day, )).fetchone()
+            return result[0] if result else 0
 
-    # Change meeting stage to organized
-    def endVoting(self, volumeId):
-        with sql.connect(self.filepath) as connection:
+    # Save the Google Books requests made on a day, never lowering a count saved before (saves can arrive out of order)
+    @timeQuery
+    def saveQuotaUsage(self, day: str, requests: int):
+        with self.connections.transaction(write = True) as connection:
             cursor = connection.cursor()
-            activeMeetingId = self.getActiveMeetingId()
-            cursor.execute("UPDATE meetings SET stage = ?, volumeId = ? WHERE meetingId = ?", ('organized', volumeId, activeMeetingId))
-            connection.commit()
-            print(f"Ended voting for meeting {activeMeetingId}, the chosen book is {volumeId}")
+            cursor.execute("INSERT INTO quotaUsage VALUES (?, ?) ON CONFLICT(day) DO UPDATE SET requests = MAX(requests, excluded.requests)", (day, requests))
+
+    # SELECT chatId FROM members, the club the user was last seen in
+    @timeQuery
+    def getCurrentClub(self, userId: int) -> int | None:
+        with self.connections.transaction() as connection:
+            cursor = connection.cursor()
+            result = cursor.execute("SELECT chatId FROM members WHERE userId = ? ORDER BY seenAt DESC LIMIT 1", (userId, )).fetchone()
+            return result[0] if result else None
+
+    # SELECT (chatId, title)[] FROM clubs the user was seen in
+    @timeQuery
+    def getClubs(self, userId: int) -> list[tuple[int, str | None]]:
+        with self.connections.transaction() as connection:
+            cursor = connection.cursor()
+            return cursor.execute(
+                "SELECT members.chatId, clubs.title FROM members LEFT JOIN clubs ON clubs.chatId = members.chatId WHERE members.userId = ? ORDER BY members.chatId",
+                (userId, )
+            ).fetchall()
+
+    # Save a club's title, replacing any previous one
+    @timeQuery
+    def saveClub(self, chatId: int, title: str | None):
+        with self.connections.transaction(write = True) as connection:
+            cursor = connection.cursor()
+            cursor.execute("INSERT OR REPLACE INTO clubs VALUES (?, ?)", (chatId, title))
+
+    # Record that a user was seen in a club, which makes it their current club
+    @timeQuery
+    def saveMember(self, chatId: int, userId: int):
+        with self.connections.transaction(write = True) as connection:
+            cursor = connection.cursor()
+            cursor.execute("INSERT OR REPLACE INTO members VALUES (?, ?, ?)", (chatId, userId, time.time()))
+
+    # Helper function to find the currently active meeting of a club
+    def getActiveMeetingId(self, chatId) -> int:
+        activeMeetingId = self.getMeetingState(chatId).meetingId
+        if activeMeetingId is None:
+            raise Exception('No active meeting.')
+        return activeMeetingId
+    
+    # Helper function to get the number of users that have made submissions in the currently active meeting
+    def getSubmissionCount(self, chatId) -> int:
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            self.getActiveMeetingId(chatId)
+            return len(state.submissions)
+
+    # Helper function to get the users that have made submissions in the currently active meeting
+    def getSubmitters(self, chatId) -> list[int]:
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            return list(state.submissions.keys())
+
+    # Helper function to get the users that have voted in the currently active meeting
+    def getVoters(self, chatId) -> list[int]:
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            return list(state.tally.ballots.keys())
+
+    # Helper function to get the ballots of the currently active meeting and their instant-runoff result (None without any ballots)
+    # The result is only recomputed after a ballot has changed
+    def getTally(self, chatId) -> tuple[dict[int, list[int]], types.VoteResult | None]:
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            return dict(state.tally.ballots), state.tally.getResult()
+
+    # Helper function to get the number of ballots ranking each submission first in the currently active meeting
+    def getFirstPreferences(self, chatId) -> dict[int, int]:
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            return { submissionId: count for submissionId, count in state.tally.firstPreferences.items() if count > 0 }
+
+    # Helper function to get the volumeId corresponding to a submission from the currently active meeting
+    def getSubmissionVolumeId(self, chatId, submissionId: int):
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            activeMeetingId = self.getActiveMeetingId(chatId)
+            for userSubmissionId, volumeId in state.submissions.values():
+                if userSubmissionId == submissionId:
+                    return volumeId
+            raise Exception(f'Missing submission {submissionId} in meeting {activeMeetingId}.')
+
+    # Set the club's existing meetings to inactive and create a new one
+    @timeQuery
+    def newMeeting(self, chatId):
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            with self.connections.transaction(write = True) as connection:
+                cursor = connection.cursor()
+                cursor.execute("UPDATE meetings SET active = FALSE WHERE chatId = ? AND active = TRUE", (chatId, ))
+                meetingId = int(cursor.execute("SELECT COALESCE(MAX(meetingId), 0) + 1 FROM meetings WHERE chatId = ?", (chatId, )).fetchone()[0])
+                cursor.execute("INSERT INTO meetings(chatId, meetingId, active, stage) VALUES (?, ?, 1, ?)", (chatId, meetingId, 'submit'))
+            (state.meetingId, state.stage, state.volumeId) = (meetingId, 'submit', None)
+            state.submissions = {}
+            state.tally = RunningTally([])
+            print(f"Initialized meeting {meetingId} of chat {chatId}")
+
+    # Submit a book for the currently active meeting, returning False if it is no longer in the submit stage (/choose may have
+    # been let through just before the submissions were closed)
+    @timeQuery
+    def submitBook(self, chatId, userId, volumeId) -> bool:
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            if state.stage != 'submit':
+                return False
+            with self.connections.transaction(write = True) as connection:
+                cursor = connection.cursor()
+                activeMeetingId = self.getActiveMeetingId(chatId)
+                # If the user already made a submission for the currently active meeting, overwrite it
+                # Otherwise, make a new submission with the submissionId being submissionCount + 1
+                # Chapter assets prepared for a previously submitted book are dropped
+                submissionId = cursor.execute(
+                    "INSERT INTO submissions(chatId, meetingId, userId, submissionId, volumeId) VALUES (?, ?, ?, (SELECT COUNT(userId) + 1 FROM submissions WHERE chatId = ? AND meetingId = ?), ?) "
+                    "ON CONFLICT(chatId, meetingId, userId) DO UPDATE SET volumeId = excluded.volumeId, assets = IIF(volumeId = excluded.volumeId, assets, NULL) RETURNING submissionId",
+                    (chatId, activeMeetingId, userId, chatId, activeMeetingId, volumeId)
+                ).fetchone()[0]
+            state.submissions[userId] = (submissionId, volumeId)
+            print(f"User {userId} submitted {volumeId} as submission {submissionId} for meeting {activeMeetingId} of chat {chatId}")
+            return True
+    
+    # Change meeting stage to report, closing the submissions while the submission report is rendered so that the report and the
+    # ballot list the same books. Returns False if the meeting is no longer in the submit stage (e.g. another admin was first)
+    @timeQuery
+    def closeSubmissions(self, chatId) -> bool:
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            if state.stage != 'submit':
+                return False
+            with self.connections.transaction(write = True) as connection:
+                cursor = connection.cursor()
+                activeMeetingId = self.getActiveMeetingId(chatId)
+                cursor.execute("UPDATE meetings SET stage = ? WHERE chatId = ? AND meetingId = ?", ('report', chatId, activeMeetingId))
+            state.stage = 'report'
+            print(f"Changed meeting stage to 'report' in chat {chatId}")
+            return True
+
+    # Change meeting stage back to submit, if the submission report could not be delivered
+    @timeQuery
+    def reopenSubmissions(self, chatId):
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            with self.connections.transaction(write = True) as connection:
+                cursor = connection.cursor()
+                activeMeetingId = self.getActiveMeetingId(chatId)
+                cursor.execute("UPDATE meetings SET stage = ? WHERE chatId = ? AND meetingId = ?", ('submit', chatId, activeMeetingId))
+            state.stage = 'submit'
+            print(f"Changed meeting stage back to 'submit' in chat {chatId}")
+
+    # Change meeting stage to voting, the candidates being the submissions closed for the report
+    @timeQuery
+    def startVoting(self, chatId):
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            with self.connections.transaction(write = True) as connection:
+                cursor = connection.cursor()
+                activeMeetingId = self.getActiveMeetingId(chatId)
+                cursor.execute("UPDATE meetings SET stage = ? WHERE chatId = ? AND meetingId = ?", ('vote', chatId, activeMeetingId))
+            state.stage = 'vote'
+            state.tally = RunningTally([submissionId for submissionId, _ in state.submissions.values()])
+            print(f"Changed meeting stage to 'vote' in chat {chatId}")
+
+    # Submit votes for the currently active meeting
+    @timeQuery
+    def vote(self, chatId, userId, firstVote, secondVote, thirdVote):
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            with self.connections.transaction(write = True) as connection:
+                cursor = connection.cursor()
+                activeMeetingId = self.getActiveMeetingId(chatId)
+                # If the user already voted in the currently active meeting, overwrite their votes
+                cursor.execute(
+                    "INSERT INTO votes VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(chatId, meetingId, userId) DO UPDATE SET firstVote = excluded.firstVote, secondVote = excluded.secondVote, thirdVote = excluded.thirdVote",
+                    (chatId, activeMeetingId, userId, firstVote, secondVote, thirdVote)
+                )
+            state.tally.setBallot(userId, [firstVote, secondVote, thirdVote])
+            print(f"User {userId} submitted their votes for meeting {activeMeetingId} of chat {chatId}.")
+
+    # Change meeting stage to organized
+    @timeQuery
+    def endVoting(self, chatId, volumeId):
+        state = self.getMeetingState(chatId)
+        with state.lock:
+            with self.connections.transaction(write = True) as connection:
+                cursor = connection.cursor()
+                activeMeetingId = self.getActiveMeetingId(chatId)
+                cursor.execute("UPDATE meetings SET stage = ?, volumeId = ? WHERE chatId = ? AND meetingId = ?", ('organized', volumeId, chatId, activeMeetingId))
+            (state.stage, state.volumeId) = ('organized', volumeId)
+            print(f"Ended voting for meeting {activeMeetingId} of chat {chatId}, the chosen book is {volumeId}")
+
+
+# Asyncio access to a BookClubDB, every method call is run on a dedicated executor so that SQLite never blocks the event loop
+# e.g. await asyncDB.submitBook(chatId, userId, volumeId), the wrapped database stays available as asyncDB.db for code running in threads
+class AsyncBookClubDB:
+    def __init__(self, bookClubDB: BookClubDB, workers: int = DB_EXECUTOR_WORKERS):
+        self.db = bookClubDB
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'sqlite')
+
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+        async def call(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        return call
@@ -1,35 +1,343 @@
 import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 import re
 import os
+import json
 
 import customTypes as types
-from constants import regex, MAX_SEARCH_RESULTS
+import constants
+import metrics
+from cache import LRUCache, InFlight, AsyncInFlight
+from rateLimit import RateLimited, TokenBucket, KeyedTokenBuckets, DailyQuota
+from constants import regex, MAX_SEARCH_RESULTS, VOLUME_CACHE_SIZE, VOLUME_CACHE_TTL, MAX_FETCH_WORKERS, GOOGLE_BOOKS_TIMEOUT, GOOGLE_BOOKS_MAX_RETRIES, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+from constants import GOOGLE_BOOKS_RATE, GOOGLE_BOOKS_BURST, GOOGLE_BOOKS_RESERVED_TOKENS, GOOGLE_BOOKS_SEARCH_MAX_WAIT, GOOGLE_BOOKS_VOLUME_MAX_WAIT
+from constants import GOOGLE_BOOKS_QUOTA_RESET_HOUR, GOOGLE_BOOKS_QUOTA_RESERVE, USER_SEARCH_BURST, USER_SEARCH_INTERVAL, USER_SEARCH_LIMIT_SIZE
 
 
-# Process the user input string to build a search string matching the google books API specifications
-def parseSearchTerms(input: str):
-    searchTerms = {}
-    input = re.sub(r"(/search )", '', input)
+# Kind of request an API resource is fetched by, as reported in the metrics
+def requestKind(resource: str) -> str:
+    return 'search' if resource == 'volumes' else 'volume'
+
+
+# Shared client for the Google Books API
+# Reuses pooled keep-alive connections, applies connect/read timeouts and retries 429/5xx responses with jittered exponential backoff
+# API requests go through a rate limiter and are counted against the API key's daily quota (cover downloads are not API requests)
+class GoogleBooksClient:
+    baseUrl = 'https://www.googleapis.com/books/v1'
+    retryStatusCodes = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout: tuple[float, float], maxRetries: int, poolSize: int, rateLimiter: TokenBucket, quota: DailyQuota, backoffBase: float = 0.5, backoffMax: float = 8):
+        self.timeout = timeout
+        self.maxRetries = maxRetries
+        self.rateLimiter = rateLimiter
+        self.quota = quota
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections = 1, pool_maxsize = poolSize))
+        # Google only serves gzip-compressed responses to user agents which mention it
+        self.session.headers.update({ 'Accept-Encoding': 'gzip', 'User-Agent': 'book-club-bot (gzip)' })
+
+    # Record an attempt of a kind of request (search, volume or cover), its status being the HTTP status code or the error
+    # Cover downloads are not API requests and have metrics of their own
+    def recordLatency(self, latency: float, kind: str, status: str):
+        if kind == 'cover':
+            metrics.coverDownloadSeconds.observe(latency)
+            metrics.coverDownloads.increment(status)
+            return
+        metrics.googleBooksSeconds.observe(latency, kind)
+        metrics.googleBooksRequests.increment(kind, status)
+
+    # Delay before the next attempt, honoring the Retry-After header if Google sent one
+    def backoffDelay(self, attempt: int, response: requests.Response | None) -> float:
+        retryAfter = response.headers.get('Retry-After') if response is not None else None
+        if retryAfter and retryAfter.isdigit():
+            return min(float(retryAfter), self.backoffMax)
+        return random.uniform(0, min(self.backoffMax, self.backoffBase * 2 ** attempt))
+
+    # GET a URL, returning the response or None if the request ultimately failed
+    # Every attempt at an API request (any kind but cover) is admitted on its own, as each one counts against the quota
+    def fetch(self, url: str, params: dict | None = None, maxRetries: int | None = None, kind: str = 'cover') -> requests.Response | None:
+        maxRetries = self.maxRetries if maxRetries is None else maxRetries
+        for attempt in range(maxRetries + 1):
+            if kind != 'cover':
+                wait = self.admitAttempt(kind, attempt)
+                if wait is None:
+                    if attempt == 0:
+                        return None
+                    break
+                if wait:
+                    time.sleep(wait)
+            response = None
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params = params, timeout = self.timeout)
+                failure = f"{response.status_code} {response.reason}"
+                status = str(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                failure = status = f"{type(e).__name__}"
+            finally:
+                self.recordLatency(time.perf_counter() - start, kind, status)
+
+            if response is not None and response.status_code == 200:
+                return response
+            if (response is not None and response.status_code not in self.retryStatusCodes) or attempt == maxRetries:
+                break
+            delay = self.backoffDelay(attempt, response)
+            print(f"Request to Google Books failed with: {failure}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+        print(f"Request to Google Books failed with: {failure}")
+        return None
+
+    # Let an API request of a kind (search or volume) through the rate limit and the daily quota, returning how long to wait before sending it
+    # Searches leave part of both to volume fetches: they are refused with RateLimited rather than kept waiting, while volume
+    # fetches wait their turn and are only refused (None) once they would wait too long or the quota is used up
+    def admit(self, kind: str) -> float | None:
+        isSearch = kind == 'search'
+        if isSearch:
+            taken, wait = self.rateLimiter.take(GOOGLE_BOOKS_SEARCH_MAX_WAIT, GOOGLE_BOOKS_RESERVED_TOKENS)
+        else:
+            taken, wait = self.rateLimiter.take(GOOGLE_BOOKS_VOLUME_MAX_WAIT)
+        if not taken:
+            metrics.googleBooksThrottled.increment(kind, 'busy')
+            if isSearch:
+                raise RateLimited('busy', wait)
+            print(f"Request to Google Books refused, the rate limit would have delayed it by {wait:.1f}s")
+            return None
+        if not self.quota.use(useReserve = not isSearch):
+            metrics.googleBooksThrottled.increment(kind, 'quota')
+            if isSearch:
+                raise RateLimited('quota', self.quota.secondsUntilReset())
+            print(f"Request to Google Books refused, the daily quota of {self.quota.limit} requests is used up")
+            return None
+        return wait
+
+    # Let an attempt at an API request through admit(), retries give up (None) rather than raise RateLimited once refused
+    def admitAttempt(self, kind: str, attempt: int) -> float | None:
+        try:
+            return self.admit(kind)
+        except RateLimited:
+            if attempt == 0:
+                raise
+            return None
+
+    # GET an API resource, returning the decoded JSON body or None if the request ultimately failed
+    # Raises RateLimited if a search is refused by the rate limit or the daily quota
+    def get(self, resource: str, params: dict | None = None) -> dict | None:
+        queryParams = { **(params or {}), 'key': os.getenv('GOOGLE_BOOKS_API_KEY') }
+        response = self.fetch(f'{self.baseUrl}/{resource}', queryParams, kind = requestKind(resource))
+        return response.json() if response is not None else None
+
+    # Download a file (e.g. a cover image) without retrying, returning its contents or None if it failed
+    def download(self, url: str) -> bytes | None:
+        response = self.fetch(url, maxRetries = 0)
+        return response.content if response is not None else None
+
+client = GoogleBooksClient(
+    GOOGLE_BOOKS_TIMEOUT, GOOGLE_BOOKS_MAX_RETRIES, MAX_FETCH_WORKERS,
+    TokenBucket(GOOGLE_BOOKS_RATE, GOOGLE_BOOKS_BURST),
+    DailyQuota(constants.GOOGLE_BOOKS_DAILY_QUOTA, GOOGLE_BOOKS_QUOTA_RESERVE, GOOGLE_BOOKS_QUOTA_RESET_HOUR),
+)
+
+
+# Asyncio counterpart of GoogleBooksClient for the asyncio bot, built on aiohttp
+# Shares the settings and retry policy of the given synchronous client, and records its requests in the same metrics
+# aiohttp is only imported once the first request is made, so the synchronous bot does not depend on it
+class AsyncGoogleBooksClient:
+    def __init__(self, client: GoogleBooksClient):
+        self.client = client
+        self.session = None
+
+    async def getSession(self):
+        if self.session is None or self.session.closed:
+            import aiohttp
+            connectTimeout, readTimeout = self.client.timeout
+            self.session = aiohttp.ClientSession(
+                headers = dict(self.client.session.headers),
+                timeout = aiohttp.ClientTimeout(sock_connect = connectTimeout, sock_read = readTimeout),
+                connector = aiohttp.TCPConnector(limit = MAX_FETCH_WORKERS),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    # GET a URL, returning the response body or None if the request ultimately failed
+    async def fetch(self, url: str, params: dict | None = None, maxRetries: int | None = None, kind: str = 'cover') -> bytes | None:
+        import aiohttp
+        session = await self.getSession()
+        maxRetries = self.client.maxRetries if maxRetries is None else maxRetries
+        # aiohttp refuses None query parameters (e.g. a missing API key), requests silently drops them
+        params = { key: value for key, value in (params or {}).items() if value is not None }
+        for attempt in range(maxRetries + 1):
+            if kind != 'cover':
+                wait = self.client.admitAttempt(kind, attempt)
+                if wait is None:
+                    if attempt == 0:
+                        return None
+                    break
+                if wait:
+                    await asyncio.sleep(wait)
+            response = None
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                async with session.get(url, params = params) as response:
+                    failure = f"{response.status} {response.reason}"
+                    status = str(response.status)
+                    if response.status == 200:
+                        return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                failure = status = f"{type(e).__name__}"
+            finally:
+                self.client.recordLatency(time.perf_counter() - start, kind, status)
+
+            if (response is not None and response.status not in self.client.retryStatusCodes) or attempt == maxRetries:
+                break
+            delay = self.client.backoffDelay(attempt, response)
+            print(f"Request to Google Books failed with: {failure}, retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+        print(f"Request to Google Books failed with: {failure}")
+        return None
+
+    # GET an API resource, returning the decoded JSON body or None if the request ultimately failed
+    # Raises RateLimited if a search is refused by the rate limit or the daily quota
+    async def get(self, resource: str, params: dict | None = None) -> dict | None:
+        queryParams = { **(params or {}), 'key': os.getenv('GOOGLE_BOOKS_API_KEY') }
+        body = await self.fetch(f'{self.client.baseUrl}/{resource}', queryParams, kind = requestKind(resource))
+        return json.loads(body) if body is not None else None
 
-    titleMatch = re.search(regex['SUBMIT_TITLE'], input)
-    if titleMatch:
-        titleGroup = titleMatch.group(1)
-        searchTerms['intitle'] = re.sub(r"(\s+)", '+', titleGroup)
-        input = re.sub(regex['SUBMIT_TITLE'], '', input)
+asyncClient = AsyncGoogleBooksClient(client)
 
-    authorMatch = re.search(regex['SUBMIT_AUTHOR'], input)
-    if authorMatch:
-        authorGroup = authorMatch.group(1)
-        searchTerms['inauthor'] = re.sub(r"(\s+)", '+', authorGroup)
-        input = re.sub(regex['SUBMIT_AUTHOR'], '', input)
 
-    isbnMatch = re.search(regex['SUBMIT_ISBN'], input)
-    if isbnMatch:
-        searchTerms['isbn'] = isbnMatch.group(1)
-        input = re.sub(regex['SUBMIT_ISBN'], '', input)
+# Two-tier cache for processed book volumes: an in-process LRU backed by an optional persistent store
+# The store is expected to provide getVolume(volumeId) -> (BookVolume, fetchedAt) | None and saveVolume(BookVolume)
+class VolumeCache:
+    def __init__(self, maxSize: int, ttl: float):
+        self.ttl = ttl
+        self.memory = LRUCache(maxSize, ttl)
+        self.store = None
+        self.storeExecutor = None
+
+    # The executor is used to reach the store from asyncio code (None means the event loop's default executor)
+    def attachStore(self, store, executor = None):
+        self.store = store
+        self.storeExecutor = executor
+
+    # Return a cached volume if it is fresh (or any cached volume at all if allowStale is set)
+    def get(self, volumeId: str, allowStale: bool = False) -> types.BookVolume | None:
+        bookVolume = self.memory.get(volumeId, allowStale = allowStale)
+        if bookVolume or not self.store:
+            return bookVolume
+        result = self.store.getVolume(volumeId)
+        if not result:
+            return None
+        bookVolume, fetchedAt = result
+        if not allowStale and (time.time() - fetchedAt) >= self.ttl:
+            return None
+        self.memory.set(volumeId, bookVolume, fetchedAt)
+        return bookVolume
+
+    def put(self, bookVolume: types.BookVolume):
+        self.memory.set(bookVolume['id'], bookVolume)
+        if self.store:
+            self.store.saveVolume(bookVolume)
+
+    # Same as get(), but the store is only reached (on the store executor) if the volume is not in memory
+    async def getAsync(self, volumeId: str, allowStale: bool = False) -> types.BookVolume | None:
+        bookVolume = self.memory.get(volumeId, allowStale = allowStale)
+        if bookVolume or not self.store:
+            return bookVolume
+        return await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.get, volumeId, allowStale)
+
+    async def putAsync(self, bookVolume: types.BookVolume):
+        self.memory.set(bookVolume['id'], bookVolume)
+        if self.store:
+            await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.store.saveVolume, bookVolume)
+
+volumeCache = VolumeCache(VOLUME_CACHE_SIZE, VOLUME_CACHE_TTL)
+
+
+# Local catalog of the book volumes seen in search results or fetched from Google Books, which searches are answered from first
+# The store is expected to provide saveCatalogVolumes(bookVolumes) and searchCatalog(query, limit) -> BookVolumes, the catalog
+# is empty without one. The async methods reach the store on storeExecutor (None means the event loop's default executor)
+class Catalog:
+    def __init__(self):
+        self.store = None
+        self.storeExecutor = None
+
+    def attachStore(self, store, executor = None):
+        self.store = store
+        self.storeExecutor = executor
+
+    def add(self, bookVolumes: types.BookVolumes):
+        if self.store and bookVolumes:
+            self.store.saveCatalogVolumes(bookVolumes)
+
+    def search(self, query: types.SearchQuery, limit: int) -> types.BookVolumes:
+        return self.store.searchCatalog(query, limit) if self.store else []
+
+    # Whether the catalog's results answer a search without asking Google Books, which is only the case for an isbn they have
+    # Other matches are only as good as the full-text ranking, so those searches go to Google Books without searching the catalog
+    def isExactMatch(self, query: types.SearchQuery, results: types.BookVolumes) -> bool:
+        return bool(query['isbn']) and any(query['isbn'] in (bookVolume.get('isbns') or []) for bookVolume in results)
+
+    async def addAsync(self, bookVolumes: types.BookVolumes):
+        if self.store and bookVolumes:
+            await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.store.saveCatalogVolumes, bookVolumes)
+
+    async def searchAsync(self, query: types.SearchQuery, limit: int) -> types.BookVolumes:
+        if not self.store:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.store.searchCatalog, query, limit)
+
+catalog = Catalog()
+# Search results keyed by normalized search string, along with the searches currently waiting on Google Books
+searchCache = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+metrics.registry.registerCache('volumes', volumeCache.memory)
+metrics.registry.registerCache('searches', searchCache)
+searchesInFlight = InFlight()
+asyncSearchesInFlight = AsyncInFlight()
+# Searches each user can send to Google Books, on top of the rate limit shared by everyone
+userSearchLimits = KeyedTokenBuckets(1 / USER_SEARCH_INTERVAL, USER_SEARCH_BURST, USER_SEARCH_LIMIT_SIZE)
+# Long-lived pool for parallel volume fetches, so that its threads (and their database connections) are reused
+fetchExecutor = ThreadPoolExecutor(max_workers = MAX_FETCH_WORKERS, thread_name_prefix = 'volume-fetch')
+
+
+# Split the user input into its general search terms and the values of the title, author and isbn tags
+def parseSearchQuery(input: str) -> types.SearchQuery:
+    query: types.SearchQuery = { 'general': '', 'title': None, 'author': None, 'isbn': None }
+    input = re.sub(r"(/search )", '', input)
+    for field, pattern in [('title', 'SUBMIT_TITLE'), ('author', 'SUBMIT_AUTHOR'), ('isbn', 'SUBMIT_ISBN')]:
+        match = re.search(regex[pattern], input)
+        if match:
+            query[field] = match.group(1)
+            input = re.sub(regex[pattern], '', input)
+    query['general'] = input.strip()
+    return query
+
+
+# Build a search string matching the google books API specifications from a search query
+def buildSearchString(query: types.SearchQuery) -> str:
+    searchTerms = {}
+    if query['title'] is not None:
+        searchTerms['intitle'] = re.sub(r"(\s+)", '+', query['title'])
+    if query['author'] is not None:
+        searchTerms['inauthor'] = re.sub(r"(\s+)", '+', query['author'])
+    if query['isbn'] is not None:
+        searchTerms['isbn'] = query['isbn']
 
     searchString = ''
-    generalTerms = re.sub(r"(\s+)", '+', input.strip())
+    generalTerms = re.sub(r"(\s+)", '+', query['general'])
     if generalTerms:
         searchString += generalTerms + '+'
     if len(searchTerms) > 0:
@@ -38,6 +346,16 @@ def parseSearchTerms(input: str):
     return searchString
 
 
+# Process the user input string to build a search string matching the google books API specifications
+def parseSearchTerms(input: str):
+    return buildSearchString(parseSearchQuery(input))
+
+
+# Collapse repeated/trailing separators so that trivially different inputs produce the same search string
+def normalizeSearchString(searchString: str) -> str:
+    return re.sub(r"\++", '+', searchString).strip('+')
+
+
 # Process book volumes collected from Google Books API
 def processBookVolumes(items: dict) -> types.BookVolumes:
     results = []
@@ -55,47 +373,283 @@ def processBookVolumes(items: dict) -> types.BookVolumes:
             'pageCount': item['volumeInfo'].get('pageCount'),
             'googleBooksLink': f"https://books.google.pl/books?id={item.get('id')}",
             'imageLink': imageLink,
+            'isbns': [identifier['identifier'] for identifier in item['volumeInfo'].get('industryIdentifiers', []) if identifier.get('type') in ('ISBN_10', 'ISBN_13')],
         })
 
     return results
 
 
-# Find books based on user input
-def findBookVolumes(input: str) -> tuple[int, types.BookVolumes]:
-    queryParams = {
-        'q': parseSearchTerms(input),
+# Query Google Books for a page of a search string's results, caching successful responses under the given key
+# The request is charged to userId's search limit, searches sharing it through searchesInFlight are not
+def searchBookVolumes(searchString: str, cacheKey: tuple[str, int], startIndex: int = 0, userId: int | None = None) -> tuple[int, types.BookVolumes] | None:
+    # Another caller may have finished the same search just before this one was started
+    cached = searchCache.get(cacheKey)
+    if cached:
+        return cached
+
+    checkSearchLimit(userId)
+    result = client.get('volumes', searchParams(searchString, startIndex))
+    if not result:
+        return None
+
+    numFound, bookVolumes = processSearchResult(result, cacheKey)
+    catalog.add(bookVolumes)
+    return numFound, bookVolumes
+
+
+# Query parameters of a Google Books search, for the page of results starting at startIndex
+def searchParams(searchString: str, startIndex: int = 0) -> dict:
+    return {
+        'q': searchString,
+        'startIndex': startIndex,
         'maxResults': MAX_SEARCH_RESULTS,
         'orderBy': 'relevance',
-        'key': os.getenv('GOOGLE_BOOKS_API_KEY')
-    } 
-    r = requests.request(method = 'GET', url = 'https://www.googleapis.com/books/v1/volumes', params = queryParams)
-    if r.status_code != 200:
-        print(f"Request to Google Books API failed with: {r.status_code} {r.reason}")
-        return 0, []
-
-    numFound = r.json()['totalItems']
-    if numFound == 0:
-        return 0, []
-    bookVolumes = processBookVolumes(r.json()['items'])
+    }
+
+
+# Key of a page of a search in the search cache, also identifying the request fetching it while it is in flight
+def searchCacheKey(searchString: str, startIndex: int) -> tuple[str, int]:
+    return searchString.casefold(), startIndex
+
+
+# startIndex of the page following a page of a search's results, None if that was the last one
+def nextSearchIndex(startIndex: int, numFound: int, bookVolumes: types.BookVolumes) -> int | None:
+    nextIndex = startIndex + MAX_SEARCH_RESULTS
+    return nextIndex if bookVolumes and nextIndex < numFound else None
+
+
+# Process the response to a Google Books search and cache it under the given key
+def processSearchResult(result: dict, cacheKey: tuple[str, int]) -> tuple[int, types.BookVolumes]:
+    numFound = result['totalItems']
+    if numFound == 0 or not result.get('items'):
+        numFound, bookVolumes = 0, []
+    else:
+        bookVolumes = processBookVolumes(result['items'])
+    searchCache.set(cacheKey, (numFound, bookVolumes))
 
     return numFound, bookVolumes
 
 
-# Find books based on user input
-def getBookVolume(volumeId: str) -> types.BookVolume | None:
-    queryParams = {
-        'key': os.getenv('GOOGLE_BOOKS_API_KEY')
-    } 
-    r = requests.request(method = 'GET', url = f'https://www.googleapis.com/books/v1/volumes/{volumeId}', params = queryParams)
-    if r.status_code != 200:
-        print(f"Request to Google Books API failed with: {r.status_code} {r.reason}")
+# Asyncio counterpart of searchBookVolumes
+async def searchBookVolumesAsync(searchString: str, cacheKey: tuple[str, int], startIndex: int = 0, userId: int | None = None) -> tuple[int, types.BookVolumes] | None:
+    cached = searchCache.get(cacheKey)
+    if cached:
+        return cached
+
+    checkSearchLimit(userId)
+    result = await asyncClient.get('volumes', searchParams(searchString, startIndex))
+    if not result:
+        return None
+
+    numFound, bookVolumes = processSearchResult(result, cacheKey)
+    await catalog.addAsync(bookVolumes)
+    return numFound, bookVolumes
+
+
+# Count a search which is about to reach Google Books against the user's limit, raising RateLimited if they are over it
+def checkSearchLimit(userId: int | None):
+    if userId is None:
+        return
+    taken, wait = userSearchLimits.take(userId)
+    if not taken:
+        metrics.googleBooksThrottled.increment('search', 'user')
+        raise RateLimited('user', wait)
+
+
+# A page of a search's Google Books results starting at startIndex, None if the request failed
+# Pages are served from the search cache and identical concurrent requests share one, only the request which reaches Google
+# Books counts against its user's limit and RateLimited is raised if they (or everyone) search too often
+# A request refused by its user's limit is not shared: the requests waiting on it are sent again, on behalf of their own users
+def searchGoogleBooks(query: types.SearchQuery, startIndex: int, userId: int | None = None) -> tuple[int, types.BookVolumes] | None:
+    searchString = normalizeSearchString(buildSearchString(query))
+    cacheKey = searchCacheKey(searchString, startIndex)
+    while True:
+        result = searchCache.get(cacheKey)
+        if result:
+            return result
+        sent = False
+        def search():
+            nonlocal sent
+            sent = True
+            return searchBookVolumes(searchString, cacheKey, startIndex, userId)
+        try:
+            return searchesInFlight.do(cacheKey, search)
+        except RateLimited as e:
+            if e.reason != 'user' or sent:
+                raise
+
+
+# Asyncio counterpart of searchGoogleBooks
+async def searchGoogleBooksAsync(query: types.SearchQuery, startIndex: int, userId: int | None = None) -> tuple[int, types.BookVolumes] | None:
+    searchString = normalizeSearchString(buildSearchString(query))
+    cacheKey = searchCacheKey(searchString, startIndex)
+    while True:
+        result = searchCache.get(cacheKey)
+        if result:
+            return result
+        sent = False
+        def search():
+            nonlocal sent
+            sent = True
+            return searchBookVolumesAsync(searchString, cacheKey, startIndex, userId)
+        try:
+            return await asyncSearchesInFlight.do(cacheKey, search)
+        except RateLimited as e:
+            if e.reason != 'user' or sent:
+                raise
+
+
+# Find books based on user input, returning the number of results, the first of them and the startIndex of the Google
+# Books page to continue with (None if there is nothing more to fetch), see findMoreBookVolumes
+# Searches for an isbn the local catalog has are answered by it, Google Books only being asked once the user pages past them.
+# Other searches list Google Books' results as it ranked them, the catalog is only searched for them when Google Books cannot
+# be reached. RateLimited is raised if the search cannot reach Google Books and the catalog has nothing to offer instead
+def findBookVolumes(input: str, userId: int | None = None) -> tuple[int, types.BookVolumes, int | None]:
+    query = parseSearchQuery(input)
+    if query['isbn']:
+        localResults = catalog.search(query, MAX_SEARCH_RESULTS)
+        if catalog.isExactMatch(query, localResults):
+            return len(localResults), localResults, 0
+
+    try:
+        result = searchGoogleBooks(query, 0, userId)
+    except RateLimited:
+        localResults = catalog.search(query, MAX_SEARCH_RESULTS)
+        if localResults:
+            return len(localResults), localResults, 0
+        raise
+
+    # After a failed request Google Books is asked again once the user pages past the catalog's results
+    if result is None:
+        localResults = catalog.search(query, MAX_SEARCH_RESULTS)
+        return len(localResults), localResults, 0
+    numFound, results = result
+    return numFound, results, nextSearchIndex(0, numFound, results)
+
+
+# Asyncio counterpart of findBookVolumes, sharing its catalog and search cache
+async def findBookVolumesAsync(input: str, userId: int | None = None) -> tuple[int, types.BookVolumes, int | None]:
+    query = parseSearchQuery(input)
+    if query['isbn']:
+        localResults = await catalog.searchAsync(query, MAX_SEARCH_RESULTS)
+        if catalog.isExactMatch(query, localResults):
+            return len(localResults), localResults, 0
+
+    try:
+        result = await searchGoogleBooksAsync(query, 0, userId)
+    except RateLimited:
+        localResults = await catalog.searchAsync(query, MAX_SEARCH_RESULTS)
+        if localResults:
+            return len(localResults), localResults, 0
+        raise
+
+    # After a failed request Google Books is asked again once the user pages past the catalog's results
+    if result is None:
+        localResults = await catalog.searchAsync(query, MAX_SEARCH_RESULTS)
+        return len(localResults), localResults, 0
+    numFound, results = result
+    return numFound, results, nextSearchIndex(0, numFound, results)
+
+
+# Fetch the Google Books page of a search starting at startIndex, as the user pages through its results
+# Returns the number of results, the page's results and the startIndex of the next page (None if this was the last one),
+# or None if the request failed. Raises RateLimited like findBookVolumes
+def findMoreBookVolumes(input: str, startIndex: int, userId: int | None = None) -> tuple[int, types.BookVolumes, int | None] | None:
+    result = searchGoogleBooks(parseSearchQuery(input), startIndex, userId)
+    if result is None:
+        return None
+    numFound, bookVolumes = result
+    return numFound, bookVolumes, nextSearchIndex(startIndex, numFound, bookVolumes)
+
+
+# Asyncio counterpart of findMoreBookVolumes
+async def findMoreBookVolumesAsync(input: str, startIndex: int, userId: int | None = None) -> tuple[int, types.BookVolumes, int | None] | None:
+    result = await searchGoogleBooksAsync(parseSearchQuery(input), startIndex, userId)
+    if result is None:
         return None
+    numFound, bookVolumes = result
+    return numFound, bookVolumes, nextSearchIndex(startIndex, numFound, bookVolumes)
 
-    bookVolume = processBookVolumes([r.json()])[0]
+
+# Get a specific book volume, served from the volume cache unless it is missing or due for a refresh
+def getBookVolume(volumeId: str) -> types.BookVolume | None:
+    bookVolume = volumeCache.get(volumeId)
+    if bookVolume:
+        return bookVolume
+
+    result = client.get(f'volumes/{volumeId}')
+    if not result:
+        # Fall back to an outdated copy of the volume rather than nothing at all
+        return volumeCache.get(volumeId, allowStale = True)
+
+    bookVolume = processBookVolumes([result])[0]
+    volumeCache.put(bookVolume)
+    catalog.add([bookVolume])
 
     return bookVolume
 
 
+# Asyncio counterpart of getBookVolume, sharing its volume cache
+async def getBookVolumeAsync(volumeId: str) -> types.BookVolume | None:
+    bookVolume = await volumeCache.getAsync(volumeId)
+    if bookVolume:
+        return bookVolume
+
+    result = await asyncClient.get(f'volumes/{volumeId}')
+    if not result:
+        return await volumeCache.getAsync(volumeId, allowStale = True)
+
+    bookVolume = processBookVolumes([result])[0]
+    await volumeCache.putAsync(bookVolume)
+    await catalog.addAsync([bookVolume])
+
+    return bookVolume
+
+
+# Get several book volumes at once, fetching the ones missing from the cache in parallel
+# Returns the volumes that were found (in the order of the given IDs) and an error for each one that was not
+def getBookVolumes(volumeIds: list[str]) -> tuple[dict[str, types.BookVolume], dict[str, str]]:
+    uniqueIds = list(dict.fromkeys(volumeIds))
+    bookVolumes: dict[str, types.BookVolume] = {}
+    errors: dict[str, str] = {}
+    if not uniqueIds:
+        return bookVolumes, errors
+
+    futures = { volumeId: fetchExecutor.submit(getBookVolume, volumeId) for volumeId in uniqueIds }
+    for volumeId, future in futures.items():
+        try:
+            bookVolume = future.result()
+        except Exception as e:
+            errors[volumeId] = str(e)
+            continue
+        if bookVolume:
+            bookVolumes[volumeId] = bookVolume
+        else:
+            errors[volumeId] = 'Volume could not be fetched from Google Books.'
+
+    return bookVolumes, errors
+
+
+# Asyncio counterpart of getBookVolumes, fetching the missing volumes concurrently
+async def getBookVolumesAsync(volumeIds: list[str]) -> tuple[dict[str, types.BookVolume], dict[str, str]]:
+    uniqueIds = list(dict.fromkeys(volumeIds))
+    bookVolumes: dict[str, types.BookVolume] = {}
+    errors: dict[str, str] = {}
+    if not uniqueIds:
+        return bookVolumes, errors
+
+    results = await asyncio.gather(*[getBookVolumeAsync(volumeId) for volumeId in uniqueIds], return_exceptions = True)
+    for volumeId, result in zip(uniqueIds, results):
+        if isinstance(result, BaseException):
+            errors[volumeId] = str(result)
+        elif result:
+            bookVolumes[volumeId] = result
+        else:
+            errors[volumeId] = 'Volume could not be fetched from Google Books.'
+
+    return bookVolumes, errors
+
+
 def formatAuthors(authors: list[str], prefix: str = '') -> str:
     if not authors:
         return ''
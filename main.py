@@ -1,142 +1,163 @@
 import telebot
-import re
-import os
+import sys
 
 import customTypes as types
 import constants
 import library
-import db
-import submissionReport
+import botSetup
 import voting
+import commands
+import metrics
+import webhook
+from searchResults import SearchSession
+from rateLimit import RateLimited
 
 
-if __name__ == '__main__':
-    bot = telebot.TeleBot(constants.secrets['TELEGRAM_TOKEN'], parse_mode="Markdown")
-    bookClubDB = db.BookClubDB()
-    userSearchResults: types.UserSearchResults = {}
+# The bot is created on import so that the module can be re-imported by the report rendering processes
+# Its token is only set by setup(), importing the module needs no secrets
+# Middleware is used to record the profiles of users sending messages
+telebot.apihelper.ENABLE_MIDDLEWARE = True
+bot = telebot.TeleBot('', parse_mode="Markdown", validate_token = False)
 
+# Load the secrets, then create the database and the state shared by the handlers, done by the entry point (or a benchmark)
+# rather than on import
+def setup():
+    global bookClubDB, clubs, userProfiles, userSearchResults, chapterExecutor
+    bookClubDB, _, clubs, userProfiles, userSearchResults, chapterExecutor = botSetup.setup(bot)
 
-# Get telegram formatted user mention
-def userMention(user: telebot.types.User):
-    return f"[{user.first_name}](tg://user?id={str(user.id)})"
 
 # Get dictionary of user mentions based on user IDs
 def getUserMentions(chatId, userIds: list[int]):
-    return { userId: (userMention(bot.get_chat_member(chatId, userId).user)) for userId in userIds }
+    return { userId: commands.userMention(userId, firstName) for userId, firstName in getUserNames(chatId, userIds).items() }
 
-# Get dictionary of user names based on user IDs
+# Get dictionary of user names based on user IDs, asking Telegram only about users missing from the profile cache
 def getUserNames(chatId, userIds: list[int]):
-    return { userId: bot.get_chat_member(chatId, userId).user.first_name for userId in userIds }
-
-# Helper function for gating access to commands
-def commandAllowed(message: telebot.types.Message, requirements: types.CommandRequirements):
-    user = message.from_user
-    if not user:
-        bot.reply_to(message, "You are not a real user. Go away.")
-        return False
-    if message.chat.type != 'private' and message.chat.id != int(constants.secrets['MASTER_CHAT_ID']):
-        bot.reply_to(message, f"I am configured for use in a different chat.")
-        return False
-    if requirements.get('chatTypes') and (not message.chat.type in requirements.get('chatTypes')):
-        bot.reply_to(message, f"This command is only allowed for messages in one of these contexts: [{requirements.get('chatTypes')}]")
+    return userProfiles.getFirstNames(list(userIds), lambda userId: bot.get_chat_member(chatId, userId).user)
+
+# Get the user IDs of a group's admins
+def getChatAdmins(chatId) -> list[int]:
+    return [member.user.id for member in bot.get_chat_administrators(chatId)]
+
+# Send a table as one or more text messages, or as images if it is too wide to read as text
+def sendTable(chatId: int, table: types.Table, fileName: str):
+    if voting.isWideTable(table):
+        images = voting.drawTableImages(table)
+        for imageIdx, image in enumerate(images):
+            suffix = f'-{imageIdx + 1}' if len(images) > 1 else ''
+            bot.send_document(chatId, image, visible_file_name = f'{fileName}{suffix}.png')
+    else:
+        for tableMessage in voting.drawTable(table):
+            bot.send_message(chatId, tableMessage, parse_mode = 'html')
+
+# Run a function on the background executor, printing any exception it raises as nothing waits for its result
+def runInBackground(function, *args):
+    def reportFailure(future):
+        if future.exception() is not None:
+            print(f"Background task {function.__name__} failed: {future.exception()}")
+    chapterExecutor.submit(function, *args).add_done_callback(reportFailure)
+
+# Helper function for gating access to commands of the club with the given chat ID
+def commandAllowed(message: telebot.types.Message, chatId: int, requirements: types.CommandRequirements):
+    isAdmin = bool(requirements.get('onlyAdmin') and message.from_user and clubs.isAdmin(chatId, message.from_user.id, getChatAdmins))
+    rejection = commands.commandRejection(bookClubDB, message, requirements, chatId, isAdmin)
+    if rejection:
+        bot.reply_to(message, rejection)
         return False
-    if requirements.get('activeMeeting'):
-        try:
-            bookClubDB.getActiveMeetingId()
-        except:
-            bot.reply_to(message, f'There is no active meeting. My daddy needs to initiate a new meeting to begin the process.')
-            return False
-    if requirements.get('onlyMasterUser') and (message.from_user.id != int(constants.secrets['MASTER_USER_ID'])):
-        bot.reply_to(message, f'Only daddy can tell me to do that ( ͡° ͜ʖ ͡°)')
-        return False
-    if requirements.get('stage'):
-        activeMeetingId = bookClubDB.getActiveMeetingId()
-        (stage, _) = bookClubDB.getMeeting(activeMeetingId)
-        if stage != requirements.get('stage'):
-            bot.reply_to(message, f"This command requires the active stage to be {requirements.get('stage')}, but it is currently {stage}.")
-            return False
     return True
 
 
+# Record the profile of every user sending a message, keeping the user profile cache warm, and the club they are in
+@bot.middleware_handler(update_types=['message'])
+def observeUser(botInstance: telebot.TeleBot, message: telebot.types.Message):
+    if message.from_user:
+        userProfiles.observe(message.from_user)
+        clubs.observe(message)
+
+
 # Print message with instructions on how the bot operates
 @bot.message_handler(commands=['instructions'])
+@metrics.timeHandler
 def printInstructions(message: telebot.types.Message):
-    instructionsMsg = "I am the *Book Club Bot* developed by *stygio* ([see here for more info](https://github.com/stygio/book-club-bot)).\n\n"
-
-    instructionsMsg += "Once the admin creates a new meeting, there are two stages: submitting books and voting on books.\n\n"
-
-    instructionsMsg += "During the *submit* stage, users submit 1 book for the active meeting.\n"
-    instructionsMsg += "Find your book using the `/search <search query>` command. Once it appears in the results, choose it using the `/choose <number>` command.\n"
-    instructionsMsg += "You can repeat this process and choose a different book if this phase is still ongoing.\n"
-    instructionsMsg += "At the end of this phase, a submission report will be generated in PDF format with an overview of the submitted books.\n\n"
-
-    instructionsMsg += "During the *vote* stage, users vote on 3 books submitted for the active meeting in order of preferrence.\n"
-    instructionsMsg += "Vote on books in order of preferrence using the `/vote <number> <number> <number>` command.\n"
-    instructionsMsg += "A winner is chosen using [Ranked-choice voting](https://ballotpedia.org/Ranked-choice_voting).\n"
-    instructionsMsg += "You can repeat this process and change your vote if this phase is still ongoing.\n"
-    instructionsMsg += "At the end of this phase, a table of votes will be generated and a winner will be chosen for the active meeting.\n\n"
-
-    instructionsMsg += "The admin has some additional commands available to them. For a full list of commands with explanations, type `/commands` in a private chat with me."
-
-    bot.reply_to(message, instructionsMsg)
+    bot.reply_to(message, commands.instructionsMessage())
 
 
 # Print message with possible commands
 @bot.message_handler(commands=['commands'])
+@metrics.timeHandler
 def printCommands(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
         'chatTypes': ['private'],
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
+        return
+
+    bot.reply_to(message, commands.commandsMessage())
+
+
+# List the clubs of the user, or switch to a different one
+@bot.message_handler(commands=['club'])
+@metrics.timeHandler
+def club(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+    }
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
 
-    commandsMsg = "Here is a list of valid commands and their requirements.\n\n"
-    commandsMsg += "Most commands have a list of tags (a: admin only, m: active meeting required, p: private chat, g: group chat, s: submissions stage, v: voting stage)\n\n"
-    commandsMsg += "*instructions*: Prints a message with an overview of how I operate.\n\n"
-    commandsMsg += "*commands* (p): Prints this message with possible commands.\n\n"
-    commandsMsg += "*checkStatus* (g): Prints the current status of the meeting.\n\n"
-    commandsMsg += "*newMeeting* (a/g): Initiates a new meeting.\n\n"
-    commandsMsg += "*search* (m/p/s): Search the Google Books collection for a book. I will return up to 10 results. If you don't find your book, please try again with a different query. You can enter search terms directly or use the (title, author, isbn) tags to be more specific. Examples:\n`/search tolkien lord rings`\n`/search title:\"city of thieves\" author:\"david benioff\"`\n`/search isbn:9788373899292`\n\n"
-    commandsMsg += "*choose* (m/p/s): Choose one of the options I returned based on your search using its number in the list of results. Example:\n`/choose 4`\n\n"
-    commandsMsg += "*finishSubmissions* (a/m/g/s): Complete the submit stage and begin the vote stage.\n\n"
-    commandsMsg += "*vote* (m/p/v): Vote on 3 books in order of preferrence based on their numbers in the submission report. Example:\n`/vote 5 10 2`\n\n"
-    commandsMsg += "*finishVoting* (a/m/g/v): Complete the vote stage."
+    userClubs = clubs.getClubs(message.from_user.id)
+    if not message.text.strip().removeprefix('/club').strip():
+        bot.reply_to(message, commands.clubsReply(userClubs, chatId))
+        return
+    chosenChatId, error = commands.parseClubChoice(message.text, userClubs)
+    if error:
+        bot.reply_to(message, error)
+        return
 
-    bot.reply_to(message, commandsMsg)
+    clubs.selectClub(message.from_user.id, chosenChatId)
+    bot.reply_to(message, commands.clubsReply(clubs.getClubs(message.from_user.id), chosenChatId))
 
 
 # Check the current status of the meeting
 @bot.message_handler(commands=['checkStatus'])
+@metrics.timeHandler
 def checkStatus(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
-        'chatTypes': ['group', 'supergroup'],
+        'chatTypes': ['private', 'group', 'supergroup'],
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
 
     # Check for active meeting
     try:
-        activeMeetingId = bookClubDB.getActiveMeetingId()
+        activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
     except:
-        bot.reply_to(message, f'There is no active meeting. My daddy needs to initiate a new meeting to begin the process.')
+        bot.reply_to(message, f'There is no active meeting. An admin needs to initiate a new meeting to begin the process.')
         return
 
     # Check the stage of the meeting
-    [stage, volumeId] = bookClubDB.getMeeting(activeMeetingId)
+    [stage, volumeId] = bookClubDB.getMeeting(chatId, activeMeetingId)
     match stage:
         case 'submit':
-            submissionsData = bookClubDB.getSubmissions(activeMeetingId)
-            # print(submissionsData)
-            usersWhoSubmitted = [userId for userId, _, _ in submissionsData]
-            # print(usersWhoSubmitted)
-            userMentions = ', '.join(getUserMentions(message.chat.id, usersWhoSubmitted).values())
+            usersWhoSubmitted = bookClubDB.getSubmitters(chatId)
+            userMentions = ', '.join(getUserMentions(chatId, usersWhoSubmitted).values())
             bot.reply_to(message, f'I am currently collecting submissions for meeting {activeMeetingId}\nThe following users have submitted books: {userMentions}')
             return
         case 'vote':
-            votesData = bookClubDB.getVotes(activeMeetingId)
-            usersWhoVoted = [userId for userId, _, _, _ in votesData]
-            userMentions = ', '.join(getUserMentions(message.chat.id, usersWhoVoted).values())
-            bot.reply_to(message, f'I am currently collecting votes for meeting {activeMeetingId}.\nThe following users have voted: {userMentions}')
+            usersWhoVoted = bookClubDB.getVoters(chatId)
+            userMentions = ', '.join(getUserMentions(chatId, usersWhoVoted).values())
+            reply = f'I am currently collecting votes for meeting {activeMeetingId}.\nThe following users have voted ({len(usersWhoVoted)} so far): {userMentions}'
+            # The projected winner is only revealed to admins, in private
+            if message.chat.type == 'private' and usersWhoVoted and clubs.isAdmin(chatId, message.from_user.id, getChatAdmins):
+                _, voteResult = bookClubDB.getTally(chatId)
+                leaderVolume = library.getBookVolume(bookClubDB.getSubmissionVolumeId(chatId, voteResult['winner']))
+                reply += '\n\n' + commands.projectionReply(voteResult, bookClubDB.getFirstPreferences(chatId), leaderVolume)
+            bot.reply_to(message, reply)
+            return
+        case 'report':
+            bot.reply_to(message, f'I am rendering the submission report for meeting {activeMeetingId}, the vote stage begins once it has been sent.')
             return
         case 'organized':
             bookVolume = library.getBookVolume(volumeId)
@@ -148,186 +169,284 @@ def checkStatus(message: telebot.types.Message):
 
 # Initiate a new meeting
 @bot.message_handler(commands=['newMeeting'])
+@metrics.timeHandler
 def newMeeting(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
         'chatTypes': ['group', 'supergroup'],
-        'onlyMasterUser': True,
+        'onlyAdmin': True,
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
 
-    bookClubDB.newMeeting()
-    activeMeetingId = bookClubDB.getActiveMeetingId()
+    bookClubDB.newMeeting(chatId)
+    activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
     
     bot.reply_to(message, f'I have initiated meeting number {activeMeetingId} for the book club.')
 
 # Begin the process of submitting a book
 @bot.message_handler(commands=['search'])
+@metrics.timeHandler
 def search(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
         'chatTypes': ['private'],
         'activeMeeting': True,
         'stage': 'submit',
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
 
-    numFound, searchResults = library.findBookVolumes(message.text)
-    if numFound == 0:
+    try:
+        numFound, searchResults, nextIndex = library.findBookVolumes(message.text, message.from_user.id)
+    except RateLimited as e:
+        bot.reply_to(message, commands.slowDownReply(e))
+        return
+    if not searchResults:
         bot.reply_to(message, "No results found, please try again.")
         return
 
-    userSearchResults[message.from_user.id] = searchResults
-    replyString = f'I found {numFound} results for your search'
-    replyString += f', these are the top {constants.MAX_SEARCH_RESULTS}:\n' if numFound > constants.MAX_SEARCH_RESULTS else ':\n'
-    # This loop shortens the results if needed (rare) so as to respect Telegram's 4096 character limit per message
-    while True:
-        tmpReplyString = replyString + library.formatBookVolumeList(searchResults)
-        if len(tmpReplyString) < 4096:
-            replyString = tmpReplyString
+    session = commands.addSearchPage(SearchSession.new(message.text, numFound, searchResults, nextIndex))
+    userSearchResults.save(message.from_user.id, session)
+    replyString, keyboard = commands.searchPageReply(session, 0)
+
+    bot.reply_to(message, replyString, reply_markup = keyboard)
+
+
+# List the next page of a search, first fetching more results from Google Books if there are not enough left for a full page
+# The page is not added if there are no results left to list (e.g. Google Books could not be reached), raises RateLimited
+def listNextSearchPage(session: SearchSession, userId: int) -> SearchSession:
+    for _ in range(constants.SEARCH_PAGE_MAX_FETCHES):
+        if not session.needsResults(constants.MAX_SEARCH_RESULTS):
+            break
+        moreResults = library.findMoreBookVolumes(session.input, session.nextIndex, userId)
+        if moreResults is None:
             break
-        searchResults = searchResults[:-1]
+        session = session.withResults(*moreResults)
+    return commands.addSearchPage(session) or session
+
+# Show another page of search results in place of the current one, when the user presses one of its buttons
+# Pages are listed (and their results fetched) the first time they are shown, afterwards they are shown as they were
+@bot.callback_query_handler(func = lambda call: commands.parseSearchPage(call.data) is not None)
+@metrics.timeHandler
+def searchPage(call: telebot.types.CallbackQuery):
+    searchId, pageIdx = commands.parseSearchPage(call.data)
+    userId = call.from_user.id
+    session = userSearchResults.get(userId)
+    if session and session.searchId == searchId and pageIdx == len(session.pageEnds):
+        try:
+            session = listNextSearchPage(session, userId)
+        except RateLimited as e:
+            bot.answer_callback_query(call.id, commands.slowDownReply(e), show_alert = True)
+            return
+        userSearchResults.save(userId, session)
 
-    bot.reply_to(message, replyString)
+    shownPageIdx, alert = commands.searchPageToShow(session, searchId, pageIdx)
+    if shownPageIdx is not None:
+        replyString, keyboard = commands.searchPageReply(session, shownPageIdx)
+        try:
+            bot.edit_message_text(replyString, call.message.chat.id, call.message.message_id, reply_markup = keyboard)
+        except telebot.apihelper.ApiTelegramException as e:
+            # Pressing a button twice asks for the page which is already shown
+            if 'message is not modified' not in e.description:
+                raise
+    bot.answer_callback_query(call.id, alert, show_alert = alert is not None)
 
 
 # Submit a book from the user's previous search result
 @bot.message_handler(commands=['choose'])
+@metrics.timeHandler
 def chooseSubmission(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
         'chatTypes': ['private'],
         'activeMeeting': True,
         'stage': 'submit',
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
     userId = message.from_user.id
 
-    chooseMatch = re.match(constants.regex['CHOOSE'], message.text)
-    if not chooseMatch:
-        bot.reply_to(message, 'Your message does not conform to the expected format of `/choose <number>`.')
-        return
-    searchResults = userSearchResults.get(userId)
-    if not searchResults:
-        bot.reply_to(message, 'You have no search results to choose from. Have you used the `/search <search expression>` command yet?')
-        return
-    # User input is indexed 1-10, array is indexed 0-9
-    choiceStr = chooseMatch.group(1)
-    choiceIdx = int(choiceStr) - 1
-    if not (choiceIdx >= 0 and choiceIdx < len(searchResults)):
-        bot.reply_to(message, f'Your choice ({choiceStr}) is not valid, expected something in the range of 1 - {len(searchResults)}.')
+    session = userSearchResults.get(userId)
+    searchResults = session.listed() if session else None
+    choiceIdx, error = commands.parseChoice(message.text, searchResults)
+    if error:
+        bot.reply_to(message, error)
         return
 
-    bookClubDB.submitBook(userId, searchResults[choiceIdx]['id'])
+    volumeId = searchResults[choiceIdx]['id']
+    if not bookClubDB.submitBook(chatId, userId, volumeId):
+        bot.reply_to(message, 'Submissions for the active meeting have just been closed, so I could not save your choice.')
+        return
+    chapterExecutor.submit(commands.prepareSubmissionChapter, bookClubDB, chatId, bookClubDB.getActiveMeetingId(chatId), userId, volumeId)
     replyString = f"I saved your choice of {library.formatBookVolume(searchResults[choiceIdx])}."
 
     bot.reply_to(message, replyString)
 
-
 # Finalize the submit stage, generate a submission report and begin the vote stage
 @bot.message_handler(commands=['finishSubmissions'])
+@metrics.timeHandler
 def finishSubmissions(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
         'chatTypes': ['group', 'supergroup'],
         'activeMeeting': True,
-        'onlyMasterUser': True,
+        'onlyAdmin': True,
         'stage': 'submit',
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
 
     # Generate report
-    activeMeetingId = bookClubDB.getActiveMeetingId()
-    submissions = { submissionId: library.getBookVolume(volumeId) for (_, submissionId, volumeId) in bookClubDB.getSubmissions(activeMeetingId) }
-    if len(submissions.keys()) == 0:
+    activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
+    if bookClubDB.getSubmissionCount(chatId) == 0:
         bot.reply_to(message, f'No submissions found, please submit some books for the active meeting.')
         return
-    submissionReportFilePath = submissionReport.generate(activeMeetingId, submissions)
-    with open(submissionReportFilePath, 'rb') as doc:
-        bot.send_document(message.chat.id, doc, None, f"Meeting {activeMeetingId} of the Wild Frog Book Club: Submission Overview")
-    os.remove(submissionReportFilePath)
-    # Begin vote stage
-    bookClubDB.startVoting()
+    # Close the submissions first, so that the report and the ballot of the vote stage list the same books
+    if not bookClubDB.closeSubmissions(chatId):
+        bot.reply_to(message, f'I am already rendering the submission report for meeting {activeMeetingId}, please be patient.')
+        return
+    try:
+        submissionsData = bookClubDB.getSubmissions(chatId, activeMeetingId)
+        # Use the chapters prepared when books were submitted, only fetching the volumes of those which are missing
+        chapters = bookClubDB.getSubmissionAssets(chatId, activeMeetingId)
+        bookVolumes, errors = library.getBookVolumes([volumeId for (_, submissionId, volumeId) in submissionsData if submissionId not in chapters])
+        if errors:
+            bookClubDB.reopenSubmissions(chatId)
+            bot.reply_to(message, commands.fetchErrorReply(errors))
+            return
+        chapters = commands.reportChapters(submissionsData, chapters, bookVolumes)
+
+        # Render the report in a separate process, the vote stage begins once it has been sent
+        bot.reply_to(message, f'Rendering the submission report for meeting {activeMeetingId}\u2026')
+        # The report module (fpdf, fontTools, Pillow) is only imported by the first report, not when the bot starts
+        import submissionReport
+        future = submissionReport.generateInBackground(activeMeetingId, chapters, commands.clubName(message.chat))
+    except Exception:
+        bookClubDB.reopenSubmissions(chatId)
+        raise
+    # The report is delivered by a background thread rather than by the callback, which runs on the render pool's own thread
+    future.add_done_callback(lambda future: runInBackground(sendSubmissionReport, message, chatId, activeMeetingId, future))
+    chapterExecutor.submit(voting.preloadTally)
+
+# Send the rendered submission report and begin the vote stage
+def sendSubmissionReport(message: telebot.types.Message, chatId: int, meetingId: int, future):
+    try:
+        report = future.result()
+        bot.send_document(message.chat.id, report, caption = f"Meeting {meetingId} of {commands.clubName(message.chat)}: Submission Overview", visible_file_name = f"bookClubSubmissions-meeting{meetingId}.pdf")
+        # Begin vote stage
+        bookClubDB.startVoting(chatId)
+    except Exception as e:
+        print(f"Failed to deliver the submission report for meeting {meetingId}: {e}")
+        bookClubDB.reopenSubmissions(chatId)
+        bot.reply_to(message, f'Something went wrong while preparing the submission report, please try again.')
+        return
 
     bot.reply_to(message, f'The voting stage has begun. Please have a look at the submission overview I generated and vote based on their IDs.')
 
 
 # Vote on three books (descending order of priority) from the submissions in the active meeting
 @bot.message_handler(commands=['vote'])
+@metrics.timeHandler
 def vote(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
         'chatTypes': ['private'],
         'activeMeeting': True,
         'stage': 'vote',
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
     userId = message.from_user.id
 
-    voteMatch = re.match(constants.regex['VOTE'], message.text)
-    if not voteMatch:
-        bot.reply_to(message, 'Your message does not conform to the expected format of `/vote <first choice number> <second choice number> <third choice number>`.')
-        return
-    choices: list[str] = re.match(constants.regex['VOTE'], message.text).groups()
-    submissionCount = bookClubDB.getSubmissionCount()
-    for choice in choices:
-        choice = int(choice)
-        if not (choice > 0 and choice <= submissionCount):
-            bot.reply_to(message, f'Your choice ({choice}) is not valid, expected something in the range of 1 - {submissionCount}.')
-            return
-    if choices[0] == choices[1] or choices[1] == choices[2] or choices[0] == choices[2]:
-        bot.reply_to(message, f'You need to choose three different books')
+    choices, error = commands.parseVotes(message.text, bookClubDB.getSubmissionCount(chatId))
+    if error:
+        bot.reply_to(message, error)
         return
 
-    bookClubDB.vote(userId, choices[0], choices[1], choices[2])
-    chosenBooks = []
-    for choice in choices:
-        choice = int(choice)
-        volumeId = bookClubDB.getSubmissionVolumeId(choice)
-        chosenBooks.append(library.getBookVolume(volumeId))
+    bookClubDB.vote(chatId, userId, choices[0], choices[1], choices[2])
+    chosenVolumeIds = [bookClubDB.getSubmissionVolumeId(chatId, choice) for choice in choices]
+    bookVolumes, _ = library.getBookVolumes(chosenVolumeIds)
+    chosenBooks = [bookVolumes[volumeId] for volumeId in chosenVolumeIds if volumeId in bookVolumes]
 
     bot.reply_to(message, f'Successfully saved your votes:\n{library.formatBookVolumeList(chosenBooks)}')
 
 
 # Finalize the vote stage and choose the winning submission
 @bot.message_handler(commands=['finishVoting'])
+@metrics.timeHandler
 def finishVoting(message: telebot.types.Message):
     commandRequirements: types.CommandRequirements = {
         'chatTypes': ['group', 'supergroup'],
         'activeMeeting': True,
-        'onlyMasterUser': True,
+        'onlyAdmin': True,
         'stage': 'vote',
     }
-    if not commandAllowed(message, commandRequirements):
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
         return
     
     # Gather data from BookClubDB
-    activeMeetingId = bookClubDB.getActiveMeetingId()
-    # Votes
-    userVotes = { int(userId): [int(firstVote), int(secondVote), int(thirdVote)] for userId, firstVote, secondVote, thirdVote in bookClubDB.getVotes(activeMeetingId) }
+    activeMeetingId = bookClubDB.getActiveMeetingId(chatId)
+    # Votes, tallied as they came in
+    userVotes, voteResult = bookClubDB.getTally(chatId)
     if len(userVotes.keys()) == 0:
         bot.reply_to(message, f'No votes found, cannot perform voting process.')
         return
     # Submissions
-    submissions = { int(submissionId): library.getBookVolume(volumeId) for (_, submissionId, volumeId) in bookClubDB.getSubmissions(activeMeetingId) }
-    # Perform vote
-    userNames = getUserNames(message.chat.id, userVotes.keys())
-    winner = voting.performVote(userVotes, submissions)
-    voteTable = voting.drawVoteTable(userVotes, submissions, userNames)
+    submissionsData = bookClubDB.getSubmissions(chatId, activeMeetingId)
+    bookVolumes, errors = library.getBookVolumes([volumeId for (_, _, volumeId) in submissionsData])
+    if errors:
+        bot.reply_to(message, commands.fetchErrorReply(errors))
+        return
+    submissions = { int(submissionId): bookVolumes[volumeId] for (_, submissionId, volumeId) in submissionsData }
+    # Vote tables
+    userNames = getUserNames(chatId, userVotes.keys())
+    winner = voteResult['winner']
+    voteTable = voting.voteTable(userVotes, list(submissions.keys()), userNames)
+    roundTable = voting.roundTable(voteResult)
     # End vote stage
-    bookClubDB.endVoting(submissions[winner].get('id'))
+    bookClubDB.endVoting(chatId, submissions[winner].get('id'))
+
+    # Drawing a wide table as images takes a while, the results are sent in the background
+    runInBackground(sendVoteResults, message, activeMeetingId, voteTable, roundTable, submissions[winner])
+
+# Send the vote and round tables of a meeting, then announce its winner
+def sendVoteResults(message: telebot.types.Message, meetingId: int, voteTable: types.Table, roundTable: types.Table, winner: types.BookVolume):
+    sendTable(message.chat.id, voteTable, f'votes-meeting{meetingId}')
+    sendTable(message.chat.id, roundTable, f'rounds-meeting{meetingId}')
+    bot.reply_to(message, f'The voting stage has concluded! The winner is {library.formatBookVolume(winner)}. See the tables above to see how users voted and how many votes each book had in every round (- being ballots with no books left).')
 
-    bot.send_message(message.chat.id, voteTable, parse_mode = 'html')
-    bot.reply_to(message, f'The voting stage has concluded! The winner is {library.formatBookVolume(submissions[winner])}. See the vote table above to see how users voted.')
 
 
+# Print how long commands and the work behind them take, and how often the caches are hit
+@bot.message_handler(commands=['stats'])
+@metrics.timeHandler
+def stats(message: telebot.types.Message):
+    commandRequirements: types.CommandRequirements = {
+        'chatTypes': ['private'],
+        'onlyMasterUser': True,
+    }
+    chatId = clubs.getClubId(message)
+    if not commandAllowed(message, chatId, commandRequirements):
+        return
+
+    bot.reply_to(message, commands.statsReply(metrics.registry, library.client.quota.usage()))
+
 # @bot.message_handler(func = lambda m : True)
 # def tester(message: telebot.types.Message):
 #     print(message)
 #     return
 
 
-# Initialize infinity polling to enable the bot
+# Receive updates through a webhook if started with --webhook, otherwise initialize infinity polling to enable the bot
 if __name__ == '__main__':
-    bot.infinity_polling()
+    setup()
+    metrics.startExporters()
+    if '--webhook' in sys.argv[1:]:
+        webhook.serve(bot)
+    else:
+        # Telegram refuses to serve updates by polling while a webhook is registered
+        bot.remove_webhook()
+        bot.infinity_polling()
 
@@ -0,0 +1,252 @@
+import time
+import bisect
+import threading
+import functools
+import inspect
+import os
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import constants
+from constants import METRICS_LATENCY_BUCKETS, METRICS_FILE_INTERVAL
+
+
+# Lightweight in-process metrics: counters and latency histograms with fixed buckets, cheap enough to stay on in production
+# Recording a value takes a lock and a bisect, anything more expensive (quantiles, formatting) happens when the metrics are read
+# Exposed to admins through /stats and to Prometheus as a text file (METRICS_FILE) and/or an HTTP endpoint (METRICS_PORT)
+
+
+# Latency distribution with Prometheus-style buckets, counts[i] being the values <= buckets[i] (and > buckets[i - 1])
+# The lock is shared by all histograms of a metric family
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...], lock = None):
+        self.buckets = buckets
+        self.lock = lock or threading.Lock()
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram(self.buckets, self.lock)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    # Estimate a quantile by interpolating within its bucket, the way Prometheus' histogram_quantile does
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if idx == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[idx - 1] if idx else 0.0
+                return lower + (self.buckets[idx] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0.0
+
+
+# A named metric with one value (counter or histogram) per combination of label values
+class MetricFamily:
+    def __init__(self, name: str, kind: str, help: str, labelNames: tuple[str, ...], buckets: tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values: dict[tuple, Histogram | float] = {}
+
+    # The histogram of the given label values, which hot paths can hold on to instead of looking it up on every observe()
+    def labels(self, *labelValues) -> Histogram:
+        histogram = self.values.get(labelValues)
+        if histogram is None:
+            with self.lock:
+                histogram = self.values.setdefault(labelValues, Histogram(self.buckets, self.lock))
+        return histogram
+
+    def observe(self, value: float, *labelValues):
+        self.labels(*labelValues).observe(value)
+
+    def increment(self, *labelValues, amount: float = 1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    # Consistent copy of the values, to be read without holding the lock
+    def snapshot(self) -> dict[tuple, Histogram | float]:
+        with self.lock:
+            return { labels: value.copy() if isinstance(value, Histogram) else value for labels, value in self.values.items() }
+
+
+def formatLabels(labelNames: tuple[str, ...], labelValues: tuple, extra: str = '') -> str:
+    def escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(labelNames, labelValues)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metrics:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.startedAt = time.time()
+        self.families: dict[str, MetricFamily] = {}
+        # name -> cache whose hit and miss counts are reported (e.g. an LRUCache)
+        self.caches: dict[str, object] = {}
+
+    def counter(self, name: str, help: str, labelNames: tuple[str, ...] = ()) -> MetricFamily:
+        family = self.families[name] = MetricFamily(f'{self.prefix}_{name}', 'counter', help, labelNames)
+        return family
+
+    def histogram(self, name: str, help: str, labelNames: tuple[str, ...] = ()) -> MetricFamily:
+        family = self.families[name] = MetricFamily(f'{self.prefix}_{name}', 'histogram', help, labelNames)
+        return family
+
+    # Report the hit rate of a cache with hits and misses counters, read only when the metrics are exported
+    def registerCache(self, name: str, cache):
+        self.caches[name] = cache
+
+    def cacheStats(self) -> dict[str, tuple[int, int]]:
+        return { name: (cache.hits, cache.misses) for name, cache in self.caches.items() }
+
+    # Metrics in the Prometheus text exposition format
+    def prometheusText(self) -> str:
+        lines = []
+        for family in self.families.values():
+            lines += [f'# HELP {family.name} {family.help}', f'# TYPE {family.name} {family.kind}']
+            for labelValues, value in sorted(family.snapshot().items()):
+                if family.kind == 'counter':
+                    lines.append(f'{family.name}{formatLabels(family.labelNames, labelValues)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(family.buckets + (float('inf'),), value.counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                    lines.append(f'{family.name}_bucket{formatLabels(family.labelNames, labelValues, le)} {cumulative}')
+                lines.append(f'{family.name}_sum{formatLabels(family.labelNames, labelValues)} {value.sum}')
+                lines.append(f'{family.name}_count{formatLabels(family.labelNames, labelValues)} {value.count}')
+        cacheStats = self.cacheStats()
+        for outcome, idx in [('hits', 0), ('misses', 1)]:
+            name = f'{self.prefix}_cache_{outcome}_total'
+            lines += [f'# HELP {name} Lookups of in-memory caches which were {outcome}', f'# TYPE {name} counter']
+            lines += [f'{name}{formatLabels(("cache",), (cacheName,))} {counts[idx]}' for cacheName, counts in sorted(cacheStats.items())]
+        lines += [f'# HELP {self.prefix}_start_time_seconds Unix time the bot was started at', f'# TYPE {self.prefix}_start_time_seconds gauge', f'{self.prefix}_start_time_seconds {self.startedAt}']
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics for Prometheus' textfile collector, replacing the file atomically so it is never read half-written
+    def writeTextFile(self, filepath: str):
+        temporaryPath = f'{filepath}.tmp'
+        with open(temporaryPath, 'w') as metricsFile:
+            metricsFile.write(self.prometheusText())
+        os.replace(temporaryPath, filepath)
+
+
+registry = Metrics('bookclub')
+handlerSeconds = registry.histogram('handler_seconds', 'Time taken by bot command handlers', ('handler',))
+handlerErrors = registry.counter('handler_errors_total', 'Bot command handlers which raised an exception', ('handler',))
+googleBooksSeconds = registry.histogram('google_books_request_seconds', 'Latency of requests to Google Books, including failed attempts', ('kind',))
+googleBooksThrottled = registry.counter('google_books_throttled_total', 'Requests to Google Books refused by the rate limits, by reason (user, busy or quota)', ('kind', 'reason'))
+googleBooksRequests = registry.counter('google_books_requests_total', 'Requests to Google Books by HTTP status code (or error for requests without a response)', ('kind', 'status'))
+coverDownloadSeconds = registry.histogram('cover_download_seconds', 'Latency of submission report cover image downloads, including failed ones')
+coverDownloads = registry.counter('cover_downloads_total', 'Cover image downloads by HTTP status code (or error for downloads without a response)', ('status',))
+dbSeconds = registry.histogram('db_call_seconds', 'Time taken by BookClubDB methods, including waiting on locks', ('method',))
+reportRenderSeconds = registry.histogram('report_render_seconds', 'Time taken to render a submission report PDF in the render process')
+
+
+# Decorator timing a bot command handler (a function or a coroutine function), to be placed under @bot.message_handler
+def timeHandler(handler):
+    name = handler.__name__
+    if inspect.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def timedAsync(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except BaseException:
+                handlerErrors.increment(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        histogram = handlerSeconds.labels(name)
+        return timedAsync
+
+    @functools.wraps(handler)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        except BaseException:
+            handlerErrors.increment(name)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    histogram = handlerSeconds.labels(name)
+    return timed
+
+
+# Decorator timing a function (or method) in the given histogram, labelled with the function's name
+def timeCalls(family: MetricFamily):
+    def decorate(function):
+        histogram = family.labels(function.__name__)
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return timed
+    return decorate
+
+
+# Serve the metrics to Prometheus over HTTP at /metrics
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = registry.prometheusText().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes arrive constantly, there is nothing worth printing about them
+        def log_message(self, format, *args):
+            pass
+
+    httpServer = ThreadingHTTPServer((host, port), RequestHandler)
+    httpServer.daemon_threads = True
+    threading.Thread(target = httpServer.serve_forever, name = 'metrics-server', daemon = True).start()
+    print(f"Serving metrics on http://{host}:{httpServer.server_address[1]}/metrics")
+    return httpServer
+
+def writePeriodically(filepath: str, interval: float):
+    def write():
+        while True:
+            try:
+                registry.writeTextFile(filepath)
+            except OSError as e:
+                print(f"Failed to write the metrics to {filepath}: {e}")
+            time.sleep(interval)
+    threading.Thread(target = write, name = 'metrics-writer', daemon = True).start()
+
+# Start the exporters enabled in the environment (METRICS_FILE, METRICS_PORT), called by the bots' entry points
+def startExporters():
+    if constants.METRICS_FILE:
+        writePeriodically(constants.METRICS_FILE, METRICS_FILE_INTERVAL)
+    if constants.METRICS_PORT:
+        serve(constants.METRICS_HOST, constants.METRICS_PORT)
@@ -0,0 +1,129 @@
+import time
+import threading
+import atexit
+from datetime import datetime, timedelta, timezone
+
+from cache import LRUCache
+
+
+# Raised when a request is refused by a rate limit, reason being 'user' (one user asking too often), 'busy' (the shared
+# rate limit is taken up by other requests) or 'quota' (the daily quota is used up), retryAfter the seconds until it would be allowed
+class RateLimited(Exception):
+    def __init__(self, reason: str, retryAfter: float):
+        super().__init__(f'Rate limited ({reason}), retry in {retryAfter:.0f}s')
+        self.reason = reason
+        self.retryAfter = retryAfter
+
+
+# Thread-safe token bucket refilling at rate tokens per second, up to capacity tokens
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updatedAt = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take a token, returning whether it was taken and how long to wait before using it (or until it could be taken)
+    # The token is only taken if the wait is at most maxWait, the bucket going into debt so that later callers queue up behind
+    # Callers with a reserve only get a token once that many tokens would be left over, keeping them for more important requests
+    def take(self, maxWait: float = 0, reserve: float = 0) -> tuple[bool, float]:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.rate)
+            self.updatedAt = now
+            wait = max(0.0, (reserve + 1 - self.tokens) / self.rate)
+            if wait > maxWait:
+                return False, wait
+            self.tokens -= 1
+            return True, wait
+
+
+# One token bucket per key (e.g. per user), for the most recently seen keys
+class KeyedTokenBuckets:
+    def __init__(self, rate: float, capacity: float, maxKeys: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = LRUCache(maxKeys)
+        self.lock = threading.Lock()
+
+    def take(self, key, maxWait: float = 0) -> tuple[bool, float]:
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self.buckets.set(key, bucket)
+        return bucket.take(maxWait)
+
+
+# Requests made with an API key today, against its daily quota which resets every day at resetHour (UTC)
+# Requests beyond limit - reserve are only allowed for callers that may use the reserve
+# The count is kept in memory and persisted by savePeriodically() and on exit, off the request path, so that a restart does
+# not forget it. The store is expected to provide getQuotaUsage(day) -> int and saveQuotaUsage(day, requests)
+class DailyQuota:
+    def __init__(self, limit: int, reserve: int, resetHour: int):
+        self.limit = limit
+        self.reserve = reserve
+        self.resetHour = resetHour
+        self.lock = threading.Lock()
+        self.day = self.currentDay()
+        self.used = 0
+        self.store = None
+        # (day, requests) last written to the store
+        self.saved = None
+
+    def attachStore(self, store):
+        self.store = store
+        with self.lock:
+            self.day = self.currentDay()
+            self.used = max(self.used, store.getQuotaUsage(self.day))
+            self.saved = (self.day, self.used)
+
+    # The quota's current day, as the date at which it started
+    def currentDay(self) -> str:
+        return (datetime.now(timezone.utc) - timedelta(hours = self.resetHour)).date().isoformat()
+
+    def secondsUntilReset(self) -> float:
+        now = datetime.now(timezone.utc)
+        reset = now.replace(hour = self.resetHour, minute = 0, second = 0, microsecond = 0)
+        if reset <= now:
+            reset += timedelta(days = 1)
+        return (reset - now).total_seconds()
+
+    # Count a request against the quota, returning whether it is allowed
+    def use(self, useReserve: bool = False) -> bool:
+        with self.lock:
+            day = self.currentDay()
+            if day != self.day:
+                self.day, self.used = day, 0
+            if self.used >= self.limit - (0 if useReserve else self.reserve):
+                return False
+            self.used += 1
+            return True
+
+    # (requests made today, daily limit)
+    def usage(self) -> tuple[int, int]:
+        with self.lock:
+            return self.used, self.limit
+
+    # Write the count to the store if it changed since it was last written
+    def save(self):
+        if self.store:
+            with self.lock:
+                usage = (self.day, self.used)
+            if usage != self.saved:
+                self.store.saveQuotaUsage(*usage)
+                self.saved = usage
+
+    # Save the count every interval seconds from a background thread, and once more when the process exits
+    # A crash loses at most interval seconds of requests, the store keeps the highest count written for a day
+    def savePeriodically(self, interval: float):
+        def save():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except Exception as e:
+                    print(f"Failed to save the daily quota usage: {e}")
+        threading.Thread(target = save, name = 'quota-writer', daemon = True).start()
+        atexit.register(self.save)
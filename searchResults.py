@@ -0,0 +1,155 @@
+import time
+import random
+import asyncio
+
+import customTypes as types
+import metrics
+from cache import LRUCache
+from constants import SEARCH_RESULTS_CACHE_SIZE, SEARCH_RESULTS_TTL
+
+
+# Compact copy of a search result, only what is needed to list it and to submit it with /choose
+# Supports item access like a BookVolume, so it can be passed to the formatting helpers of the library module
+class SearchResult:
+    __slots__ = ('id', 'title', 'subtitle', 'authors', 'googleBooksLink')
+
+    def __init__(self, id: str, title: str, subtitle: str | None, authors: tuple[str, ...], googleBooksLink: str):
+        self.id = id
+        self.title = title
+        self.subtitle = subtitle
+        self.authors = authors
+        self.googleBooksLink = googleBooksLink
+
+    @classmethod
+    def fromBookVolume(cls, bookVolume: types.BookVolume) -> 'SearchResult':
+        return cls(bookVolume['id'], bookVolume['title'], bookVolume['subtitle'], tuple(bookVolume['authors'] or ()), bookVolume['googleBooksLink'])
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def toRow(self) -> list:
+        return [self.id, self.title, self.subtitle, list(self.authors), self.googleBooksLink]
+
+    @classmethod
+    def fromRow(cls, row: list) -> 'SearchResult':
+        id, title, subtitle, authors, googleBooksLink = row
+        return cls(id, title, subtitle, tuple(authors), googleBooksLink)
+
+
+# A user's latest search, whose results they page through and pick one of with /choose
+# results are those fetched so far in the order they are listed (numbered across pages), pageEnds where each page listed so
+# far ends, and nextIndex the startIndex of the next page of Google Books results (None once there is nothing more to fetch)
+# searchId tells the pages of this search apart from those of the user's earlier searches
+# Sessions are never modified, adding results or a page returns a new session, so concurrent page turns cannot mix them up
+class SearchSession:
+    __slots__ = ('searchId', 'input', 'numFound', 'results', 'pageEnds', 'nextIndex')
+
+    def __init__(self, searchId: int, input: str, numFound: int, results: tuple[SearchResult, ...], pageEnds: tuple[int, ...], nextIndex: int | None):
+        self.searchId = searchId
+        self.input = input
+        self.numFound = numFound
+        self.results = results
+        self.pageEnds = pageEnds
+        self.nextIndex = nextIndex
+
+    # Session of a new search, before any of its pages is listed
+    @classmethod
+    def new(cls, input: str, numFound: int, bookVolumes: types.BookVolumes, nextIndex: int | None) -> 'SearchSession':
+        return cls(random.getrandbits(31), input, numFound, (), (), nextIndex).withResults(numFound, bookVolumes, nextIndex)
+
+    # Number of results on the pages listed so far
+    def listedCount(self) -> int:
+        return self.pageEnds[-1] if self.pageEnds else 0
+
+    # The results listed so far, which /choose picks from
+    def listed(self) -> tuple[SearchResult, ...]:
+        return self.results[:self.listedCount()]
+
+    # (start, end) of a listed page in the results
+    def pageBounds(self, pageIdx: int) -> tuple[int, int]:
+        return (self.pageEnds[pageIdx - 1] if pageIdx else 0), self.pageEnds[pageIdx]
+
+    # Whether there are results past a listed page, either fetched already or still to be fetched
+    def hasMore(self, pageIdx: int) -> bool:
+        return self.pageEnds[pageIdx] < len(self.results) or self.nextIndex is not None
+
+    # Whether more results should be fetched before listing the next page of pageSize results
+    def needsResults(self, pageSize: int) -> bool:
+        return self.nextIndex is not None and len(self.results) - self.listedCount() < pageSize
+
+    # Add the results of another page of the search, skipping those which were already added
+    def withResults(self, numFound: int, bookVolumes: types.BookVolumes, nextIndex: int | None) -> 'SearchSession':
+        resultIds = { result.id for result in self.results }
+        results = list(self.results)
+        for bookVolume in bookVolumes:
+            if bookVolume['id'] not in resultIds:
+                resultIds.add(bookVolume['id'])
+                results.append(SearchResult.fromBookVolume(bookVolume))
+        # Google Books' count is an estimate, once the last page is in the results are all there is
+        numFound = len(results) if nextIndex is None else max(self.numFound, numFound, len(results))
+        return SearchSession(self.searchId, self.input, numFound, tuple(results), self.pageEnds, nextIndex)
+
+    # List the next page, made of the results up to end
+    def withPage(self, end: int) -> 'SearchSession':
+        return SearchSession(self.searchId, self.input, self.numFound, self.results, self.pageEnds + (end, ), self.nextIndex)
+
+    def toRow(self) -> dict:
+        return {
+            'searchId': self.searchId,
+            'input': self.input,
+            'numFound': self.numFound,
+            'results': [result.toRow() for result in self.results],
+            'pageEnds': list(self.pageEnds),
+            'nextIndex': self.nextIndex,
+        }
+
+    @classmethod
+    def fromRow(cls, row: dict) -> 'SearchSession':
+        results = tuple(SearchResult.fromRow(resultRow) for resultRow in row['results'])
+        return cls(row['searchId'], row['input'], row['numFound'], results, tuple(row['pageEnds']), row['nextIndex'])
+
+
+# The latest search of each user, so that they can page through its results and pick one of them with /choose
+# Searches expire a while after they were made and the least recently used users are evicted once the store is full.
+# With a persistent store they also survive restarts, the store is expected to provide getSearchResults(userId) ->
+# (row, savedAt) | None, saveSearchResults(userId, row) and deleteSearchResults(olderThan)
+# The async methods reach the store on storeExecutor (None means the event loop's default executor)
+class SearchResultStore:
+    def __init__(self, store = None, maxSize: int = SEARCH_RESULTS_CACHE_SIZE, ttl: float = SEARCH_RESULTS_TTL, storeExecutor = None):
+        self.store = store
+        self.storeExecutor = storeExecutor
+        self.ttl = ttl
+        # userId -> SearchSession
+        self.memory = LRUCache(maxSize, ttl)
+        metrics.registry.registerCache('searchResults', self.memory)
+        if self.store:
+            self.store.deleteSearchResults(time.time() - ttl)
+
+    def save(self, userId: int, session: SearchSession):
+        self.memory.set(userId, session)
+        if self.store:
+            self.store.saveSearchResults(userId, session.toRow())
+
+    # Return the user's latest search, or None if they have none or it expired
+    def get(self, userId: int) -> SearchSession | None:
+        session = self.memory.get(userId)
+        if session is not None or not self.store:
+            return session
+        stored = self.store.getSearchResults(userId)
+        if not stored:
+            return None
+        row, savedAt = stored
+        if (time.time() - savedAt) >= self.ttl:
+            return None
+        session = SearchSession.fromRow(row)
+        self.memory.set(userId, session, savedAt)
+        return session
+
+    async def saveAsync(self, userId: int, session: SearchSession):
+        await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.save, userId, session)
+
+    async def getAsync(self, userId: int) -> SearchSession | None:
+        session = self.memory.get(userId)
+        if session is not None or not self.store:
+            return session
+        return await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.get, userId)
@@ -1,12 +1,144 @@
 from fpdf import FPDF, enums
+from PIL import Image
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
 from os import path
+import html
+import multiprocessing
+import threading
+import hashlib
+import io
+import os
+import time
 
 import customTypes as types
 import library
 import constants
+import metrics
 
 
 dirname = path.dirname(__file__)
+coverCacheDir = path.join(dirname, 'covers')
+# Width of the cover images in the report (mm)
+coverImageWidth = 40
+
+def imagePath(imageName: str) -> str:
+    return path.join(dirname, 'images', constants.images[imageName])
+
+
+# Download a cover image and store it downscaled to its printed width, returning the local file path or None on failure
+# Files are named after a hash of the image link, so covers already in the cache are not downloaded again
+def fetchCover(imageLink: str, widthMM: float) -> str | None:
+    filepath = path.join(coverCacheDir, f"{hashlib.sha256(imageLink.encode()).hexdigest()}.jpg")
+    if path.exists(filepath):
+        return filepath
+
+    content = library.client.download(imageLink)
+    if not content:
+        return None
+    try:
+        image = Image.open(io.BytesIO(content)).convert('RGB')
+    except Exception as e:
+        print(f"Failed to decode cover image {imageLink}: {e}")
+        return None
+    widthPx = round(widthMM / 25.4 * constants.COVER_DPI)
+    if image.width > widthPx:
+        image = image.resize((widthPx, round(image.height * widthPx / image.width)), Image.Resampling.LANCZOS)
+    # Write to a temporary file first so that a concurrent render never picks up a partially written cover
+    os.makedirs(coverCacheDir, exist_ok = True)
+    temporaryFilepath = f"{filepath}.{os.getpid()}.tmp"
+    image.save(temporaryFilepath, 'JPEG', quality = 85, optimize = True)
+    os.replace(temporaryFilepath, filepath)
+    return filepath
+
+# Tags from Google Books descriptions which are passed on to write_html, any other markup is reduced to its text
+descriptionTags = {'b', 'i', 'u', 'em', 'strong', 'p', 'br', 'ul', 'ol', 'li'}
+
+# Rebuilds description HTML with only the supported tags, escaped text and every opened tag closed
+class DescriptionCleaner(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs = True)
+        self.parts: list[str] = []
+        self.openTags: list[str] = []
+        self.skippedTag: str | None = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skippedTag = tag
+        elif tag == 'br':
+            self.parts.append('<br>')
+        elif tag in descriptionTags:
+            # Paragraphs and list items are implicitly closed by the next one
+            if tag in ('p', 'li') and self.openTags and self.openTags[-1] == tag:
+                self.handle_endtag(tag)
+            self.parts.append(f'<{tag}>')
+            self.openTags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag == self.skippedTag:
+            self.skippedTag = None
+        if tag not in self.openTags:
+            return
+        while self.openTags:
+            openTag = self.openTags.pop()
+            self.parts.append(f'</{openTag}>')
+            if openTag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.skippedTag:
+            return
+        self.parts.append(html.escape(data, quote = False))
+
+    def result(self) -> str:
+        self.close()
+        return ''.join(self.parts) + ''.join(f'</{tag}>' for tag in reversed(self.openTags))
+
+def cleanDescription(description: str | None) -> str:
+    if not description:
+        return '<b>Google Books does not have a description for this volume.</b>'
+    cleaner = DescriptionCleaner()
+    cleaner.feed(description)
+    return cleaner.result()
+
+# Prepare everything needed to print a submission's chapter ahead of rendering the report
+def prepareChapter(bookVolume: types.BookVolume) -> types.ChapterAssets:
+    return {
+        'volume': bookVolume,
+        'coverPath': fetchCover(bookVolume['imageLink'], coverImageWidth) if bookVolume['imageLink'] else None,
+        'descriptionHtml': cleanDescription(bookVolume['description']),
+    }
+
+# Check whether a chapter is ready to be printed, i.e. its description is cleaned and its cover (if any) is on disk
+def isChapterPrepared(chapter: types.ChapterAssets) -> bool:
+    if chapter['descriptionHtml'] is None:
+        return False
+    if chapter['volume']['imageLink']:
+        return bool(chapter['coverPath']) and path.exists(chapter['coverPath'])
+    return True
+
+# Prepare the chapters which were not prepared ahead of time, concurrently
+# Covers which fail or are not ready in time are left out, so that the report falls back to COVER_NOT_FOUND
+def prepareChapters(chapters: dict[int, types.ChapterAssets]) -> dict[int, types.ChapterAssets]:
+    unprepared = [submissionId for submissionId, chapter in chapters.items() if not isChapterPrepared(chapter)]
+    if not unprepared:
+        return chapters
+
+    executor = ThreadPoolExecutor(max_workers = min(constants.MAX_FETCH_WORKERS, len(unprepared)))
+    futures = { submissionId: executor.submit(prepareChapter, chapters[submissionId]['volume']) for submissionId in unprepared }
+    wait(futures.values(), timeout = constants.COVER_PREFETCH_TIMEOUT)
+    executor.shutdown(wait = False, cancel_futures = True)
+
+    preparedChapters = dict(chapters)
+    for submissionId, future in futures.items():
+        if future.done() and not future.cancelled() and not future.exception():
+            preparedChapters[submissionId] = future.result()
+        else:
+            bookVolume = chapters[submissionId]['volume']
+            preparedChapters[submissionId] = { 'volume': bookVolume, 'coverPath': None, 'descriptionHtml': cleanDescription(bookVolume['description']) }
+    return preparedChapters
+
 
 class SubmissionReport(FPDF):
     def __init__(self, coverImageWidth, ):
@@ -17,7 +149,7 @@ class SubmissionReport(FPDF):
         # Setting font: helvetica bold 15
         self.set_font("helvetica", style="B", size=18)
         # Embed logo
-        self.image(path.join(dirname, 'images', constants.images['LOGO']), x = self.l_margin, y=10, w = 10)
+        self.image(imagePath('LOGO'), x = self.l_margin, y=10, w = 10)
         # Calculating width of title and setting cursor position:
         width = self.get_string_width(self.title) + 6
         self.set_x(((210 - width) / 2) + 8)
@@ -53,7 +185,7 @@ class SubmissionReport(FPDF):
             fill = fill,
         )
 
-    def chapter_header(self, submissionId: int, bookVolume: types.BookVolume):
+    def chapter_header(self, submissionId: int, bookVolume: types.BookVolume, coverPath: str | None):
         # Get X, Y coordinates for image with link to Google Books page
         googleBooksLogoX = self.w - self.r_margin - 1 - 6
         googleBooksLogoY = self.get_y() + 1
@@ -71,7 +203,7 @@ class SubmissionReport(FPDF):
             self.addChapterHeaderLine(f"{bookVolume['subtitle']}")
         # Add image with link to Google Books page
         yAfterText = self.get_y()
-        self.image(path.join(dirname, 'images', constants.images['GOOGLE_BOOKS_LINK']), x = googleBooksLogoX, y = googleBooksLogoY, h = 7, link = bookVolume['googleBooksLink'])
+        self.image(imagePath('GOOGLE_BOOKS_LINK'), x = googleBooksLogoX, y = googleBooksLogoY, h = 7, link = bookVolume['googleBooksLink'])
         self.set_y(yAfterText)
         self.ln(4)
 
@@ -79,18 +211,13 @@ class SubmissionReport(FPDF):
         self.set_font("Roboto", size = 12)
         startY = self.get_y()
 
-        # Book Cover Art
-        imageHeight = 0
-        if bookVolume["imageLink"]:
-            imageData = self.image(bookVolume["imageLink"], x = self.l_margin, y = self.get_y(), w = self.coverImageWidth)
-            imageHeight = imageData["rendered_height"]
-            self.rect(x = self.l_margin, y = startY, w = self.coverImageWidth, h = imageHeight)
-            self.set_x(10 + self.coverImageWidth + 6)
-        else:
-            imageData = self.image(path.join(dirname, 'images', constants.images['COVER_NOT_FOUND']), x = self.l_margin, y = self.get_y(), w = self.coverImageWidth)
-            imageHeight = imageData["rendered_height"]
-            self.rect(x = self.l_margin, y = startY, w = self.coverImageWidth, h = imageHeight)
-            self.set_x(10 + self.coverImageWidth + 6)
+        # Book Cover Art (prepared ahead of time, falling back to a placeholder if there is none)
+        if not coverPath:
+            coverPath = imagePath('COVER_NOT_FOUND')
+        imageData = self.image(coverPath, x = self.l_margin, y = self.get_y(), w = self.coverImageWidth)
+        imageHeight = imageData["rendered_height"]
+        self.rect(x = self.l_margin, y = startY, w = self.coverImageWidth, h = imageHeight)
+        self.set_x(10 + self.coverImageWidth + 6)
 
         # Print chapter header text
         lineStartX = self.get_x()
@@ -126,35 +253,76 @@ class SubmissionReport(FPDF):
         # Performing a line break:
         self.ln(8)
 
-    def print_chapter(self, submissionId: int, bookVolume: types.BookVolume):
+    def print_chapter(self, submissionId: int, chapter: types.ChapterAssets):
         # If there is less than 90mm left in the page, create a new one
         if not (self.h - self.get_y()) > 90:
             self.add_page()
-        self.chapter_header(submissionId, bookVolume)
-        if bookVolume["description"]:
-            self.chapter_body(bookVolume["description"])
-        else:
-            self.chapter_body('<b>Google Books does not have a description for this volume.</b>')
+        self.chapter_header(submissionId, chapter['volume'], chapter['coverPath'])
+        self.chapter_body(chapter['descriptionHtml'])
+
 
+# Render the submission report in memory from the submissions' chapters, returning the PDF file contents
+# Chapters are normally prepared when the book is submitted, any that are not are prepared (concurrently) here
+def generate(meetingId: str, chapters: dict[int, types.ChapterAssets], clubName: str = constants.DEFAULT_CLUB_NAME) -> io.BytesIO:
+    chapters = prepareChapters(chapters)
 
-def generate(meetingId: str, submissions: dict[str, types.BookVolume]) -> str:
     # Initiailize PDF file
-    report = SubmissionReport(40)
-    report.set_title(f"Submissions for Meeting {meetingId} of the Wild Frog Book Club")
+    report = SubmissionReport(coverImageWidth)
+    report.set_title(f"Submissions for Meeting {meetingId} of {clubName}")
     report.set_author("Generated by WildFrogBookClubBot")
     report.add_page()
 
     # Load unicode font
-    report.add_font('Roboto', '', path.join(dirname, 'fonts', constants.fonts['DEFAULT']), uni = True)
-    report.add_font('Roboto', 'b', path.join(dirname, 'fonts', constants.fonts['BOLD']), uni = True)
-    report.add_font('Roboto', 'i', path.join(dirname, 'fonts', constants.fonts['ITALIC']), uni = True)
-    report.add_font('Roboto', 'bi', path.join(dirname, 'fonts', constants.fonts['BOLD-ITALIC']), uni = True)
+    report.add_font('Roboto', '', path.join(dirname, 'fonts', constants.fonts['DEFAULT']))
+    report.add_font('Roboto', 'b', path.join(dirname, 'fonts', constants.fonts['BOLD']))
+    report.add_font('Roboto', 'i', path.join(dirname, 'fonts', constants.fonts['ITALIC']))
+    report.add_font('Roboto', 'bi', path.join(dirname, 'fonts', constants.fonts['BOLD-ITALIC']))
 
     # Print a 'chapter' for each submission
-    for submissionId, bookVolume in submissions.items():
-        report.print_chapter(submissionId, bookVolume)
+    for submissionId, chapter in chapters.items():
+        report.print_chapter(submissionId, chapter)
+
+    return io.BytesIO(report.output())
+
+
+# Entry point of the render processes, also returning how long rendering took, as their own metrics are never collected
+def renderReport(meetingId: str, chapters: dict[int, types.ChapterAssets], clubName: str) -> tuple[io.BytesIO, float]:
+    start = time.perf_counter()
+    report = generate(meetingId, chapters, clubName)
+    return report, time.perf_counter() - start
+
+
+# Process pool for rendering reports, created on first use and replaced if a render process dies and breaks it
+# Worker processes are spawned rather than forked, as forking the multi-threaded bot process is not safe
+renderExecutor: ProcessPoolExecutor | None = None
+renderExecutorLock = threading.Lock()
+
+def newRenderExecutor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers = constants.REPORT_RENDER_WORKERS, mp_context = multiprocessing.get_context('spawn'))
+
+# Render the submission report in a separate process, so that the bot's handler threads are not blocked by it
+def generateInBackground(meetingId: str, chapters: dict[int, types.ChapterAssets], clubName: str = constants.DEFAULT_CLUB_NAME) -> Future:
+    global renderExecutor
+    with renderExecutorLock:
+        if renderExecutor is None:
+            renderExecutor = newRenderExecutor()
+        try:
+            renderFuture = renderExecutor.submit(renderReport, meetingId, chapters, clubName)
+        except BrokenProcessPool:
+            print("The report render pool is broken, starting a new one")
+            renderExecutor.shutdown(wait = False)
+            renderExecutor = newRenderExecutor()
+            renderFuture = renderExecutor.submit(renderReport, meetingId, chapters, clubName)
 
-    # Save PDF file to output in local directory
-    reportFilename = f"bookClubSubmissions-meeting{meetingId}.pdf"
-    report.output(reportFilename)
-    return reportFilename
\ No newline at end of file
+    # The render time is recorded here, in the bot's process, and the caller only gets the report
+    future = Future()
+    def renderDone(renderFuture: Future):
+        try:
+            report, renderTime = renderFuture.result()
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        metrics.reportRenderSeconds.observe(renderTime)
+        future.set_result(report)
+    renderFuture.add_done_callback(renderDone)
+    return future
\ No newline at end of file
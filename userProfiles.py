@@ -0,0 +1,103 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Awaitable
+
+import telebot
+
+import metrics
+from cache import LRUCache
+from constants import USER_PROFILE_CACHE_SIZE, USER_PROFILE_TTL, MAX_USER_FETCH_WORKERS
+
+
+# Cache of Telegram user profiles (first names), kept in memory and persisted in the database
+# Profiles are refreshed for free from incoming messages, Telegram is only asked about users that are unknown or outdated
+# The store is expected to provide getUsers(userIds) -> { userId: (firstName, updatedAt) } and saveUser(userId, firstName)
+# The async methods reach the store on storeExecutor (None means the event loop's default executor)
+class UserProfiles:
+    def __init__(self, store, maxSize: int = USER_PROFILE_CACHE_SIZE, ttl: float = USER_PROFILE_TTL, storeExecutor = None):
+        self.store = store
+        self.storeExecutor = storeExecutor
+        self.ttl = ttl
+        # userId -> (firstName, updatedAt)
+        self.memory = LRUCache(maxSize)
+        metrics.registry.registerCache('userProfiles', self.memory)
+        self.fetchExecutor = ThreadPoolExecutor(max_workers = MAX_USER_FETCH_WORKERS, thread_name_prefix = 'user-fetch')
+
+    def isFresh(self, updatedAt: float) -> bool:
+        return (time.time() - updatedAt) < self.ttl
+
+    def save(self, userId: int, firstName: str):
+        self.memory.set(userId, (firstName, time.time()))
+        self.store.saveUser(userId, firstName)
+
+    # Record the profile of a user who sent a message, only writing to the database if it changed or is outdated
+    def observe(self, user: telebot.types.User):
+        cached = self.memory.get(user.id)
+        if cached and cached[0] == user.first_name and self.isFresh(cached[1]):
+            return
+        self.save(user.id, user.first_name)
+
+    # Get the first names of the given users, fetching unknown or outdated profiles in parallel with fetchUser(userId)
+    # Outdated profiles are still used if fetching them fails
+    def getFirstNames(self, userIds: list[int], fetchUser: Callable[[int], telebot.types.User]) -> dict[int, str]:
+        profiles: dict[int, tuple[str, float]] = {}
+        for userId in userIds:
+            cached = self.memory.get(userId)
+            if cached:
+                profiles[userId] = cached
+        missingIds = [userId for userId in userIds if userId not in profiles]
+        if missingIds:
+            for userId, profile in self.store.getUsers(missingIds).items():
+                self.memory.set(userId, profile)
+                profiles[userId] = profile
+
+        fetchIds = [userId for userId in userIds if userId not in profiles or not self.isFresh(profiles[userId][1])]
+        futures = { userId: self.fetchExecutor.submit(fetchUser, userId) for userId in fetchIds }
+        for userId, future in futures.items():
+            try:
+                user = future.result()
+            except Exception as e:
+                print(f"Failed to fetch the profile of user {userId}: {e}")
+                continue
+            self.save(userId, user.first_name)
+            profiles[userId] = (user.first_name, time.time())
+
+        return { userId: profiles[userId][0] if userId in profiles else str(userId) for userId in userIds }
+
+    # Asyncio counterpart of observe
+    async def observeAsync(self, user: telebot.types.User):
+        cached = self.memory.get(user.id)
+        if cached and cached[0] == user.first_name and self.isFresh(cached[1]):
+            return
+        await asyncio.get_running_loop().run_in_executor(self.storeExecutor, self.save, user.id, user.first_name)
+
+    # Asyncio counterpart of getFirstNames, fetching unknown or outdated profiles concurrently with await fetchUser(userId)
+    async def getFirstNamesAsync(self, userIds: list[int], fetchUser: Callable[[int], Awaitable[telebot.types.User]]) -> dict[int, str]:
+        loop = asyncio.get_running_loop()
+        profiles: dict[int, tuple[str, float]] = {}
+        for userId in userIds:
+            cached = self.memory.get(userId)
+            if cached:
+                profiles[userId] = cached
+        missingIds = [userId for userId in userIds if userId not in profiles]
+        if missingIds:
+            for userId, profile in (await loop.run_in_executor(self.storeExecutor, self.store.getUsers, missingIds)).items():
+                self.memory.set(userId, profile)
+                profiles[userId] = profile
+
+        fetchIds = [userId for userId in userIds if userId not in profiles or not self.isFresh(profiles[userId][1])]
+        # Same concurrency limit as the fetch executor of getFirstNames
+        semaphore = asyncio.Semaphore(MAX_USER_FETCH_WORKERS)
+        async def fetch(userId: int):
+            async with semaphore:
+                return await fetchUser(userId)
+        results = await asyncio.gather(*[fetch(userId) for userId in fetchIds], return_exceptions = True)
+        for userId, user in zip(fetchIds, results):
+            if isinstance(user, BaseException):
+                print(f"Failed to fetch the profile of user {userId}: {user}")
+                continue
+            await loop.run_in_executor(self.storeExecutor, self.save, userId, user.first_name)
+            profiles[userId] = (user.first_name, time.time())
+
+        return { userId: profiles[userId][0] if userId in profiles else str(userId) for userId in userIds }
@@ -1,50 +1,305 @@
-from pyrankvote import Candidate, Ballot, instant_runoff_voting
-import prettytable as pt
+from wcwidth import wcswidth
+from collections import Counter
+from os import path
+import itertools
+import threading
+import html
+import math
+import io
 
 import customTypes as types
+import constants
+from cache import LRUCache
+from constants import MAX_MESSAGE_LENGTH, VOTE_TABLE_NAME_LENGTH, VOTE_TABLE_MAX_TEXT_COLUMNS, VOTE_TABLE_IMAGE_ROWS, VOTE_TABLE_IMAGE_FONT_SIZE, VOTE_TABLE_IMAGE_CACHE_SIZE
 
 
-def performVote(userVotes: dict[int, list[int]], submissions: dict[int, types.BookVolume | None]) -> int:
-    # Map of submissionId -> Candidate
-    submissionCandidates = { submissionId: Candidate(submissionId) for submissionId in submissions.keys() }
-    # Map of userId -> ranked list of Candidates
-    userVotesForCandidates: dict[str, list[Candidate]] = {}
+# Instant-runoff (ranked-choice) tally of ballots listing candidate IDs from most to least preferred, of any length
+# Every round each ballot counts for its highest ranked candidate still in the race, ballots with none left are exhausted.
+# A candidate counted on more than half of the ballots which are not exhausted wins, otherwise the candidate with the
+# fewest votes is eliminated (all candidates without a single vote are eliminated at once, as they cannot change the outcome)
+# Ties for the fewest votes are broken by the latest earlier round in which the tied candidates' votes differed, then by
+# tieBreakOrder: the candidate listed last is eliminated (defaults to ascending IDs, i.e. the latest submission goes first)
+# numpy is only imported by the first tally, so that importing the module (as the bot does on startup) stays cheap
+def tallyVotes(ballots: list[list[int]], candidates: list[int], tieBreakOrder: list[int] | None = None) -> types.VoteResult:
+    import numpy as np
+    candidateIds = np.array(sorted(set(candidates)), dtype = np.int64)
+    candidateCount = len(candidateIds)
+    if candidateCount == 0:
+        raise Exception('Cannot tally votes without any candidates')
+    # Position of each candidate in the tie-break order, higher is eliminated first
+    if tieBreakOrder is None:
+        tieBreakRank = np.arange(candidateCount)
+    else:
+        if sorted(tieBreakOrder) != candidateIds.tolist():
+            raise Exception('The tie-break order has to list every candidate exactly once')
+        tieBreakRank = np.empty(candidateCount, dtype = np.int64)
+        tieBreakRank[np.searchsorted(candidateIds, tieBreakOrder)] = np.arange(candidateCount)
+
+    # Ballots as a matrix of candidate indexes, padded with -1 up to one column more than the longest ballot,
+    # so that a ballot which ran out of candidates reads -1
+    ballotCount = len(ballots)
+    lengths = np.fromiter(map(len, ballots), dtype = np.int64, count = ballotCount)
+    rankedIds = np.fromiter(itertools.chain.from_iterable(ballots), dtype = np.int64, count = int(lengths.sum()))
+    rankedIndexes = np.searchsorted(candidateIds, rankedIds).clip(max = candidateCount - 1)
+    if (candidateIds[rankedIndexes] != rankedIds).any():
+        raise Exception('A ballot ranks a candidate which is not running')
+    rankings = np.full((ballotCount, int(lengths.max(initial = 0)) + 1), -1, dtype = np.int64)
+    ballotStarts = np.cumsum(lengths) - lengths
+    rankings[np.repeat(np.arange(ballotCount), lengths), np.arange(len(rankedIds)) - np.repeat(ballotStarts, lengths)] = rankedIndexes
+
+    # Whether each candidate is in the race, with a trailing True read for exhausted ballots (index -1)
+    inRace = np.ones(candidateCount + 1, dtype = bool)
+    positions = np.zeros(ballotCount, dtype = np.int64)
+    current = rankings[:, 0].copy()
+    # Every round's vote counts, for breaking ties
+    history: list[np.ndarray] = []
+    rounds: list[types.VoteRound] = []
+    while True:
+        counts = np.bincount(current[current >= 0], minlength = candidateCount)
+        history.append(counts)
+        activeBallots = int(counts.sum())
+        remaining = np.flatnonzero(inRace[:candidateCount])
+        remainingCounts = counts[remaining]
+        voteRound: types.VoteRound = {
+            'votes': dict(zip(candidateIds[remaining].tolist(), remainingCounts.tolist())),
+            'exhausted': ballotCount - activeBallots,
+            'eliminated': [],
+            'tieBreak': False,
+        }
+        rounds.append(voteRound)
+
+        leader = remaining[np.argmax(remainingCounts)]
+        if len(remaining) == 1 or counts[leader] * 2 > activeBallots:
+            return { 'winner': int(candidateIds[leader]), 'rounds': rounds }
+
+        if remainingCounts.max() > 0 and remainingCounts.min() == 0:
+            eliminated = remaining[remainingCounts == 0]
+        else:
+            eliminated = remaining[remainingCounts == remainingCounts.min()]
+            voteRound['tieBreak'] = len(eliminated) > 1
+            for pastCounts in reversed(history[:-1]):
+                if len(eliminated) == 1:
+                    break
+                eliminated = eliminated[pastCounts[eliminated] == pastCounts[eliminated].min()]
+            if len(eliminated) > 1:
+                eliminated = eliminated[[np.argmax(tieBreakRank[eliminated])]]
+        voteRound['eliminated'] = candidateIds[eliminated].tolist()
+
+        # Move the ballots of the eliminated candidates on to their next choice still in the race
+        inRace[eliminated] = False
+        moving = np.flatnonzero(~inRace[current])
+        while len(moving) > 0:
+            positions[moving] += 1
+            current[moving] = rankings[moving, positions[moving]]
+            moving = moving[~inRace[current[moving]]]
+
+
+# Import what the tally needs ahead of the first one (while the submission report renders), so that no command waits on numpy being imported
+def preloadTally():
+    import numpy
+
+
+# Running tally of a meeting's vote stage, updated as users vote
+# First preference counts are kept up to date on every ballot, while the instant-runoff result is computed on demand
+# and cached until a ballot changes. Not thread-safe on its own, the meeting state's lock guards it
+class RunningTally:
+    def __init__(self, candidates: list[int], ballots: dict[int, list[int]] | None = None):
+        self.candidates = sorted(candidates)
+        # userId -> ranked submissionIds
+        self.ballots: dict[int, list[int]] = {}
+        # submissionId -> number of ballots ranking it first
+        self.firstPreferences: Counter[int] = Counter()
+        self.result: types.VoteResult | None = None
+        for userId, ballot in (ballots or {}).items():
+            self.setBallot(userId, ballot)
+
+    # Add or replace a user's ballot
+    def setBallot(self, userId: int, ballot: list[int]):
+        previousBallot = self.ballots.get(userId)
+        if previousBallot == ballot:
+            return
+        if previousBallot:
+            self.firstPreferences[previousBallot[0]] -= 1
+        if ballot:
+            self.firstPreferences[ballot[0]] += 1
+        self.ballots[userId] = list(ballot)
+        self.result = None
+
+    # The instant-runoff result of the ballots so far, None without any ballots
+    def getResult(self) -> types.VoteResult | None:
+        if self.result is None and self.ballots:
+            self.result = tallyVotes(list(self.ballots.values()), self.candidates)
+        return self.result
+
+
+# Tally the users' votes for the meeting's submissions
+def performVote(userVotes: dict[int, list[int]], submissions: dict[int, types.BookVolume | None]) -> types.VoteResult:
+    return tallyVotes(list(userVotes.values()), list(submissions.keys()))
+
+# Table of how each user ranked each submission, one row per user
+def voteTable(userVotes: dict[int, list[int]], submissionIds: list[int], userNames: dict[int, str]) -> types.Table:
+    rows = []
     for userId, votes in userVotes.items():
-        userVotesForCandidates[userId] = [submissionCandidates[vote] for vote in votes]
-    # Preparing ballots based on user ranked lists of candidates
-    ballots = [Ballot(ranked_candidates = votes) for votes in userVotesForCandidates.values()]
-
-    result = instant_runoff_voting(candidates = [candidate for candidate in submissionCandidates.values()], ballots = ballots)
-    winningCandidate = result.get_winners()[0]
-    candidateToSubmissionId = { candidate: submissionId for submissionId, candidate in submissionCandidates.items() }
-    winningSubmissionId = candidateToSubmissionId[winningCandidate]
-
-    return winningSubmissionId
-
-def userVoteRankForSubmission(submissionId: int, votes: list[int]):
-    if not submissionId in votes:
-        return ''
-    voteIndex = votes.index(submissionId)
-    return str(voteIndex + 1)
-
-def drawVoteTable(userVotes: dict[str, list[int]], submissions: dict[int, types.BookVolume | None], userNames: dict[int, str]) -> str:
-    # Build table corresponding to how each user voted for each submission
-    table: list[list[str]] = []
-    for uIdx, votes in enumerate(userVotes.values()):
-        table.append([])
-        for submissionId in submissions.keys():
-            table[uIdx].append(userVoteRankForSubmission(submissionId, votes))
-    
-    row = ['']
-    row.extend([str(submissionId) for submissionId in submissions.keys()])
-    voteTable = pt.PrettyTable(row)
-    for uIdx, userSubmissionVotes in enumerate(table):
-        userId = list(userVotes.keys())[uIdx]
-        row = [userNames[userId]]
-        row.extend(userSubmissionVotes)
-        voteTable.add_row(row)
-
-    print(voteTable)
-    return f'<pre>{voteTable}</pre>'
-
-    
\ No newline at end of file
+        ranks = { submissionId: str(rank + 1) for rank, submissionId in enumerate(votes) }
+        rows.append([shortName(userNames[userId])] + [ranks.get(submissionId, '') for submissionId in submissionIds])
+    return { 'header': [''] + [str(submissionId) for submissionId in submissionIds], 'rows': rows }
+
+# Table of how many votes each submission had in every round of the tally, with the exhausted ballots as the last row
+def roundTable(result: types.VoteResult) -> types.Table:
+    submissionIds = sorted(result['rounds'][0]['votes'].keys())
+    rows = [[str(submissionId)] + [str(voteRound['votes'].get(submissionId, '')) for voteRound in result['rounds']] for submissionId in submissionIds]
+    rows.append(['-'] + [str(voteRound['exhausted']) for voteRound in result['rounds']])
+    return { 'header': [''] + [f'R{roundIdx + 1}' for roundIdx in range(len(result['rounds']))], 'rows': rows }
+
+def shortName(name: str) -> str:
+    return name if len(name) <= VOTE_TABLE_NAME_LENGTH else name[:VOTE_TABLE_NAME_LENGTH - 1] + '…'
+
+# Tables too wide to read as text in a chat are sent as images instead
+def isWideTable(table: types.Table) -> bool:
+    return len(table['header']) - 1 > VOTE_TABLE_MAX_TEXT_COLUMNS
+
+def textWidth(text: str) -> int:
+    return len(text) if text.isascii() else max(wcswidth(text), len(text))
+
+# Draw a table as monospaced text, split into as many HTML messages as needed to respect Telegram's message length limit
+# The first column is left aligned and the others centered, every message repeats the header
+def drawTable(table: types.Table, maxLength: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    widths = [textWidth(cell) for cell in table['header']]
+    for row in table['rows']:
+        for columnIdx, cell in enumerate(row):
+            if cell:
+                widths[columnIdx] = max(widths[columnIdx], textWidth(cell))
+
+    def line(row: list[str]) -> str:
+        cells = [html.escape(row[0]) + ' ' * (widths[0] - textWidth(row[0]))]
+        for cell, width in zip(row[1:], widths[1:]):
+            padding = width - textWidth(cell)
+            cells.append(' ' * (padding // 2) + html.escape(cell) + ' ' * (padding - padding // 2))
+        return '| ' + ' | '.join(cells) + ' |'
+
+    border = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
+    top = f'<pre>{border}\n{line(table["header"])}\n{border}\n'
+    bottom = f'{border}</pre>'
+    messages = []
+    lines = []
+    length = len(top) + len(bottom)
+    for row in table['rows']:
+        rowLine = line(row) + '\n'
+        if lines and length + len(rowLine) > maxLength:
+            messages.append(top + ''.join(lines) + bottom)
+            lines = []
+            length = len(top) + len(bottom)
+        lines.append(rowLine)
+        length += len(rowLine)
+    messages.append(top + ''.join(lines) + bottom)
+    return messages
+
+# Font of the table images, the report's font if it is set up
+# Pillow is only imported once the first table image is drawn, most meetings never have a table wide enough to need one
+tableFont: 'ImageFont.FreeTypeFont | ImageFont.ImageFont | None' = None
+tableFontLock = threading.Lock()
+
+def getTableFont() -> 'ImageFont.FreeTypeFont | ImageFont.ImageFont':
+    global tableFont
+    from PIL import ImageFont
+    with tableFontLock:
+        if tableFont is None:
+            try:
+                tableFont = ImageFont.truetype(path.join(path.dirname(__file__), 'fonts', constants.fonts['DEFAULT']), VOTE_TABLE_IMAGE_FONT_SIZE)
+            except OSError:
+                tableFont = ImageFont.load_default(VOTE_TABLE_IMAGE_FONT_SIZE)
+        return tableFont
+
+# Gray levels of the table images, which are drawn as 4-bit grayscale palette images: a linear ramp, so that blending
+# palette indexes (e.g. when pasting antialiased text) blends the grays, and a quarter of the 8-bit pixel data to encode
+TABLE_IMAGE_LEVELS = 16
+TABLE_IMAGE_PALETTE = b''.join(bytes([level * 255 // (TABLE_IMAGE_LEVELS - 1)] * 3) for level in range(TABLE_IMAGE_LEVELS))
+TABLE_IMAGE_WHITE, TABLE_IMAGE_STRIPE, TABLE_IMAGE_GRID, TABLE_IMAGE_BLACK = 15, 14, 10, 0
+
+# Glyph masks of the table font by character, with the offset of their top left corner from the pen position on the
+# baseline and the pen's advance. FreeType renders whole strings slowly, so the cells' texts are put together from these
+# The masks of the cells' texts are kept as well, as the ranks, counts and submission IDs are in every table
+tableGlyphs = LRUCache(VOTE_TABLE_IMAGE_CACHE_SIZE)
+tableTextMasks = LRUCache(VOTE_TABLE_IMAGE_CACHE_SIZE)
+
+def getTableGlyph(font: 'ImageFont.FreeTypeFont | ImageFont.ImageFont', character: str) -> tuple['Image.Image | None', int, int, float]:
+    glyph = tableGlyphs.get(character)
+    if glyph is None:
+        from PIL import Image, ImageDraw
+        left, top, right, bottom = font.getbbox(character, anchor = 'ls')
+        mask = None
+        if right > left and bottom > top:
+            mask = Image.new('L', (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), character, font = font, fill = 255, anchor = 'ls')
+        glyph = (mask, left, top, font.getlength(character))
+        tableGlyphs.set(character, glyph)
+    return glyph
+
+def getTextMask(font: 'ImageFont.FreeTypeFont | ImageFont.ImageFont', text: str) -> 'Image.Image':
+    textMask = tableTextMasks.get(text)
+    if textMask is None:
+        textMask = drawTextMask(font, text)
+        tableTextMasks.set(text, textMask)
+    return textMask
+
+# Mask of a line of text in the table font, as tall as the font's ascent and descent so that every cell's text is centered alike
+def drawTextMask(font: 'ImageFont.FreeTypeFont | ImageFont.ImageFont', text: str) -> 'Image.Image':
+    from PIL import Image
+    ascent, descent = font.getmetrics()
+    glyphs = [getTableGlyph(font, character) for character in text]
+    width, pen = 0, 0.0
+    for mask, left, _, advance in glyphs:
+        if mask:
+            width = max(width, round(pen) + left + mask.width)
+        pen += advance
+    textMask = Image.new('L', (max(width, math.ceil(pen), 1), ascent + descent), 0)
+    pen = 0.0
+    for mask, left, top, advance in glyphs:
+        if mask:
+            textMask.paste(255, (round(pen) + left, ascent + top), mask)
+        pen += advance
+    return textMask
+
+# Draw a table as PNG images of up to rowsPerImage rows each, every image repeating the header
+# The first column is left aligned and the others centered, as in the text tables
+def drawTableImages(table: types.Table, rowsPerImage: int = VOTE_TABLE_IMAGE_ROWS) -> list[bytes]:
+    from PIL import Image, ImageDraw
+    font = getTableFont()
+    padding = VOTE_TABLE_IMAGE_FONT_SIZE // 4
+    rowHeight = VOTE_TABLE_IMAGE_FONT_SIZE + 2 * padding
+
+    # Most cells repeat the same few ranks or counts, each distinct text is put together (and measured) once
+    rows = [table['header']] + table['rows']
+    textMasks = { text: getTextMask(font, text) for text in set(itertools.chain.from_iterable(rows)) if text }
+    widths = [max((textMasks[row[columnIdx]].width for row in rows if row[columnIdx]), default = 0) for columnIdx in range(len(table['header']))]
+    columnStarts = [0]
+    for width in widths:
+        columnStarts.append(columnStarts[-1] + width + 2 * padding)
+
+    images = []
+    for start in range(0, max(len(table['rows']), 1), rowsPerImage):
+        rows = [table['header']] + table['rows'][start:start + rowsPerImage]
+        image = Image.new('P', (columnStarts[-1] + 1, len(rows) * rowHeight + 1), TABLE_IMAGE_WHITE)
+        image.putpalette(TABLE_IMAGE_PALETTE)
+        draw = ImageDraw.Draw(image)
+        for rowIdx, row in enumerate(rows):
+            top = rowIdx * rowHeight
+            if rowIdx % 2:
+                draw.rectangle((0, top, columnStarts[-1], top + rowHeight), fill = TABLE_IMAGE_STRIPE)
+            for columnIdx, cell in enumerate(row):
+                if not cell:
+                    continue
+                textMask = textMasks[cell]
+                if columnIdx == 0:
+                    left = columnStarts[0] + padding
+                else:
+                    left = (columnStarts[columnIdx] + columnStarts[columnIdx + 1] - textMask.width) // 2
+                image.paste(TABLE_IMAGE_BLACK, (left, top + (rowHeight - textMask.height) // 2), textMask)
+        for columnStart in columnStarts:
+            draw.line((columnStart, 0, columnStart, image.height), fill = TABLE_IMAGE_GRID)
+        for rowIdx in range(len(rows) + 1):
+            draw.line((0, rowIdx * rowHeight, image.width, rowIdx * rowHeight), fill = TABLE_IMAGE_GRID if rowIdx != 1 else TABLE_IMAGE_BLACK)
+        output = io.BytesIO()
+        image.save(output, 'PNG', compress_level = 1, bits = 4)
+        images.append(output.getvalue())
+    return images
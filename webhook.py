@@ -0,0 +1,101 @@
+import telebot
+import threading
+import queue
+import hmac
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import constants
+from constants import WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS, WEBHOOK_MAX_BODY_SIZE
+
+
+# Receives Telegram updates over HTTP (webhook mode), as an alternative to long polling
+# Every POST is checked against the secret token and queued, then answered with 200 straight away, while a bounded
+# pool of worker threads runs the bot's handlers. If the queue is full Telegram is told to retry later.
+# It can be tried out locally by POSTing recorded updates, e.g. with bench/webhookReplay.py
+class WebhookServer:
+    def __init__(self, bot: telebot.TeleBot, secretToken: str, host: str, port: int, queueSize: int = WEBHOOK_QUEUE_SIZE, workers: int = WEBHOOK_WORKERS):
+        self.bot = bot
+        # Handlers run on the webhook workers, not on the bot's own thread pool
+        self.bot.threaded = False
+        self.secretToken = secretToken.encode()
+        self.updates = queue.Queue(maxsize = queueSize)
+        self.workers = [threading.Thread(target = self.work, name = f'webhook-worker-{i}', daemon = True) for i in range(workers)]
+        self.httpServer = ThreadingHTTPServer((host, port), self.requestHandler())
+        self.httpServer.daemon_threads = True
+
+    def requestHandler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                secretToken = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode()
+                if not hmac.compare_digest(secretToken, server.secretToken):
+                    return self.respond(403)
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > WEBHOOK_MAX_BODY_SIZE:
+                    return self.respond(413)
+                try:
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    return self.respond(400)
+                if not isinstance(update, dict) or 'update_id' not in update:
+                    return self.respond(400)
+                try:
+                    server.updates.put_nowait(update)
+                except queue.Full:
+                    print(f"Webhook queue is full, asking Telegram to resend update {update['update_id']}")
+                    return self.respond(503)
+                self.respond(200)
+
+            def respond(self, status: int):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            # Updates arrive constantly, only failures are worth printing
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    def work(self):
+        while True:
+            update = self.updates.get()
+            try:
+                if update is None:
+                    return
+                self.bot.process_new_updates([telebot.types.Update.de_json(update)])
+            except Exception as e:
+                print(f"Failed to process update {update['update_id']}: {e}")
+            finally:
+                self.updates.task_done()
+
+    # Serve until interrupted, then let the workers finish the updates which were already accepted
+    def serveForever(self):
+        for worker in self.workers:
+            worker.start()
+        host, port = self.httpServer.server_address[:2]
+        print(f"Listening for webhook updates on {host}:{port}")
+        try:
+            self.httpServer.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpServer.server_close()
+            for _ in self.workers:
+                self.updates.put(None)
+            for worker in self.workers:
+                worker.join()
+
+
+# Run the bot in webhook mode, registering the webhook with Telegram if a public URL is configured
+# Without one, the server only listens (e.g. behind a proxy whose webhook is already set, or for local testing)
+def serve(bot: telebot.TeleBot):
+    if not constants.WEBHOOK_SECRET_TOKEN:
+        raise Exception('Missing environment variable: WEBHOOK_SECRET_TOKEN')
+    server = WebhookServer(bot, constants.WEBHOOK_SECRET_TOKEN, constants.WEBHOOK_HOST, constants.WEBHOOK_PORT)
+    if constants.WEBHOOK_URL:
+        bot.set_webhook(url = constants.WEBHOOK_URL, secret_token = constants.WEBHOOK_SECRET_TOKEN)
+        print(f"Registered webhook {constants.WEBHOOK_URL}")
+    server.serveForever()